@@ -0,0 +1,431 @@
+"""
+AttachmentInspector:
+    Streaming inspection of archive and Office attachments
+
+Zip archives (and OOXML documents, which are zip archives) are inspected
+from their central directory, read from the end of the stream, and the
+first bytes of each entry, inflated with a bounded output.  OLE documents
+(doc, xls, ppt, msi...) are inspected from their directory.  Nothing is
+extracted to disk, and limits on entries, sizes, compression ratio and
+nesting depth stop zip bombs before anything large is read.
+
+The result is a dict that can be serialized to JSON:
+
+    {'type': 'zip', 'entries': 3, 'types': {'exe': 1, 'text': 2},
+     'executables': ['invoice.pdf.exe'], 'macros': False, 'encrypted': [],
+     'embedded': [], 'external_links': False, 'nested': [...], 'limits': [], ...}
+"""
+
+import bz2
+import collections
+import io
+import struct
+import zlib
+
+import olefile as OleFile
+
+import MagicSniffer
+
+INSPECTED_TYPES = frozenset(('zip', 'ooxml', 'jar', 'ole'))
+
+_EOCD = b'PK\x05\x06'
+_EOCD64_LOCATOR = b'PK\x06\x07'
+_EOCD64 = b'PK\x06\x06'
+_CENTRAL_HEADER = struct.Struct('<4sHHHHHHIIIHHHHHII')
+_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_READ_SIZE = 16 * 1024
+# Relationship parts are small, a bigger one is not read
+_MAX_RELS_SIZE = 256 * 1024
+_MAX_RELS_PARTS = 64
+_MACRO_PARTS = ('vbaproject.bin', 'vbadata.xml')
+_OLE_MACRO_STORAGES = ('macros', '_vba_project_cur', 'vba', '_vba_project')
+# The FILEPASS record of an encrypted workbook is among its first records
+_WORKBOOK_HEAD_SIZE = 64 * 1024
+
+
+class InspectionError(Exception):
+    pass
+
+
+class ZipEntry(object):
+    __slots__ = ('name', 'flags', 'method', 'compressed_size', 'size', 'offset')
+
+    def __init__(self, name, flags, method, compressed_size, size, offset):
+        self.name = name
+        self.flags = flags
+        self.method = method
+        self.compressed_size = compressed_size
+        self.size = size
+        self.offset = offset
+
+    @property
+    def encrypted(self):
+        return bool(self.flags & 0x1)
+
+    @property
+    def is_dir(self):
+        return self.name.endswith('/')
+
+
+def _decode_name(raw, flags):
+    if flags & 0x800:
+        return raw.decode('utf-8', 'replace')
+    return raw.decode('cp437')
+
+
+def _zip64_extra(extra, size, compressed_size, offset):
+    # The fields set to 0xFFFFFFFF in the central directory follow in the zip64 extra field, in this order
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, length = struct.unpack_from('<HH', extra, pos)
+        if tag == 0x0001:
+            values = extra[pos + 4:pos + 4 + length]
+            fields = []
+            for value in (size, compressed_size, offset):
+                if value == 0xFFFFFFFF and len(values) >= 8:
+                    fields.append(struct.unpack_from('<Q', values)[0])
+                    values = values[8:]
+                else:
+                    fields.append(value)
+            return fields
+        pos += 4 + length
+    return size, compressed_size, offset
+
+
+def is_risky(result):
+    """True if an inspection result (see Inspector.inspect) found something worth an analyst's look"""
+    if not result:
+        return False
+    if result['executables'] or result['macros'] or result['encrypted'] or result['embedded'] \
+            or result['external_links'] or result['limits']:
+        return True
+    return any(is_risky(nested) for nested in result['nested'])
+
+
+class Inspector(object):
+    """Inspects attachments, remembering the result of the last cache_size payloads by SHA-1.
+    Instances are meant to be shared, e.g. by all the messages of a process.
+    Zip archives are not inspected beyond max_entries entries or a central directory of
+    max_central_directory bytes, and are reported (in 'limits') when they declare more than
+    max_total_size bytes, a compression ratio above max_ratio or overlapping entries.
+    Nested archives up to max_nested_size bytes are inflated in memory and inspected in turn,
+    up to max_depth levels.
+    lookup, when set, is called with the SHA-1 of a payload missing from the cache and returns its
+    result from an earlier inspection (e.g. stored in a database) or None.
+    """
+    def __init__(self, max_entries=10000, max_central_directory=8 * 1024 * 1024, max_total_size=2 * 1024 ** 3,
+                 max_ratio=200, max_nested_size=32 * 1024 * 1024, max_depth=2, max_listed=100, cache_size=4096,
+                 lookup=None):
+        self.max_entries = max_entries
+        self.max_central_directory = max_central_directory
+        self.max_total_size = max_total_size
+        self.max_ratio = max_ratio
+        self.max_nested_size = max_nested_size
+        self.max_depth = max_depth
+        self.max_listed = max_listed
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self.lookup = lookup
+        self.hits = 0
+        self.misses = 0
+
+    def inspect(self, sha1, magic, open_stream):
+        """Result of the inspection of a payload of type magic (see MagicSniffer.sniff), or None if
+        that type is not inspected. open_stream returns a seekable file object over the payload and is
+        only called when the SHA-1 is neither in the cache nor found by lookup.
+        """
+        if magic not in INSPECTED_TYPES:
+            return None
+        if sha1 is not None and sha1 in self._cache:
+            self._cache.move_to_end(sha1)
+            self.hits += 1
+            return self._cache[sha1]
+        result = None
+        if sha1 is not None and self.lookup is not None:
+            result = self.lookup(sha1)
+        if result is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            stream = open_stream()
+            if stream is None:
+                return None
+            try:
+                result = self.inspect_stream(stream, magic)
+            finally:
+                stream.close()
+        if sha1 is not None and self.cache_size:
+            self._cache[sha1] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def inspect_stream(self, f, magic, depth=0):
+        """Inspects the seekable file object f, a payload of type magic"""
+        result = {'type': magic, 'entries': 0, 'types': {}, 'listed': [], 'executables': [], 'macros': False,
+                  'encrypted': [], 'embedded': [], 'external_links': False, 'nested': [], 'limits': []}
+        try:
+            if magic == 'ole':
+                self._inspect_ole(f, result)
+            else:
+                self._inspect_zip(f, result, depth)
+        except (InspectionError, IOError, ValueError, struct.error, zlib.error, EOFError) as e:
+            result['error'] = "%s: %s" % (type(e).__name__, e)
+        return result
+
+    def _add(self, result, name, magic, **details):
+        result['types'][magic] = result['types'].get(magic, 0) + 1
+        if MagicSniffer.is_executable(magic):
+            result['executables'].append(name)
+        if len(result['listed']) < self.max_listed:
+            item = {'name': name, 'magic': magic}
+            item.update(details)
+            result['listed'].append(item)
+
+    # --- Zip and OOXML --------------------------------------------------------
+
+    def _central_directory(self, f, result):
+        f.seek(0, io.SEEK_END)
+        size = f.tell()
+        tail_size = min(size, 22 + 65535)
+        f.seek(size - tail_size)
+        tail = f.read(tail_size)
+        pos = tail.rfind(_EOCD)
+        if pos == -1 or pos + 22 > len(tail):
+            raise InspectionError("no end of central directory")
+        count, cd_size, cd_offset = struct.unpack_from('<10xHII', tail, pos)
+        shift = 0
+        if count == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+            locator = pos - 20
+            if locator < 0 or tail[locator:locator + 4] != _EOCD64_LOCATOR:
+                raise InspectionError("missing zip64 end of central directory locator")
+            f.seek(struct.unpack_from('<Q', tail, locator + 8)[0])
+            record = f.read(56)
+            if record[:4] != _EOCD64:
+                raise InspectionError("bad zip64 end of central directory")
+            count, cd_size, cd_offset = struct.unpack_from('<QQQ', record, 32)
+        else:
+            # Data prepended to the archive (self-extracting archives) shifts every offset
+            shift = (size - tail_size + pos) - cd_size - cd_offset
+            if shift < 0:
+                raise InspectionError("central directory overlaps its end record")
+        result['entries'] = count
+        if count > self.max_entries:
+            result['limits'].append('entries')
+        if cd_size > self.max_central_directory:
+            result['limits'].append('central_directory')
+            raise InspectionError("central directory of %d bytes" % cd_size)
+        f.seek(cd_offset + shift)
+        directory = f.read(cd_size)
+        entries = []
+        pos = 0
+        while pos + _CENTRAL_HEADER.size <= len(directory) and len(entries) < min(count, self.max_entries):
+            (signature, _, _, flags, method, _, _, _, compressed_size, size, name_length, extra_length,
+             comment_length, _, _, _, offset) = _CENTRAL_HEADER.unpack_from(directory, pos)
+            if signature != b'PK\x01\x02':
+                raise InspectionError("bad central directory entry")
+            start = pos + _CENTRAL_HEADER.size
+            name = _decode_name(directory[start:start + name_length], flags)
+            if 0xFFFFFFFF in (compressed_size, size, offset):
+                extra = directory[start + name_length:start + name_length + extra_length]
+                size, compressed_size, offset = _zip64_extra(extra, size, compressed_size, offset)
+            entries.append(ZipEntry(name, flags, method, compressed_size, size, offset + shift))
+            pos = start + name_length + extra_length + comment_length
+        return entries, cd_offset + shift
+
+    def _check_bomb(self, entries, cd_offset, result):
+        total = 0
+        offsets = set()
+        for entry in entries:
+            total += entry.size
+            if entry.size > 1024 * 1024 and entry.size > self.max_ratio * max(entry.compressed_size, 1):
+                if 'ratio' not in result['limits']:
+                    result['limits'].append('ratio')
+            if entry.offset in offsets or entry.offset + entry.compressed_size > cd_offset:
+                # Entries sharing their data, a known way to build zip bombs
+                if 'overlap' not in result['limits']:
+                    result['limits'].append('overlap')
+            offsets.add(entry.offset)
+        result['size'] = total
+        if total > self.max_total_size:
+            result['limits'].append('total_size')
+
+    def _data_offset(self, f, entry):
+        f.seek(entry.offset)
+        header = f.read(_LOCAL_HEADER.size)
+        if len(header) < _LOCAL_HEADER.size or header[:4] != b'PK\x03\x04':
+            raise InspectionError("bad local header for %s" % entry.name)
+        name_length, extra_length = struct.unpack_from('<HH', header, 26)
+        return entry.offset + _LOCAL_HEADER.size + name_length + extra_length
+
+    def _read_entry(self, f, entry, limit):
+        """Returns at most limit bytes of the content of entry, reading and inflating no more than needed"""
+        f.seek(self._data_offset(f, entry))
+        remaining = entry.compressed_size
+        if entry.method == 0:
+            return f.read(min(limit, remaining))
+        if entry.method == 8:
+            decompressor = zlib.decompressobj(-15)
+        elif entry.method == 12:
+            decompressor = bz2.BZ2Decompressor()
+        else:
+            return None
+        chunks = []
+        produced = 0
+        while produced < limit and remaining > 0:
+            data = f.read(min(_READ_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            chunk = decompressor.decompress(data, limit - produced)
+            chunks.append(chunk)
+            produced += len(chunk)
+            if entry.method == 8 and decompressor.unconsumed_tail:
+                # Output limit reached
+                break
+        return b''.join(chunks)[:limit]
+
+    def _inspect_zip(self, f, result, depth):
+        entries, cd_offset = self._central_directory(f, result)
+        self._check_bomb(entries, cd_offset, result)
+        names = [entry.name for entry in entries]
+        lower = [name.lower() for name in names]
+        if any(name == '[content_types].xml' for name in lower):
+            result['type'] = 'ooxml'
+        if result['type'] == 'ooxml':
+            result['macros'] = any(name.rsplit('/', 1)[-1] in _MACRO_PARTS for name in lower)
+            result['embedded'] = [name for name, low in zip(names, lower)
+                                  if '/embeddings/' in low or '/activex/' in low][:self.max_listed]
+        bomb = bool(result['limits'])
+        rels = 0
+        for entry in entries:
+            if entry.is_dir:
+                continue
+            if entry.encrypted:
+                result['encrypted'].append(entry.name)
+                self._add(result, entry.name, 'unknown', size=entry.size, encrypted=True)
+                continue
+            if bomb:
+                # Only the names of the entries of a suspected bomb are looked at
+                self._add(result, entry.name, 'unknown', size=entry.size)
+                continue
+            if result['type'] == 'ooxml' and entry.name.lower().endswith('.rels') and rels < _MAX_RELS_PARTS \
+                    and entry.size <= _MAX_RELS_SIZE:
+                # Remote template or object, e.g. attachedTemplate with TargetMode="External"
+                rels += 1
+                content = self._read_entry(f, entry, _MAX_RELS_SIZE) or b''
+                if b'TargetMode="External"' in content and (b'attachedTemplate' in content or b'oleObject' in content):
+                    result['external_links'] = True
+            head = self._read_entry(f, entry, MagicSniffer.SNIFF_SIZE)
+            magic = MagicSniffer.sniff(head) if head is not None else 'unknown'
+            self._add(result, entry.name, magic, size=entry.size)
+            # Embedded OLE objects of OOXML documents may hold macros of their own
+            if magic in INSPECTED_TYPES and (result['type'] != 'ooxml' or '/embeddings/' in entry.name.lower()):
+                self._inspect_nested(f, entry, magic, result, depth)
+
+    def _inspect_nested(self, f, entry, magic, result, depth):
+        if depth + 1 > self.max_depth:
+            if 'depth' not in result['limits']:
+                result['limits'].append('depth')
+            return
+        if entry.size > self.max_nested_size:
+            if 'nested_size' not in result['limits']:
+                result['limits'].append('nested_size')
+            return
+        content = self._read_entry(f, entry, self.max_nested_size)
+        if content is None:
+            return
+        nested = self.inspect_stream(io.BytesIO(content), magic, depth + 1)
+        nested['name'] = entry.name
+        result['nested'].append(nested)
+
+    # --- OLE ------------------------------------------------------------------
+
+    def _inspect_ole(self, f, result):
+        f.seek(0)
+        try:
+            ole = OleFile.OleFileIO(f)
+        except Exception as e:
+            # olefile raises a variety of exceptions on damaged files
+            raise InspectionError("not a valid OLE file (%s)" % e)
+        streams = ole.listdir(streams=True, storages=True)
+        result['entries'] = len(streams)
+        if len(streams) > self.max_entries:
+            result['limits'].append('entries')
+        names = set()
+        for path in streams[:self.max_entries]:
+            lower = [part.lower() for part in path]
+            names.add('/'.join(lower))
+            if any(part in _OLE_MACRO_STORAGES for part in lower[:-1]) or lower[-1] == 'vba':
+                result['macros'] = True
+            if lower[-1] in ('\x01ole10native', 'package', 'contents') and ole.get_type(path) == OleFile.STGTY_STREAM:
+                result['embedded'].append('/'.join(path))
+            if len(result['listed']) < self.max_listed:
+                result['listed'].append({'name': '/'.join(path)})
+        if 'encryptioninfo' in names and 'encryptedpackage' in names:
+            # Password protected OOXML document
+            result['encrypted'].append('EncryptedPackage')
+        elif 'worddocument' in names:
+            # fEncrypted flag of the Word file information block
+            fib = self._ole_head(ole, 'WordDocument', 12)
+            if len(fib) == 12 and struct.unpack_from('<H', fib, 10)[0] & 0x0100:
+                result['encrypted'].append('WordDocument')
+        elif 'workbook' in names:
+            if self._excel_filepass(io.BytesIO(self._ole_head(ole, 'Workbook', _WORKBOOK_HEAD_SIZE))):
+                result['encrypted'].append('Workbook')
+
+    @staticmethod
+    def _ole_head(ole, name, size):
+        """Returns at most size bytes from the start of stream name of ole, reading only their sectors:
+        openstream reads the whole stream, or the whole ministream for a small one, in memory
+        """
+        entry = ole.direntries[ole._find(name)]
+        if entry.entry_type != OleFile.STGTY_STREAM:
+            raise IOError("%s is not a stream" % name)
+        size = min(size, entry.size)
+        if entry.size >= ole.minisectorcutoff:
+            return Inspector._ole_read(ole, entry.isectStart, 0, size)
+        if ole.minifat is None:
+            ole.loadminifat()
+        chunks = []
+        for sector in Inspector._ole_chain(ole.minifat, entry.isectStart, -(-size // ole.minisectorsize)):
+            # Mini sectors are stored in the stream of the root entry
+            chunks.append(Inspector._ole_read(ole, ole.root.isectStart, sector * ole.minisectorsize,
+                                              ole.minisectorsize))
+        return b''.join(chunks)[:size]
+
+    @staticmethod
+    def _ole_chain(fat, start, count):
+        # At most count sectors, a looping chain stops there
+        sectors = []
+        while len(sectors) < count and 0 <= start < len(fat):
+            sectors.append(start)
+            start = fat[start]
+        return sectors
+
+    @staticmethod
+    def _ole_read(ole, start, offset, size):
+        """Returns size bytes at offset of the regular stream starting at sector start"""
+        first = offset // ole.sectorsize
+        chunks = []
+        for sector in Inspector._ole_chain(ole.fat, start, -(-(offset + size) // ole.sectorsize))[first:]:
+            ole.fp.seek((sector + 1) * ole.sectorsize)
+            chunks.append(ole.fp.read(ole.sectorsize))
+        skip = offset - first * ole.sectorsize
+        return b''.join(chunks)[skip:skip + size]
+
+    @staticmethod
+    def _excel_filepass(stream, records=64):
+        # A FILEPASS record follows the first BOF of encrypted workbooks
+        for _ in range(records):
+            header = stream.read(4)
+            if len(header) < 4:
+                return False
+            record, length = struct.unpack('<HH', header)
+            if record == 0x002F:
+                return True
+            if record == 0x00E1 or record == 0x0042:
+                # INTERFACEHDR or CODEPAGE come after FILEPASS
+                return False
+            stream.seek(length, io.SEEK_CUR)
+        return False
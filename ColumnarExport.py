@@ -0,0 +1,317 @@
+"""
+ColumnarExport:
+    Export of the analyzed messages to columnar files (Parquet or Arrow IPC)
+
+Writes three datasets of the EmailAnalyzer database under a directory, each
+one partitioned by month of the message date, Hive style:
+
+    messages/month=2018-10/part-0.parquet     one row per message, nested ones included
+    attachments/month=2018-10/part-0.parquet  one row per attachment, with its content size and flags
+    urls/month=2018-10/part-0.parquet         one row per link of a message body
+
+Messages without a date go to month=unknown.  Columns are typed and senders,
+domains, extensions and types are dictionary encoded.  Rows are read from the
+database batch_size at a time and written as row groups (record batches for
+Arrow) of at most row_group_size rows, so memory does not depend on the size
+of the corpus.  Requires pyarrow, which the rest of the project does not need.
+
+    python MsgAnalyzer.py columnar OUTPUT_DIR [--database sqlite:///db.sqlite] [--format arrow]
+
+    import pyarrow.dataset
+    messages = pyarrow.dataset.dataset('OUTPUT_DIR/messages', format='parquet', partitioning='hive')
+    table = messages.to_table().unify_dictionaries()  # files have their own dictionaries
+"""
+
+import logging
+import os
+
+from sqlalchemy import select, func
+
+from EmailAnalyzer import Message, Attachment, AttachmentContent, MessageUrl, Url
+
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+UNKNOWN_MONTH = 'unknown'
+
+# Columns of the datasets and their types: int32, int64, bool, timestamp, string or dictionary (of strings)
+MESSAGE_COLUMNS = (
+    ('id', 'int64'),
+    ('parent_id', 'int64'),
+    ('campaign_id', 'int64'),
+    ('date', 'timestamp'),
+    ('sender', 'dictionary'),
+    ('sender_email', 'dictionary'),
+    ('sender_domain', 'dictionary'),
+    ('to', 'string'),
+    ('cc', 'string'),
+    ('subject', 'string'),
+    ('spf_pass', 'bool'),
+    ('distinct_senders_in_header', 'int32'),
+    ('from_mismatch_header', 'bool'),
+    ('internal_mail', 'bool'),
+    ('attachment_count', 'int32'),
+    ('url_count', 'int32'),
+    ('nested_limits', 'dictionary'),
+)
+BODY_COLUMNS = (
+    ('header', 'string'),
+    ('body', 'string'),
+)
+ATTACHMENT_COLUMNS = (
+    ('id', 'int64'),
+    ('message_id', 'int64'),
+    ('date', 'timestamp'),
+    ('sender_domain', 'dictionary'),
+    ('short_name', 'string'),
+    ('long_name', 'string'),
+    ('extension', 'dictionary'),
+    ('magic', 'dictionary'),
+    ('type_mismatch', 'bool'),
+    ('risky', 'bool'),
+    ('sha1', 'string'),
+    ('size', 'int64'),
+    ('has_macros', 'bool'),
+    ('encrypted', 'bool'),
+)
+URL_COLUMNS = (
+    ('message_id', 'int64'),
+    ('date', 'timestamp'),
+    ('sender_domain', 'dictionary'),
+    ('url', 'string'),
+    ('host', 'dictionary'),
+)
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("ColumnarExport requires pyarrow: pip install pyarrow")
+    return pyarrow
+
+
+def schema(columns):
+    """pyarrow schema of columns, a sequence of (name, type) such as MESSAGE_COLUMNS"""
+    pa = _pyarrow()
+    types = {
+        'int32': pa.int32(),
+        'int64': pa.int64(),
+        'bool': pa.bool_(),
+        # Parquet has no seconds unit
+        'timestamp': pa.timestamp('ms'),
+        'string': pa.string(),
+        'dictionary': pa.dictionary(pa.int32(), pa.string()),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in columns])
+
+
+def month(date):
+    return date.strftime('%Y-%m') if date is not None else UNKNOWN_MONTH
+
+
+def domain_of(email):
+    if not email or '@' not in email:
+        return None
+    return email.rsplit('@', 1)[1].lower()
+
+
+def extension_of(name):
+    if not name:
+        return None
+    extension = os.path.splitext(name)[1].lower()
+    return extension or None
+
+
+class PartitionFile(object):
+    """Rows of one partition of a dataset, buffered by column and written to their file as row groups.
+    Arrow files keep one dictionary per column for the whole file, extended as new values come
+    (dictionary deltas); Parquet row groups each get the dictionary of their own values.
+    """
+    def __init__(self, path, columns, schema, fmt):
+        pa = _pyarrow()
+        self.path = path
+        self.columns = columns
+        self.schema = schema
+        self.fmt = fmt
+        self.buffers = [[] for column in columns]
+        self.rows = 0
+        self.dictionaries = [{} if kind == 'dictionary' else None for name, kind in columns]
+        self.dictionary_arrays = [pa.array([], pa.string()) if kind == 'dictionary' else None
+                                  for name, kind in columns]
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if fmt == 'arrow':
+            options = pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+            self.writer = pa.ipc.new_file(path, schema, options=options)
+        else:
+            self.writer = pa.parquet.ParquetWriter(path, schema)
+
+    def add(self, row):
+        for buffer, value in zip(self.buffers, row):
+            buffer.append(value)
+        self.rows += 1
+
+    def _array(self, i, values):
+        pa = _pyarrow()
+        field = self.schema.field(i)
+        if self.dictionaries[i] is None:
+            return pa.array(values, field.type)
+        if self.fmt != 'arrow':
+            return pa.array(values, pa.string()).dictionary_encode().cast(field.type)
+        dictionary = self.dictionaries[i]
+        new = []
+        indices = []
+        for value in values:
+            if value is None:
+                indices.append(None)
+                continue
+            index = dictionary.get(value)
+            if index is None:
+                index = dictionary[value] = len(dictionary)
+                new.append(value)
+            indices.append(index)
+        if new:
+            self.dictionary_arrays[i] = pa.concat_arrays([self.dictionary_arrays[i], pa.array(new, pa.string())])
+        return pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()), self.dictionary_arrays[i])
+
+    def flush(self):
+        if not self.rows:
+            return
+        pa = _pyarrow()
+        arrays = [self._array(i, values) for i, values in enumerate(self.buffers)]
+        batch = pa.record_batch(arrays, schema=self.schema)
+        if self.fmt == 'arrow':
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        self.buffers = [[] for column in self.columns]
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class DatasetWriter(object):
+    """Writes the rows of a dataset to one file per partition, in row groups of at most row_group_size
+    rows. At most max_buffered rows are kept in memory across partitions: beyond, the largest
+    partition is written even if its row group is not full.
+    """
+    def __init__(self, directory, columns, fmt='parquet', row_group_size=100000, max_buffered=None):
+        if fmt not in FORMATS:
+            raise ValueError("Unknown format %s, expected one of %s" % (fmt, ', '.join(sorted(FORMATS))))
+        self.directory = directory
+        self.columns = columns
+        self.schema = schema(columns)
+        self.fmt = fmt
+        self.row_group_size = row_group_size
+        self.max_buffered = max_buffered or 4 * row_group_size
+        self.partitions = {}
+        self.buffered = 0
+        self.rows = 0
+
+    def add(self, partition, row):
+        """Adds row, a tuple of the values of the columns, to partition (e.g. '2018-10')"""
+        current = self.partitions.get(partition)
+        if current is None:
+            path = os.path.join(self.directory, 'month=%s' % partition, 'part-0%s' % FORMATS[self.fmt])
+            current = self.partitions[partition] = PartitionFile(path, self.columns, self.schema, self.fmt)
+        current.add(row)
+        self.buffered += 1
+        self.rows += 1
+        if current.rows >= self.row_group_size:
+            self._flush(current)
+        elif self.buffered >= self.max_buffered:
+            self._flush(max(self.partitions.values(), key=lambda partition: partition.rows))
+
+    def _flush(self, partition):
+        self.buffered -= partition.rows
+        partition.flush()
+
+    def close(self):
+        for partition in self.partitions.values():
+            partition.close()
+        self.buffered = 0
+
+
+def message_query(include_body=False):
+    attachment_count = select(func.count(Attachment.id)).where(Attachment.message_id == Message.id) \
+        .scalar_subquery()
+    url_count = select(func.count(MessageUrl.id)).where(MessageUrl.message_id == Message.id).scalar_subquery()
+    columns = [Message.id, Message.parent_id, Message.campaign_id, Message.date, Message.sender,
+               Message.sender_email, Message.to, Message.cc, Message.subject, Message.spf_pass,
+               Message.distinct_senders_in_header, Message.from_mismatch_header, Message.internal_mail,
+               attachment_count, url_count, Message.nested_limits]
+    if include_body:
+        columns += [Message.header, Message.body]
+    return select(*columns).order_by(Message.id)
+
+
+def message_row(row):
+    return row[:6] + (domain_of(row[5]),) + row[6:]
+
+
+def attachment_query():
+    return select(Attachment.id, Attachment.message_id, Message.date, Message.sender_email, Attachment.short_name,
+                  Attachment.long_name, Attachment.magic, Attachment.type_mismatch, Attachment.risky,
+                  Attachment.sha1, AttachmentContent.size, AttachmentContent.has_macros,
+                  AttachmentContent.encrypted) \
+        .join(Message, Attachment.message_id == Message.id) \
+        .outerjoin(AttachmentContent, Attachment.sha1 == AttachmentContent.sha1) \
+        .order_by(Attachment.id)
+
+
+def attachment_row(row):
+    return row[:3] + (domain_of(row[3]),) + row[4:6] + (extension_of(row[5] or row[4]),) + row[6:]
+
+
+def url_query():
+    return select(MessageUrl.message_id, Message.date, Message.sender_email, MessageUrl.url, Url.host) \
+        .join(Message, MessageUrl.message_id == Message.id) \
+        .outerjoin(Url, MessageUrl.url == Url.url) \
+        .order_by(MessageUrl.id)
+
+
+def url_row(row):
+    return row[:2] + (domain_of(row[2]),) + row[3:]
+
+
+def export_query(connection, query, to_row, writer, batch_size=10000):
+    """Streams the rows of query, turned into rows of the dataset by to_row, to writer (a DatasetWriter)
+    batch_size rows at a time. Rows are partitioned by the month of their date column.
+    """
+    date_index = [name for name, kind in writer.columns].index('date')
+    result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+    for rows in result.partitions(batch_size):
+        for row in rows:
+            row = to_row(tuple(row))
+            writer.add(month(row[date_index]), row)
+
+
+def export(connection, directory, fmt='parquet', batch_size=10000, row_group_size=100000, include_body=False):
+    """Writes the messages, attachments and urls datasets of the database of connection under directory,
+    in fmt ('parquet' or 'arrow'). The header and body of the messages are only exported if include_body
+    is set. Returns the number of rows written per dataset.
+    """
+    _pyarrow()
+    datasets = (
+        ('messages', MESSAGE_COLUMNS + (BODY_COLUMNS if include_body else ()), message_query(include_body),
+         message_row),
+        ('attachments', ATTACHMENT_COLUMNS, attachment_query(), attachment_row),
+        ('urls', URL_COLUMNS, url_query(), url_row),
+    )
+    for name, columns, query, to_row in datasets:
+        if os.path.exists(os.path.join(directory, name)):
+            raise IOError("%s already exists" % os.path.join(directory, name))
+    counts = {}
+    for name, columns, query, to_row in datasets:
+        writer = DatasetWriter(os.path.join(directory, name), columns, fmt, row_group_size)
+        try:
+            export_query(connection, query, to_row, writer, batch_size)
+        finally:
+            writer.close()
+        counts[name] = writer.rows
+        logging.info("%d rows written to %s in %d partitions" % (writer.rows, name, len(writer.partitions)))
+    return counts
@@ -3,16 +3,25 @@ from sqlalchemy.types import DateTime
 from sqlalchemy.types import String, Unicode
 from sqlalchemy.types import Integer
 from sqlalchemy.types import Boolean
-from sqlalchemy import Column, ForeignKey, create_engine
-from sqlalchemy.orm import relationship, backref, sessionmaker
+from sqlalchemy.types import Float
+from sqlalchemy.types import BigInteger, LargeBinary
+from sqlalchemy import Column, ForeignKey, create_engine, func, select, delete, bindparam
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import relationship, backref
+from sqlalchemy import inspect as inspect_object
 from ExtractMsg import Message as MessageParser
-from ExtractMsg import Attachment as AttachmentParser
+# The analysis itself does not depend on the database
+from MessageAnalysis import MessageAnalysis, AttachmentAnalysis, file_signature, analyze_files, file_status, \
+    QUARANTINED
+import UrlExtractor
+import MinHash
+import Instrumentation
 import logging
+import os
+import time
 from datetime import datetime
-import re
 import json
 
-logging.basicConfig(level=logging.DEBUG)
 Base = declarative_base()
 
 class Message(Base):
@@ -32,106 +41,60 @@ class Message(Base):
     from_mismatch_header = Column(Boolean)
 
     internal_mail = Column(Boolean)
-    attachments = relationship("Attachment", backref="message")
+    attachments = relationship("Attachment", backref="message", cascade="all")
 
     parent_id = Column(Integer, ForeignKey('message.id'))
-    nested_messages = relationship("Message", backref=backref('parent', remote_side=[id]))
+    nested_messages = relationship("Message", backref=backref('parent', remote_side=[id]), cascade="all")
+    url_links = relationship("MessageUrl", backref="message", cascade="all")
+    minhash = Column(LargeBinary)  # see MinHash.pack
+    campaign_id = Column(Integer, ForeignKey('campaign.id'), index=True)
+    campaign = relationship("Campaign", backref="messages")
+    lsh_buckets = relationship("LshBucket", backref="message", cascade="all, delete-orphan")
+    nested_limits = Column(String)  # limits of ExtractMsg.NestedWalk reached, comma separated
 
-    def __init__(self, msgFilePath=None, msgParser=None):
-        if msgFilePath is not None:
-            self.msg_parser = MessageParser(msgFilePath=msgFilePath)
-        elif msgParser is not None:
-            self.msg_parser = msgParser
-        else:
-            raise Exception("No path or msgParser given")
-        self.sender = self.msg_parser.sender
-        try:
-            self.sender_email = re.search(r"([a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+)", self.sender).group() #Parse according to RFC5322
-        except AttributeError:
-            self.sender_email = None
-        self.to = self.msg_parser.to
-        self.cc = self.msg_parser.cc
-        self.subject = self.msg_parser.subject
-        self.header = self.msg_parser.headerStr
-        self.body = self.msg_parser.body
-        self.urls = json.dumps(self.extract_urls(self.body))
-        date = self.msg_parser.parsedDate
-        self.date = datetime(
-            year=date[0],
-            month=date[1],
-            day=date[2],
-            hour=date[3],
-            minute=date[4],
-            second=date[5]
-        )
-
-        for attachment in self.msg_parser.attachments:
-            if isinstance(attachment, MessageParser):
-                self.nested_messages.append(Message(msgParser=attachment))
-            elif isinstance(attachment, AttachmentParser):
-                self.attachments.append(Attachment(attachment))
-
-        self.score_mail()
-        pass
-
-    @staticmethod
-    def extract_urls(html):
-        if not html:
-            return
-        urls = re.findall(r'(http[s]?://.*?)(?:>| |(?:\r\n){2})', html, flags=re.DOTALL|re.MULTILINE)
-        urls = [url.replace('\r\n','') for url in urls]
-        for url in urls:
-
-        return urls
-
-    def score_mail(self):
-        status, spf_senders = self.spf()
-        envelope_from, x_sender = self.check_sender()
-        if not self.internal_mail:
-            all_senders = spf_senders + envelope_from + x_sender
-            all_senders = list(set(all_senders))
-            if len(all_senders) > 1:
-                logging.warning("/!\ Multiple senders declared : %s"%all_senders)
-                self.distinct_senders_in_header = len(all_senders)
-            if self.sender_email not in all_senders:
-                logging.warning("/!\ sender email %s is not present in server generated headers (%s), email must be forged"%(self.sender_email, all_senders))
-                self.from_mismatch_header = True
-        else:
-            #Internal
-            pass
-
-    def check_sender(self):
-        envelope_from = re.findall("envelope-from=\"(.*?)\"", self.header, flags=re.MULTILINE|re.DOTALL)
-        envelope_from = list(set(envelope_from))
-        logging.info("enveloppe from : %s" % envelope_from)
-        x_sender = re.findall("x-sender=\"(.*?)\"", self.header, flags=re.MULTILINE|re.DOTALL)
-        x_sender = list(set(x_sender))
-        logging.info("xsender : %s" % x_sender)
-        return envelope_from, x_sender
-
-    def spf(self):
-        spfs = re.findall("Received-SPF: (Pass|None) (\(.*?\.MYDOMAIN\.fr: .*?\))", self.header, flags=re.MULTILINE|re.DOTALL)
-        senders = []
-        spf_pass = False
-        for spf in spfs:
-            logging.debug("SPF : %s, %s"%spf)
-            if spf[0] == "Pass":
-                spf_pass = True
-                logging.info("SPF is OK : %s, %s"%spf)
-            sender = re.findall("\S*?@[^) ]*",spf[1])
-            if sender is not None:
-                senders += sender
-        if not spf_pass:
-            if not "Received-SPF" in self.header:
-                logging.info("Internal email : %s"%self.header)
-                self.internal_mail = True
-                spf_pass = True
+    # Shared by all messages unless one is given to __init__
+    header_analyzer = MessageAnalysis.header_analyzer
+    inspector = MessageAnalysis.inspector
+    # Columns copied as is from MessageAnalysis
+    analysis_fields = ('sender', 'sender_email', 'to', 'cc', 'subject', 'header', 'body', 'date', 'spf_pass',
+                       'distinct_senders_in_header', 'from_mismatch_header', 'internal_mail', 'minhash',
+                       'nested_limits')
+
+    def __init__(self, msgFilePath=None, msgParser=None, blob_store=None, header_analyzer=None, inspector=None,
+                 nested_limits=None, walk_nested=True, analysis=None):
+        """Stores analysis, a MessageAnalysis, or the analysis of the message at msgFilePath or of msgParser
+        (see MessageAnalysis for the other arguments).
+        """
+        if analysis is None:
+            if msgFilePath is not None:
+                self.msg_parser = MessageParser(msgFilePath=msgFilePath, snapshot=True)
+            elif msgParser is not None:
+                self.msg_parser = msgParser
             else:
-                logging.info("SPF is KO : %s"%spfs)
-        senders = list(set(senders))
-        logging.info("SPF Senders : %s"%senders)
-        self.spf_pass = spf_pass
-        return spf_pass, senders
+                raise Exception("No path, msgParser or analysis given")
+            analysis = MessageAnalysis(self.msg_parser, blob_store=blob_store,
+                                       header_analyzer=header_analyzer or self.header_analyzer,
+                                       inspector=inspector or self.inspector, nested_limits=nested_limits,
+                                       walk_nested=walk_nested)
+        for name in self.analysis_fields:
+            setattr(self, name, getattr(analysis, name))
+        self.header_analysis = analysis.header_analysis
+        self.urls = json.dumps(analysis.urls)
+        for url in analysis.urls:
+            self.url_links.append(MessageUrl(url=url))
+        for attachment in analysis.attachments:
+            self.attachments.append(Attachment(analysis=attachment))
+        for nested in analysis.nested:
+            self.nested_messages.append(Message(analysis=nested))
+
+    def release_parser(self):
+        """Closes the underlying .msg file once all the fields have been extracted.
+        The message (and its nested messages) can then be pickled, e.g. to be sent back by a worker process.
+        """
+        msg_parser = self.__dict__.pop('msg_parser', None)
+        if msg_parser is not None:
+            msg_parser.oleMessage.close()
+
 
 class Attachment(Base):
     __tablename__ = 'attachments'
@@ -139,34 +102,755 @@ class Attachment(Base):
     short_name = Column(String)
     long_name = Column(String)
     magic = Column(String)
-    sha1 = Column(String)
+    type_mismatch = Column(Boolean)  # extension does not match the content, see MagicSniffer.mismatch
+    sha1 = Column(String, ForeignKey('attachment_content.sha1'), index=True)
     message_id = Column(Integer, ForeignKey('message.id'))
     risky = Column(Boolean)
-    risky_ext = {'.bat': '', '.bin': '',  '.cmd': '',  '.com': '',  '.cpl': '',  '.dll': '',  '.doc': '',  '.docb': '',  '.docm': '',  '.docx': '',  '.dot': '',  '.dotm': '',  '.dotx': '',  '.exe': '',  '.hta': '',  '.htm': '',  '.html': '',
-        '.jar': '',  '.msc': '',  '.msi': '',  '.msp': '',  '.mst': '',  '.pdf': '',  '.pif': '',  '.pot': '',  '.potm': '',  '.potx': '',  '.ppam': '',  '.pps': '',  '.ppsm': '',  '.ppsx': '',  '.ppt': '',  '.pptm': '',  '.pptx': '',
-        '.ps1': '',  '.ps1xml': '',  '.ps2': '',  '.ps2xml': '',  '.psc1': '',  '.psc2': '',  '.reg': '',  '.rgs': '',  '.scr': '',  '.sct': '',  '.shb': '',  '.shs': '',  '.sldm': '',  '.sldx': '',  '.vb': '',  '.vba': '',  '.vbe': '',
-        '.vbs': '',  '.vbscript': '',  '.ws': '',  '.wsh': '',  '.xla': '',  '.xlam': '',  '.xll': '',  '.xlm': '',  '.xls': '',  '.xlsb': '',  '.xlsm': '',  '.xlsx': '',  '.xlt': '',  '.xltm': '',  '.xltx': '',  '.xlw': '',  '.zip': ''
-    }
-
-    def __init__(self, attachment_obj):
-        self.short_name = attachment_obj.shortFilename
-        self.long_name = attachment_obj.longFilename
-        self.sha1 = attachment_obj.sha1
-        data = attachment_obj.data
-        self.is_risky()
-
-    def is_risky(self):
-        ext = "." + self.long_name.split(".")[-1]
-        if ext in self.risky_ext:
-            self.risky = True
-
-engine = create_engine('sqlite:///db.sqlite', echo=True)
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-session=Session()
-import glob
-for mail in glob.glob(u"mails/*.msg"):
-    msg = Message(msgFilePath=mail)
-    session.add(msg)
-session.commit()
-pass
\ No newline at end of file
+    content = relationship("AttachmentContent", backref="attachments")
+    risky_ext = AttachmentAnalysis.risky_ext
+
+    def __init__(self, attachment_obj=None, blob_store=None, inspector=None, analysis=None):
+        if analysis is None:
+            analysis = AttachmentAnalysis(attachment_obj, blob_store=blob_store, inspector=inspector)
+        self.short_name = analysis.short_name
+        self.long_name = analysis.long_name
+        self.sha1 = analysis.sha1
+        self.magic = analysis.magic
+        self.type_mismatch = analysis.type_mismatch
+        self.risky = analysis.risky
+        # Not stored on this table, see ContentRegistry and AttachmentContent.inspection
+        self.size = analysis.size
+        self.stored = analysis.stored
+        self.inspection = analysis.inspection
+
+
+class AttachmentContent(Base):
+    """Distinct attachment payloads, one row per SHA-1 whatever the number of messages carrying it"""
+    __tablename__ = 'attachment_content'
+    sha1 = Column(String, primary_key=True)
+    size = Column(Integer)
+    magic = Column(String)
+    stored = Column(Boolean)  # payload available in the BlobStore
+    first_seen = Column(DateTime)
+    inspection = Column(String)  # JSON, see AttachmentInspector
+    has_macros = Column(Boolean)
+    encrypted = Column(Boolean)
+
+
+class ContentRegistry(object):
+    """Links the attachments being persisted to their AttachmentContent row, creating it the first time a
+    payload is seen. Known hashes are remembered so each one is looked up in the database at most once.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.known = set()
+
+    def register(self, msg):
+        for attachment in msg.attachments:
+            sha1 = attachment.sha1
+            if sha1 is None or sha1 in self.known:
+                continue
+            with self.session.no_autoflush:
+                content = self.session.get(AttachmentContent, sha1)
+            if content is None:
+                attachment.content = AttachmentContent(sha1=sha1, size=attachment.size, magic=attachment.magic,
+                                                       stored=attachment.stored, first_seen=datetime.now())
+                inspection = getattr(attachment, 'inspection', None)
+                if inspection is not None:
+                    attachment.content.inspection = json.dumps(inspection, sort_keys=True)
+                    attachment.content.has_macros = inspection['macros']
+                    attachment.content.encrypted = bool(inspection['encrypted'])
+            self.known.add(sha1)
+        for nested in msg.nested_messages:
+            self.register(nested)
+
+
+# Engines of InspectionLookup by process and database URL
+_lookup_engines = {}
+
+
+class InspectionLookup(object):
+    """Inspection results stored in AttachmentContent, by SHA-1, for AttachmentInspector.Inspector.lookup.
+    Only holds the database URL, so it can be sent to worker processes: each one opens its own connections.
+    """
+    def __init__(self, url):
+        self.url = url
+
+    def __call__(self, sha1):
+        key = (os.getpid(), self.url)
+        engine = _lookup_engines.get(key)
+        if engine is None:
+            engine = _lookup_engines[key] = create_engine(self.url)
+        try:
+            with engine.connect() as connection:
+                inspection = connection.execute(
+                    select(AttachmentContent.inspection).where(AttachmentContent.sha1 == sha1)).scalar()
+        except SQLAlchemyError as e:
+            # Inspected again
+            logging.debug("Could not look up the inspection of %s: %s" % (sha1, e))
+            return None
+        return json.loads(inspection) if inspection is not None else None
+
+
+def inspection_lookup(session):
+    """InspectionLookup of the database of session, or None for an in-memory SQLite database"""
+    url = session.get_bind().url
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return None
+    return InspectionLookup(url.render_as_string(hide_password=False))
+
+
+def messages_with_attachment(session, sha1):
+    """Query of the messages carrying the attachment payload whose SHA-1 is sha1"""
+    return session.query(Message).join(Attachment).filter(Attachment.sha1 == sha1)
+
+
+class Domain(Base):
+    __tablename__ = 'domain'
+    name = Column(String, primary_key=True)
+
+
+class Url(Base):
+    """Distinct normalized URLs found in message bodies"""
+    __tablename__ = 'url'
+    url = Column(String, primary_key=True)
+    host = Column(String, ForeignKey('domain.name'), index=True)
+    domain = relationship("Domain", backref="urls")
+
+
+class MessageUrl(Base):
+    __tablename__ = 'message_url'
+    id = Column(Integer, primary_key=True)
+    message_id = Column(Integer, ForeignKey('message.id'), index=True)
+    url = Column(String, ForeignKey('url.url'), index=True)
+    target = relationship("Url", backref="links")
+
+
+class UrlRegistry(object):
+    """Creates the Url and Domain rows of the links of the messages being persisted, the first time they
+    are seen. As for ContentRegistry, known keys are remembered so each one is looked up at most once.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.known_urls = set()
+        self.known_domains = set()
+
+    def register(self, msg):
+        for link in msg.url_links:
+            if link.url in self.known_urls:
+                continue
+            with self.session.no_autoflush:
+                exists = self.session.get(Url, link.url) is not None
+            if not exists:
+                link.target = Url(url=link.url, host=self._domain(UrlExtractor.host_of(link.url)))
+            self.known_urls.add(link.url)
+        for nested in msg.nested_messages:
+            self.register(nested)
+
+    def _domain(self, name):
+        if name is not None and name not in self.known_domains:
+            with self.session.no_autoflush:
+                if self.session.get(Domain, name) is None:
+                    self.session.add(Domain(name=name))
+            self.known_domains.add(name)
+        return name
+
+
+def messages_linking_to(session, host):
+    """Query of the messages whose body links to host"""
+    return session.query(Message).join(MessageUrl).join(Url).filter(Url.host == host.lower()).distinct()
+
+
+class Campaign(Base):
+    """Near-duplicate messages, e.g. the copies of a phishing campaign, see CampaignRegistry"""
+    __tablename__ = 'campaign'
+    id = Column(Integer, primary_key=True)
+    subject = Column(Unicode)  # of the first message
+    first_seen = Column(DateTime)
+
+
+class LshBucket(Base):
+    """Band keys of the message signatures (see MinHash.band_keys), each one stored once with the first
+    message that had it: one of the messages of a campaign is enough to find the campaign.
+    """
+    __tablename__ = 'lsh_bucket'
+    key = Column(BigInteger, primary_key=True, autoincrement=False)
+    message_id = Column(Integer, ForeignKey('message.id'), index=True)
+
+
+class CampaignRegistry(object):
+    """Assigns the messages being persisted to the campaign of the most similar message sharing a band key
+    with them, or to a new campaign when none is at least threshold similar (see MinHash.similarity).
+    Matching a message costs a lookup of its MinHash.BANDS keys, whatever the number of messages stored.
+    Messages not committed yet are matched from memory.
+    The keys of messages being replaced (see release) go to the messages registered next.
+    """
+    def __init__(self, session, threshold=0.6):
+        self.session = session
+        self.threshold = threshold
+        # Band key -> (signature, Campaign or campaign id) of the messages not committed yet
+        self.pending = {}
+        self._pending_messages = []
+        # Keys stored with the messages being replaced, not claimed yet
+        self.released = set()
+
+    def register(self, msg):
+        self._register(msg)
+        # Keys of the replaced messages the new analysis does not have stay with it
+        keys = self.unclaimed()
+        if msg.minhash is not None:
+            for key in keys:
+                msg.lsh_buckets.append(LshBucket(key=key))
+
+    def _register(self, msg):
+        if msg.minhash is not None:
+            self._assign(msg)
+        for nested in msg.nested_messages:
+            self._register(nested)
+
+    def _assign(self, msg):
+        if self._pending_messages and inspect_object(self._pending_messages[0]).detached:
+            # Committed and expunged by the BulkWriter, now in the database
+            self.clear()
+        signature = MinHash.unpack(msg.minhash)
+        campaign, keys = self.match(signature)
+        if campaign is None:
+            campaign = msg.campaign = Campaign(subject=msg.subject, first_seen=datetime.now())
+        elif isinstance(campaign, Campaign):
+            msg.campaign = campaign
+        else:
+            msg.campaign_id = campaign
+        for key in keys:
+            msg.lsh_buckets.append(LshBucket(key=key))
+        self.remember(signature, keys, campaign)
+        self._pending_messages.append(msg)
+
+    def match(self, signature):
+        """Returns (campaign, keys): the campaign of the most similar message (a Campaign not committed yet or a
+        campaign id), None if no message is similar enough, and the band keys of signature that are not stored yet.
+        Only reads the database, so that it can be used with the ORM or Core (see CoreWriter).
+        """
+        keys = MinHash.band_keys(signature)
+        known = set(key for key in keys if key in self.pending)
+        candidates = [self.pending[key] for key in known]
+        lookup = [key for key in keys if key not in known]
+        if lookup:
+            with self.session.no_autoflush:
+                rows = self.session.execute(select(LshBucket.key, Message.minhash, Message.campaign_id).join(
+                    Message, LshBucket.message_id == Message.id).where(LshBucket.key.in_(lookup))).all()
+            for key, minhash, campaign_id in rows:
+                if key not in self.released:
+                    known.add(key)
+                if minhash is not None and campaign_id is not None:
+                    candidates.append((MinHash.unpack(minhash), campaign_id))
+        best = None
+        best_similarity = self.threshold
+        for other, campaign in candidates:
+            score = MinHash.similarity(signature, other)
+            if score >= best_similarity:
+                best, best_similarity = campaign, score
+        return best, [key for key in keys if key not in known]
+
+    def remember(self, signature, keys, campaign):
+        """Records the keys of a message assigned to campaign until they are committed"""
+        for key in keys:
+            self.pending[key] = (signature, campaign)
+        self.released.difference_update(keys)
+
+    def release(self, message_ids):
+        """Makes the keys stored with message_ids, about to be deleted to be replaced, count as not stored,
+        so that the messages registered next store them again instead of losing them with the deleted rows.
+        """
+        message_ids = list(message_ids)
+        for i in range(0, len(message_ids), 500):
+            self.released.update(key for key, in self.session.execute(
+                select(LshBucket.key).where(LshBucket.message_id.in_(message_ids[i:i + 500]))))
+
+    def unclaimed(self):
+        """Returns the released keys no message registered since stores, and forgets them"""
+        keys = sorted(self.released)
+        self.released = set()
+        return keys
+
+    def clear(self):
+        """Forgets the messages remembered, once committed"""
+        self.pending = {}
+        self._pending_messages = []
+
+
+def campaigns(session, min_size=2):
+    """Query of (Campaign, number of messages) of the campaigns of at least min_size messages, largest first"""
+    size = func.count(Message.id).label('size')
+    return session.query(Campaign, size).join(Message, Message.campaign_id == Campaign.id).group_by(
+        Campaign.id).having(size >= min_size).order_by(size.desc())
+
+
+class ProcessedFile(Base):
+    """Manifest of the analyzed files, lets a new run skip the files that did not change"""
+    __tablename__ = 'processed_file'
+    id = Column(Integer, primary_key=True)
+    path = Column(String, unique=True)
+    size = Column(Integer)
+    mtime = Column(Float)
+    sha1 = Column(String, index=True)
+    status = Column(String)  # 'ok', 'failed' or 'quarantined' (see MessageAnalysis.file_status)
+    error = Column(String)  # or reason of the quarantine
+    processed_at = Column(DateTime)
+    message_id = Column(Integer, ForeignKey('message.id'))
+    message = relationship("Message", backref=backref('source_file', uselist=False))
+
+
+def absolute_paths(paths):
+    """Absolute paths of paths in order, without duplicates"""
+    seen = set()
+    unique = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if path not in seen:
+            seen.add(path)
+            unique.append(path)
+    return unique
+
+
+def select_changed(paths, session, retry_failed=True, retry_quarantined=False):
+    """Filters out the files the manifest knows as already analyzed and unchanged.
+    Size and mtime are checked first, the content is only hashed when they differ,
+    a file that was merely touched gets its manifest entry updated and is skipped.
+    Failed files are analyzed again if retry_failed is set. Quarantined files would
+    exceed the same limits again, they are only analyzed again when they changed,
+    unless retry_quarantined is set.
+    Returns (absolute paths to analyze, number of skipped files)
+    """
+    known = dict((row.path, row) for row in session.query(
+        ProcessedFile.path, ProcessedFile.size, ProcessedFile.mtime, ProcessedFile.sha1, ProcessedFile.status))
+    changed = []
+    skipped = 0
+    for path in absolute_paths(paths):
+        entry = known.get(path)
+        if entry is None:
+            changed.append(path)
+            continue
+        if entry.status == QUARANTINED:
+            if retry_quarantined:
+                changed.append(path)
+                continue
+            # Otherwise skipped below unless it changed
+        elif entry.status != 'ok':
+            if retry_failed:
+                changed.append(path)
+            else:
+                skipped += 1
+            continue
+        stat = os.stat(path)
+        if stat.st_size == entry.size and stat.st_mtime == entry.mtime:
+            skipped += 1
+            continue
+        size, mtime, sha1 = file_signature(path)
+        if sha1 == entry.sha1:
+            session.query(ProcessedFile).filter_by(path=path).update({'size': size, 'mtime': mtime})
+            skipped += 1
+        else:
+            changed.append(path)
+    session.commit()
+    return changed, skipped
+
+
+class BulkWriter(object):
+    """Persists analyzed messages (with their attachments and nested messages) or manifest entries in batches.
+    Every batch is committed on its own and then expunged from the session, so memory stays flat
+    whatever the number of messages, and a crash only loses the current batch.
+    """
+    def __init__(self, session, batch_size=500):
+        self.session = session
+        self.batch_size = batch_size
+        self.pending = []
+        self.objects = 0
+        self.rows = 0
+        self.elapsed = 0.0
+
+    def add(self, obj):
+        self.pending.append(obj)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        start = time.time()
+        rows = sum(count_rows(obj) for obj in self.pending)
+        try:
+            with Instrumentation.timer('db_flush'):
+                self.session.add_all(self.pending)
+                self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        finally:
+            self.session.expunge_all()
+        self.elapsed += time.time() - start
+        Instrumentation.count('db_rows', rows)
+        self.objects += len(self.pending)
+        self.rows += rows
+        logging.info("Committed %d objects (%d rows), %.0f rows/s" % (len(self.pending), rows, self.rows_per_second))
+        self.pending = []
+
+    def close(self):
+        self.flush()
+
+    @property
+    def rows_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return self.rows / self.elapsed
+
+
+def count_rows(obj):
+    """Number of rows stored for obj: a manifest entry, or a message with its attachments and nested messages"""
+    if isinstance(obj, ProcessedFile):
+        if obj.message is None:
+            return 1
+        return 1 + count_rows(obj.message)
+    rows = 1 + len(obj.attachments) + len(obj.url_links)
+    for nested in obj.nested_messages:
+        rows += count_rows(nested)
+    return rows
+
+
+class CoreWriter(object):
+    """Persists analyzed files as persist_result and BulkWriter do, but with SQLAlchemy Core: the rows of a batch
+    are sent with one executemany INSERT per table, without ORM objects, identity map or unit of work.
+    Message ids are allocated here, from the largest one in the database, so this writer must be the only one
+    while it runs. Attachment contents, URLs and domains are inserted the first time they are seen, messages
+    are assigned to their campaign (see CampaignRegistry) and indexed for full-text search when SearchIndex is
+    installed. A modified file has its previous analysis deleted.
+    """
+    # Bound parameters per IN (...) query, below the SQLite limit
+    chunk_size = 500
+
+    def __init__(self, session, batch_size=500, campaign_registry=None):
+        self.session = session
+        self.batch_size = batch_size
+        self.campaign_registry = campaign_registry or CampaignRegistry(session)
+        self.known_contents = set()
+        self.known_urls = set()
+        self.known_domains = set()
+        self.next_message_id = (session.execute(select(func.max(Message.id))).scalar() or 0) + 1
+        self.next_campaign_id = (session.execute(select(func.max(Campaign.id))).scalar() or 0) + 1
+        self.objects = 0
+        self.rows = 0
+        self.elapsed = 0.0
+        self._reset()
+
+    def _reset(self):
+        self._files = []
+        self._messages = []
+        self._attachments = []
+        self._contents = {}
+        self._links = []
+        self._urls = {}
+        self._campaigns = []
+        self._buckets = []
+
+    def add(self, path, signature, analysis, error):
+        """Adds the result of analyze_file for path, analysis being None if it failed"""
+        entry = {'path': path, 'size': None, 'mtime': None, 'sha1': None, 'error': error,
+                 'processed_at': datetime.now(), 'message_id': None, 'status': file_status(analysis, error)}
+        if signature is not None:
+            entry['size'], entry['mtime'], entry['sha1'] = signature
+        if analysis is not None:
+            previous = self.session.execute(
+                select(ProcessedFile.message_id).where(ProcessedFile.path == path)).scalar()
+            if previous is not None:
+                # Modified file, its previous analysis is deleted by flush
+                self.campaign_registry.release(self._message_tree([previous]))
+            entry['message_id'] = self._add_message(analysis)
+            # Keys of the previous analysis the new one does not have stay with it
+            keys = self.campaign_registry.unclaimed()
+            if analysis.minhash is not None:
+                self._buckets.extend({'key': key, 'message_id': entry['message_id']} for key in keys)
+        self._files.append(entry)
+        if len(self._files) >= self.batch_size:
+            self.flush()
+
+    def _add_message(self, analysis):
+        now = datetime.now()
+        root_id = self.next_message_id
+        stack = [(analysis, None)]
+        while stack:
+            current, parent_id = stack.pop()
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            row = dict((name, getattr(current, name)) for name in Message.analysis_fields)
+            row.update(id=message_id, parent_id=parent_id, urls=json.dumps(current.urls), campaign_id=None)
+            if current.minhash is not None:
+                # Matched now, as later messages of the batch may belong to the same campaign
+                row['campaign_id'] = self._campaign(current, message_id, now)
+            self._messages.append(row)
+            for attachment in current.attachments:
+                self._attachments.append({'message_id': message_id, 'short_name': attachment.short_name,
+                                          'long_name': attachment.long_name, 'sha1': attachment.sha1,
+                                          'magic': attachment.magic, 'type_mismatch': attachment.type_mismatch,
+                                          'risky': attachment.risky})
+                if attachment.sha1 is not None and attachment.sha1 not in self.known_contents \
+                        and attachment.sha1 not in self._contents:
+                    inspection = attachment.inspection
+                    self._contents[attachment.sha1] = {
+                        'sha1': attachment.sha1, 'size': attachment.size, 'magic': attachment.magic,
+                        'stored': attachment.stored, 'first_seen': now,
+                        'inspection': json.dumps(inspection, sort_keys=True) if inspection is not None else None,
+                        'has_macros': inspection['macros'] if inspection is not None else None,
+                        'encrypted': bool(inspection['encrypted']) if inspection is not None else None}
+            for url in current.urls:
+                self._links.append({'message_id': message_id, 'url': url})
+                if url not in self.known_urls:
+                    self._urls[url] = UrlExtractor.host_of(url)
+            stack.extend((nested, message_id) for nested in reversed(current.nested))
+        return root_id
+
+    def _campaign(self, analysis, message_id, now):
+        signature = MinHash.unpack(analysis.minhash)
+        campaign, keys = self.campaign_registry.match(signature)
+        if campaign is None:
+            campaign = self.next_campaign_id
+            self.next_campaign_id += 1
+            self._campaigns.append({'id': campaign, 'subject': analysis.subject, 'first_seen': now})
+        for key in keys:
+            self._buckets.append({'key': key, 'message_id': message_id})
+        self.campaign_registry.remember(signature, keys, campaign)
+        return campaign
+
+    def _chunks(self, values):
+        values = list(values)
+        for i in range(0, len(values), self.chunk_size):
+            yield values[i:i + self.chunk_size]
+
+    def _existing(self, column, values):
+        existing = set()
+        for chunk in self._chunks(values):
+            existing.update(value for value, in self.session.execute(select(column).where(column.in_(chunk))))
+        return existing
+
+    def _insert(self, model, rows):
+        if rows:
+            self.session.execute(model.__table__.insert(), rows)
+        return len(rows)
+
+    def _message_tree(self, root_ids):
+        """Ids of the messages of root_ids and of their nested messages"""
+        ids = list(root_ids)
+        frontier = ids
+        while frontier:
+            frontier = [message_id for chunk in self._chunks(frontier) for message_id, in self.session.execute(
+                select(Message.id).where(Message.parent_id.in_(chunk)))]
+            ids.extend(frontier)
+        return ids
+
+    def _delete_messages(self, root_ids):
+        """Deletes messages with their nested messages, attachments, links and band keys"""
+        for chunk in self._chunks(self._message_tree(root_ids)):
+            for model in (Attachment, MessageUrl, LshBucket):
+                self.session.execute(delete(model.__table__).where(model.__table__.c.message_id.in_(chunk)))
+            self.session.execute(delete(Message.__table__).where(Message.__table__.c.id.in_(chunk)))
+            if self._search_index is not None:
+                self._search_index.remove(self.session.connection(), chunk)
+
+    @property
+    def _search_index(self):
+        import SearchIndex
+        return SearchIndex if SearchIndex.installed(self.session.get_bind()) else None
+
+    def flush(self):
+        if not self._files:
+            return
+        start = time.time()
+        rows = 0
+        try:
+            with Instrumentation.timer('db_flush'):
+                previous = {}
+                for chunk in self._chunks(entry['path'] for entry in self._files):
+                    for file_id, path, message_id in self.session.execute(select(
+                            ProcessedFile.id, ProcessedFile.path, ProcessedFile.message_id).where(
+                            ProcessedFile.path.in_(chunk))):
+                        previous[path] = (file_id, message_id)
+                # Modified files, their previous analysis is replaced
+                self._delete_messages(message_id for file_id, message_id in previous.values()
+                                      if message_id is not None)
+
+                contents = self._existing(AttachmentContent.sha1, self._contents)
+                rows += self._insert(AttachmentContent, [row for sha1, row in self._contents.items()
+                                                         if sha1 not in contents])
+                hosts = set(host for host in self._urls.values() if host is not None and host not in self.known_domains)
+                domains = self._existing(Domain.name, hosts)
+                rows += self._insert(Domain, [{'name': host} for host in hosts if host not in domains])
+                urls = self._existing(Url.url, self._urls)
+                rows += self._insert(Url, [{'url': url, 'host': host} for url, host in self._urls.items()
+                                           if url not in urls])
+                rows += self._insert(Campaign, self._campaigns)
+                rows += self._insert(Message, self._messages)
+                rows += self._insert(Attachment, self._attachments)
+                rows += self._insert(MessageUrl, self._links)
+                rows += self._insert(LshBucket, self._buckets)
+                new_files = [entry for entry in self._files if entry['path'] not in previous]
+                rows += self._insert(ProcessedFile, new_files)
+                # Bound parameters of an UPDATE can not be named after its columns
+                fields = ('size', 'mtime', 'sha1', 'status', 'error', 'processed_at', 'message_id')
+                updated = [dict([('file_id', previous[entry['path']][0])] +
+                                [('new_' + name, entry[name]) for name in fields])
+                           for entry in self._files if entry['path'] in previous]
+                if updated:
+                    table = ProcessedFile.__table__
+                    self.session.execute(table.update().where(table.c.id == bindparam('file_id')).values(
+                        dict((name, bindparam('new_' + name)) for name in fields)), updated)
+                    rows += len(updated)
+                if self._search_index is not None:
+                    self._search_index.add(self.session.connection(), self._index_rows())
+                self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        finally:
+            self.campaign_registry.clear()
+        self.known_contents.update(self._contents)
+        self.known_urls.update(self._urls)
+        self.known_domains.update(host for host in self._urls.values() if host is not None)
+        self.elapsed += time.time() - start
+        Instrumentation.count('db_rows', rows)
+        self.objects += len(self._files)
+        self.rows += rows
+        logging.info("Committed %d files (%d rows), %.0f rows/s" % (len(self._files), rows, self.rows_per_second))
+        self._reset()
+
+    def _index_rows(self):
+        names = {}
+        for attachment in self._attachments:
+            if attachment['long_name']:
+                names.setdefault(attachment['message_id'], []).append(attachment['long_name'])
+        return [{'id': row['id'], 'subject': row['subject'], 'body': row['body'], 'sender': row['sender'],
+                 'attachments': ' '.join(names.get(row['id'], ()))} for row in self._messages]
+
+    def close(self):
+        self.flush()
+
+    @property
+    def rows_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return self.rows / self.elapsed
+
+
+def ingest(paths, session, workers=1, chunksize=8, batch_size=500, force=False, retry_failed=True, blob_store=None,
+           header_analyzer=None, metrics=None, nested_limits=None, core=False, file_limits=None,
+           retry_quarantined=False):
+    """Analyzes every file of paths and persists the results.
+    Unless force is set, files already analyzed and unchanged since are skipped (see select_changed),
+    a modified file has its previous analysis replaced.
+    With workers > 1 the analysis runs in a pool of processes while this process stays the only writer,
+    results are consumed in input order so the database content is the same as a serial run.
+    Results are committed every batch_size files (see BulkWriter, or CoreWriter if core is set).
+    Attachment payloads are recorded once per SHA-1 (see ContentRegistry) and written to blob_store if given,
+    those already in the database are not inspected again (see InspectionLookup).
+    A file that can not be analyzed is logged, recorded as failed in the manifest and skipped.
+    When metrics (an Instrumentation.Metrics) is given, the run is instrumented and its measures added to it.
+    nested_limits bounds the analysis of nested messages (see MessageAnalysis) and file_limits the resources
+    spent on each file (see analyze_file): a file beyond them is quarantined, i.e. recorded with its reason and
+    not analyzed again until it changes or retry_quarantined is set.
+    Returns (number of messages stored, list of (path, error) for failed and quarantined files)
+    """
+    known = set(path for path, in session.query(ProcessedFile.path))
+    if force:
+        paths = absolute_paths(paths)
+        skipped = 0
+    else:
+        paths, skipped = select_changed(paths, session, retry_failed=retry_failed,
+                                        retry_quarantined=retry_quarantined)
+    instrument = metrics is not None
+    was_enabled = Instrumentation.enabled()
+    if instrument:
+        Instrumentation.enable()
+    results = analyze_files(paths, workers, chunksize, blob_store=blob_store, header_analyzer=header_analyzer,
+                            instrument=instrument, nested_limits=nested_limits, file_limits=file_limits,
+                            known_inspections=inspection_lookup(session))
+    if core:
+        writer = CoreWriter(session, batch_size=batch_size)
+    else:
+        writer = BulkWriter(session, batch_size=batch_size)
+        registry = ContentRegistry(session)
+        url_registry = UrlRegistry(session)
+        campaign_registry = CampaignRegistry(session)
+    stored = 0
+    failed = []
+    quarantined = 0
+    try:
+        with Instrumentation.use(metrics):
+            for path, signature, msg, error, record in results:
+                if record is not None:
+                    metrics.addFile(record)
+                if core:
+                    with Instrumentation.timer('registry'):
+                        writer.add(path, signature, msg, error)
+                else:
+                    with Instrumentation.timer('registry'):
+                        entry = persist_result(session, known, path, signature, msg, error, registry, url_registry,
+                                               campaign_registry)
+                    writer.add(entry)
+                if msg is None:
+                    failed.append((path, error))
+                    if file_status(msg, error) == QUARANTINED:
+                        quarantined += 1
+                else:
+                    stored += 1
+            writer.close()
+    finally:
+        Instrumentation.enable(was_enabled)
+        results.close()
+    logging.info("%d messages stored, %d failed, %d quarantined, %d unchanged files skipped"
+                 % (stored, len(failed) - quarantined, quarantined, skipped))
+    return stored, failed
+
+
+def message_tree_ids(msg):
+    """Ids of msg, a stored Message, and of its nested messages"""
+    ids = []
+    stack = [msg]
+    while stack:
+        current = stack.pop()
+        ids.append(current.id)
+        stack.extend(current.nested_messages)
+    return ids
+
+
+def persist_result(session, known, path, signature, msg, error, registry, url_registry, campaign_registry=None):
+    """Manifest entry of an analyzed file, with its message (a Message, or the MessageAnalysis returned by
+    analyze_file) linked to the known attachment contents and URLs and, if campaign_registry is given, to its
+    campaign"""
+    if isinstance(msg, MessageAnalysis):
+        msg = Message(analysis=msg)
+    entry = None
+    if path in known:
+        with session.no_autoflush:
+            entry = session.query(ProcessedFile).filter_by(path=path).first()
+    if entry is None:
+        entry = ProcessedFile(path=path)
+    elif entry.message is not None:
+        # Modified file, its previous analysis is replaced
+        if campaign_registry is not None and msg is not None:
+            campaign_registry.release(message_tree_ids(entry.message))
+        session.delete(entry.message)
+    if signature is not None:
+        entry.size, entry.mtime, entry.sha1 = signature
+    entry.processed_at = datetime.now()
+    entry.message = msg
+    entry.error = error
+    entry.status = file_status(msg, error)
+    if msg is not None:
+        registry.register(msg)
+        url_registry.register(msg)
+        if campaign_registry is not None:
+            campaign_registry.register(msg)
+    return entry
+
+
+if __name__ == "__main__":
+    import sys
+    import MsgAnalyzer
+    sys.exit(MsgAnalyzer.main(['analyze'] + sys.argv[1:]))
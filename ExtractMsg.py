@@ -29,15 +29,22 @@ __version__ = '0.2'
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import io
 import sys
-import glob
-import traceback
+import fnmatch
+import re
+import logging
+import shutil
+import struct
+import time
 import hashlib
-from email.parser import Parser as EmailParser
-import email.utils
 import olefile as OleFile
-import json
-from imapclient import  imapclient
+import Instrumentation
+import HeaderAnalyzer
+import MagicSniffer
+
+# email, zipfile and tarfile are imported when needed, they are a large part of
+# the startup time of short runs
 
 # This property information was sourced from
 # http://www.fileformat.info/format/outlookmsg/index.htm
@@ -156,7 +163,152 @@ properties = {
     '3FFC': 'To email (uncertain)',
     '403D': 'To adrtype (uncertain)',
     '403E': 'To email (uncertain)',
-    '5FF6': 'To (uncertain)'}
+    '5FF6': 'To (uncertain)',
+
+    # Fixed length properties, see PropertyTable
+    '0017': 'Importance',
+    '0026': 'Priority',
+    '0036': 'Sensitivity',
+    '0039': 'Client submit time',
+    '0E06': 'Message delivery time',
+    '0E07': 'Message flags',
+    '0E08': 'Message size',
+    '0E17': 'Message status',
+    '0E1B': 'Has attachments',
+    '0E20': 'Attachment size',
+    '0E21': 'Attachment number',
+    '3007': 'Creation time',
+    '3008': 'Last modification time',
+    '3705': 'Attachment method'}
+
+# Property types, the last 4 digits of property tags and stream names
+propertyTypes = {
+    '0002': 'Integer16',
+    '0003': 'Integer32',
+    '0004': 'Floating32',
+    '0005': 'Floating64',
+    '0006': 'Currency',
+    '0007': 'Floating time',
+    '000A': 'Error code',
+    '000B': 'Boolean',
+    '000D': 'Object',
+    '0014': 'Integer64',
+    '001E': 'String8',
+    '001F': 'String',
+    '0040': 'Time',
+    '0048': 'GUID',
+    '0102': 'Binary'}
+
+# Size of the blocks used when streaming attachment payloads
+CHUNK_SIZE = 64 * 1024
+# Default limits of the traversal of nested messages, see NestedWalk
+MAX_NESTED_DEPTH = 8
+MAX_NESTED_COUNT = 256
+MAX_NESTED_BYTES = 256 * 1024 * 1024
+# Default resources a file may use, see FileLimits
+MAX_FILE_SECONDS = 60
+MAX_FILE_BYTES = 512 * 1024 * 1024
+MAX_FILE_STREAMS = 20000
+MAX_FILE_ATTACHMENTS = 2000
+
+
+def fileTime(value):
+    """datetime (UTC) of a FILETIME, the number of 100 ns intervals since
+    1601-01-01, None for 0 and out of range values
+    """
+    import datetime
+    if not value:
+        return None
+    try:
+        return datetime.datetime(1601, 1, 1) + datetime.timedelta(microseconds=value // 10)
+    except OverflowError:
+        return None
+
+
+def floatingTime(value):
+    # Days since 1899-12-30 (OLE automation date)
+    import datetime
+    try:
+        return datetime.datetime(1899, 12, 30) + datetime.timedelta(days=value)
+    except OverflowError:
+        return None
+
+
+class PropertyTable(object):
+    """Properties of a message, attachment or recipient listed in its
+    __properties_version1.0 stream, decoded from a single read of the stream.
+    The stream holds the value of every fixed length property and the size of
+    every variable length one (stored in its own __substg1.0_ stream).
+
+        table.get('0E06')    # value, by property id (see properties)
+        table.types['0E06']  # type code, '0040' (see propertyTypes)
+        table.sizes['1000']  # size of the stream of a variable length property
+
+    headerSize depends on the object: 32 for a message, 24 for an embedded
+    message, 8 for attachments and recipients.
+    """
+    ENTRY = struct.Struct('<II8s')
+    FIXED = {
+        0x0002: struct.Struct('<h'),
+        0x0003: struct.Struct('<i'),
+        0x0004: struct.Struct('<f'),
+        0x0005: struct.Struct('<d'),
+        0x0006: struct.Struct('<q'),
+        0x0007: struct.Struct('<d'),
+        0x000A: struct.Struct('<I'),
+        0x000B: struct.Struct('<H'),
+        0x0014: struct.Struct('<q'),
+        0x0040: struct.Struct('<Q'),
+    }
+
+    def __init__(self, data, headerSize=32):
+        self.values = {}
+        self.types = {}
+        self.sizes = {}
+        self.recipientCount = None
+        self.attachmentCount = None
+        if not data:
+            return
+        if headerSize >= 24 and len(data) >= 24:
+            self.recipientCount, self.attachmentCount = struct.unpack_from('<II', data, 16)
+        end = headerSize + (len(data) - headerSize) // self.ENTRY.size * self.ENTRY.size
+        for tag, flags, raw in self.ENTRY.iter_unpack(data[headerSize:end]):
+            propId = '%04X' % (tag >> 16)
+            propType = tag & 0xFFFF
+            self.types[propId] = '%04X' % propType
+            fixed = self.FIXED.get(propType)
+            if fixed is None:
+                # Variable length or multiple values: size of the property stream
+                self.sizes[propId] = struct.unpack_from('<I', raw)[0]
+                continue
+            value = fixed.unpack_from(raw)[0]
+            if propType == 0x0040:
+                value = fileTime(value)
+            elif propType == 0x0007:
+                value = floatingTime(value)
+            elif propType == 0x0006:
+                value = value / 10000.0
+            elif propType == 0x000B:
+                value = value != 0
+            self.values[propId] = value
+
+    def get(self, propId, default=None):
+        return self.values.get(propId, default)
+
+    def __contains__(self, propId):
+        return propId in self.values or propId in self.sizes
+
+    def __len__(self):
+        return len(self.types)
+
+    def toJson(self):
+        """Values by property name (or id when it has no name)"""
+        result = {}
+        for propId, value in self.values.items():
+            if hasattr(value, 'isoformat'):
+                value = value.isoformat()
+            result[properties.get(propId, propId)] = value
+        return result
 
 
 def windowsUnicode(string):
@@ -168,6 +320,26 @@ def windowsUnicode(string):
         return unicode(string, 'utf_16_le')
 
 
+def windowsAnsi(string):
+    # 8-bit string properties are stored in the message code page,
+    # Windows-1252 for most western mailboxes
+    if string is None:
+        return None
+    if sys.version_info[0] >= 3:  # Python 3
+        return str(string, 'cp1252', 'replace')
+    else:  # Python 2
+        return string
+
+
+
+def safeFilename(name):
+    """Last component of name (attachment names can contain paths), without the
+    characters Windows does not allow in file names
+    """
+    name = name.replace('\\', '/').split('/')[-1]
+    name = re.sub(r'[\x00-\x1f<>:"|?*]', '_', name).strip(' .')
+    return name
+
 
 class Attachment:
     def __init__(self, msg, dir_):
@@ -177,55 +349,511 @@ class Attachment:
         # Get short filename
         self.shortFilename = msg._getStringStream([dir_, '__substg1.0_3704'])
 
-        # Get attachment data
-        self.data = msg._getStream([dir_, '__substg1.0_37010102'])
+        # Attachment data is only read on demand, see open()
+        self.msg = msg
+        self.dataPath = [dir_, '__substg1.0_37010102']
+
+    @property
+    def data(self):
+        # Whole attachment data, prefer open() for large attachments
+        return self.msg._getStream(self.dataPath)
+
+    @property
+    def size(self):
+        try:
+            return self.msg.oleMessage.get_size(self.msg.root_path + self.dataPath)
+        except IOError:
+            return None
+
+    @property
+    def fixedProperties(self):
+        """PropertyTable of the attachment"""
+        try:
+            return self._fixedProperties
+        except Exception:
+            with Instrumentation.timer('properties'):
+                self._fixedProperties = PropertyTable(
+                    self.msg._getStream([self.dataPath[0], '__properties_version1.0']), 8)
+            return self._fixedProperties
+
+    @property
+    def attachSize(self):
+        # Size of the whole attachment object as reported by Outlook, data and properties
+        return self.fixedProperties.get('0E20')
+
+    @property
+    def attachMethod(self):
+        # 1 for attached data, 5 for an embedded message, 6 for an OLE object
+        return self.fixedProperties.get('3705')
+
+    def open(self):
+        """Returns a read-only file object over the attachment data,
+        or None if the attachment has no data stream.
+        """
+        return self.msg._openStream(self.dataPath)
+
+    def head(self, size=MagicSniffer.SNIFF_SIZE):
+        """Returns the first size bytes of the attachment data, or None if the
+        attachment has no data stream.  Only those bytes are read from the file.
+        """
+        stream = self.open()
+        if stream is None:
+            return None
+        # Around the buffering of open(), which would read CHUNK_SIZE bytes
+        stream = getattr(stream, 'raw', stream)
+        chunks = []
+        while size > 0:
+            chunk = stream.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    @property
+    def magic(self):
+        """Type of the attachment data according to its first bytes, see MagicSniffer.sniff"""
+        try:
+            return self._magic
+        except Exception:
+            with Instrumentation.timer('sniff'):
+                self._magic = MagicSniffer.sniff(self.head())
+            return self._magic
+
+    @property
+    def typeMismatch(self):
+        """True if the extension of the attachment name does not match its content"""
+        return MagicSniffer.mismatch(self.magic, self.longFilename or self.shortFilename)
 
     @property
     def sha1(self):
         try:
             return self._sha1
         except Exception:
-            sha1 = hashlib.sha1()
-            sha1.update(self.data)
-            self._sha1 = sha1.hexdigest()
+            stream = self.open()
+            if stream is None:
+                self._sha1 = None
+                return self._sha1
+            with Instrumentation.timer('sha1'):
+                sha1 = hashlib.sha1()
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    sha1.update(chunk)
+                self._sha1 = sha1.hexdigest()
             return self._sha1
 
-    def save(self):
+    def save(self, directory=None):
+        """Writes the attachment data to a file of directory (the current
+        directory by default) named after the attachment, returns its path.
+        Only the last component of the attachment name is used.
+        """
         # Use long filename as first preference
         filename = self.longFilename
         # Otherwise use the short filename
         if filename is None:
             filename = self.shortFilename
+        if filename is not None:
+            filename = safeFilename(filename)
         # Otherwise just make something up!
-        if filename is None:
+        if not filename:
             import random
             import string
             filename = 'UnknownFilename ' + \
                 ''.join(random.choice(string.ascii_uppercase + string.digits)
                         for _ in range(5)) + ".bin"
+        if directory is not None:
+            filename = os.path.join(directory, filename)
         f = open(filename, 'wb')
-        f.write(self.data)
+        stream = self.open()
+        if stream is not None:
+            shutil.copyfileobj(stream, f, CHUNK_SIZE)
         f.close()
         return filename
 
 
-    def toJson(self):
-        return {
+    def toJson(self, hashData=False):
+        # Metadata only, the data is read (in chunks) when hashData is set
+        result = {
             'short_name': self.shortFilename,
             'long_name': self.longFilename,
+            'size': self.size,
+            'magic': self.magic,
         }
+        if hashData:
+            result['sha1'] = self.sha1
+        return result
+
+class ResourceLimitError(Exception):
+    """Raised when a file goes beyond one of its FileLimits, /limit/ naming
+    it: 'seconds', 'bytes', 'streams' or 'attachments'
+    """
+    def __init__(self, limit, message):
+        Exception.__init__(self, message)
+        self.limit = limit
+
+
+class FileLimits(object):
+    """Resources a single file may use: wall time since it was opened, bytes
+    read from its streams, directory entries (streams and storages) and
+    attachments, those of nested messages included.  The OLEMessage given
+    the limits raises ResourceLimitError as soon as one of them is exceeded,
+    before reading a stream that would exceed maxBytes, so that a corrupt or
+    hostile file costs at most these resources.  Directory entries are
+    counted from the FAT before the directory is loaded.  Time is checked
+    whenever a stream is read or attachments are listed, a stage that does
+    not read can go past it: MessageAnalysis.analyze_files also watches the
+    time from another process.  None disables a limit.
+    /exceeded/ keeps the first error raised, for callers that may have caught it.
+    """
+    def __init__(self, maxSeconds=MAX_FILE_SECONDS, maxBytes=MAX_FILE_BYTES, maxStreams=MAX_FILE_STREAMS,
+                 maxAttachments=MAX_FILE_ATTACHMENTS):
+        self.maxSeconds = maxSeconds
+        self.maxBytes = maxBytes
+        self.maxStreams = maxStreams
+        self.maxAttachments = maxAttachments
+        self.start()
+
+    def start(self):
+        self.deadline = time.monotonic() + self.maxSeconds if self.maxSeconds is not None else None
+        self.bytes = 0
+        self.attachments = 0
+        self.exceeded = None
+
+    def _exceed(self, limit, message):
+        error = ResourceLimitError(limit, message)
+        if self.exceeded is None:
+            self.exceeded = error
+        raise error
+
+    def checkTime(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self._exceed('seconds', "more than %s s spent on the file" % self.maxSeconds)
+
+    def reserve(self, size):
+        """Accounts for size bytes about to be read"""
+        self.checkTime()
+        self.bytes += size
+        if self.maxBytes is not None and self.bytes > self.maxBytes:
+            self._exceed('bytes', "more than %d bytes read from the streams of the file" % self.maxBytes)
+
+    def checkSize(self, size):
+        """Checks that a stream of size bytes can be read within maxBytes"""
+        if self.maxBytes is not None and self.bytes + size > self.maxBytes:
+            self._exceed('bytes', "stream of %d bytes, more than the %d bytes left to read from the file"
+                         % (size, self.maxBytes - self.bytes))
+
+    def checkStreams(self, count):
+        if self.maxStreams is not None and count > self.maxStreams:
+            self._exceed('streams', "%d directory entries, more than %d" % (count, self.maxStreams))
+
+    def addAttachments(self, count):
+        self.checkTime()
+        self.attachments += count
+        if self.maxAttachments is not None and self.attachments > self.maxAttachments:
+            self._exceed('attachments', "more than %d attachments" % self.maxAttachments)
+
+
+class SectorStream(io.RawIOBase):
+    """Read-only file object over a stream stored in the regular sectors of
+    an OLE file.  Sectors are read from the file when needed, following the
+    FAT chain, so the stream is never loaded in memory as a whole.
+    """
+    def __init__(self, ole, start, size, name=None):
+        io.RawIOBase.__init__(self)
+        self.ole = ole
+        self.name = name
+        self.start = start
+        self.size = size
+        self.pos = 0
+        # FAT chain position: index in the stream and sector number
+        self._index = 0
+        self._sect = start
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self.pos = offset
+        return self.pos
+
+    def _seekSector(self, index):
+        if index < self._index:
+            self._index, self._sect = 0, self.start
+        while self._index < index:
+            self._sect = self.ole.fat[self._sect]
+            self._index += 1
+            if self._sect >= len(self.ole.fat):
+                raise IOError("broken FAT chain in OLE stream")
+            if self._index >= len(self.ole.fat):
+                raise IOError("loop in the FAT chain of OLE stream")
+
+    def readinto(self, b):
+        if self.pos >= self.size:
+            return 0
+        sectorSize = self.ole.sectorsize
+        self._seekSector(self.pos // sectorSize)
+        offset = self.pos % sectorSize
+        wanted = min(len(b), self.size - self.pos)
+        # Read runs of contiguous sectors with a single call
+        first = self._sect
+        available = sectorSize - offset
+        while available < wanted and self.ole.fat[self._sect] == self._sect + 1:
+            self._sect += 1
+            self._index += 1
+            available += sectorSize
+        count = min(wanted, available)
+        if self.ole.limits is not None:
+            self.ole.limits.reserve(count)
+        self.ole.fp.seek(sectorSize * (first + 1) + offset)
+        data = self.ole.fp.read(count)
+        n = len(data)
+        b[:n] = data
+        self.pos += n
+        Instrumentation.addBytes(self.name, n)
+        return n
+
+
+class DirectoryNode(object):
+    """Node of a DirectoryIndex: an OLE directory entry and its children,
+    indexed by lower-cased name (OLE names are case-insensitive).
+    """
+    __slots__ = ('name', 'entry', 'kids')
+
+    def __init__(self, entry):
+        self.name = entry.name
+        self.entry = entry
+        self.kids = {}
+
+    @property
+    def isStream(self):
+        return self.entry.entry_type == OleFile.STGTY_STREAM
+
+    def kid(self, name):
+        return self.kids.get(name.lower())
+
+
+class DirectoryIndex(object):
+    """Prefix tree of the storages and streams of an OLE file, built with a
+    single walk of its directory.  Lookups cost one dict access per path
+    component, and listing a storage only visits that storage.
+    """
+    def __init__(self, rootEntry):
+        self.root = DirectoryNode(rootEntry)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for entry in node.entry.kids:
+                kid = DirectoryNode(entry)
+                node.kids[entry.name.lower()] = kid
+                stack.append(kid)
+
+    def find(self, path):
+        """Returns the node at path (list of names or slash separated string), or None"""
+        if not isinstance(path, list):
+            path = path.split('/')
+        node = self.root
+        for name in path:
+            node = node.kids.get(name.lower())
+            if node is None:
+                return None
+        return node
+
+    def exists(self, path):
+        return self.find(path) is not None
+
+    def listdir(self, path=[]):
+        """Lists the streams stored under path, in the same form as OleFileIO.listdir()"""
+        node = self.find(path)
+        if node is None:
+            return []
+        files = []
+        stack = [(list(path), node)]
+        while stack:
+            prefix, node = stack.pop()
+            for kid in node.kids.values():
+                if kid.isStream:
+                    files.append(prefix + [kid.name])
+                else:
+                    stack.append((prefix + [kid.name], kid))
+        files.sort()
+        return files
+
+
+class MemoryFile(io.RawIOBase):
+    """Seekable read-only file object over a buffer (bytearray, memoryview...).
+    The buffer is not copied, only the parts being read are.
+    """
+    def __init__(self, buffer):
+        io.RawIOBase.__init__(self)
+        self.view = memoryview(buffer).cast('B')
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self.pos = offset
+        return self.pos
+
+    def readinto(self, b):
+        n = min(len(b), len(self.view) - self.pos)
+        if n <= 0:
+            return 0
+        b[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+def openSource(source):
+    """Turns a message source into something OleFileIO can read without
+    copying it when possible: a path, the content of a file as bytes,
+    bytearray, memoryview or mmap, or a file object.  A file object that can
+    not seek is read into memory.
+    Returns (object for OleFileIO, True if it was created here and must be closed)
+    """
+    if isinstance(source, bytes):
+        if source[:8] == OleFile.MAGIC or len(source) >= OleFile.MINIMAL_OLEFILE_SIZE or b'\0' in source:
+            # BytesIO shares the bytes until written to
+            return io.BytesIO(source), True
+        # Path
+        return source, False
+    if isinstance(source, (bytearray, memoryview)):
+        return MemoryFile(source), True
+    if hasattr(source, 'read'):
+        # File objects and mmap
+        if hasattr(source, 'seekable') and not source.seekable():
+            return io.BytesIO(source.read()), True
+        return source, False
+    return source, False
+
+
+def _streamName(filename):
+    # Last component of a stream path, list or slash separated
+    if isinstance(filename, list):
+        return filename[-1]
+    return filename.rsplit('/', 1)[-1]
+
 
 class OLEMessage(OleFile.OleFileIO):
-    def __init__(self, filename):
-        OleFile.OleFileIO.__init__(self, filename)
+    def __init__(self, filename, limits=None):
+        """filename is any source accepted by openSource, limits a FileLimits
+        (None for no limits)
+        """
+        self.limits = limits
+        if limits is not None:
+            limits.start()
+        with Instrumentation.timer('ole_open'):
+            fileObj, self._ownsSource = openSource(filename)
+            try:
+                OleFile.OleFileIO.__init__(self, fileObj)
+            except Exception:
+                if self._ownsSource:
+                    fileObj.close()
+                raise
+        if limits is not None:
+            try:
+                limits.checkTime()
+            except ResourceLimitError:
+                self.close()
+                raise
+
+    def loaddirectory(self, sect):
+        # Called by OleFileIO.__init__ once the FAT is loaded: the whole
+        # directory stream is read and its tree built, unless the number of
+        # entries of its chain is beyond the limits
+        if self.limits is not None and self.limits.maxStreams is not None:
+            perSector = self.sectorsize // 128
+            # Enough to exceed the limit, a looping chain stops there
+            maxSectors = self.limits.maxStreams // perSector + 1
+            sectors = 0
+            sector = sect
+            while 0 <= sector < len(self.fat) and sectors < maxSectors:
+                sectors += 1
+                sector = self.fat[sector]
+            self.limits.checkStreams(sectors * perSector)
+        OleFile.OleFileIO.loaddirectory(self, sect)
+
+    def close(self):
+        OleFile.OleFileIO.close(self)
+        if self._ownsSource:
+            self.fp.close()
+
+    @property
+    def index(self):
+        try:
+            return self._index
+        except Exception:
+            with Instrumentation.timer('ole_index'):
+                self._index = DirectoryIndex(self.root)
+            return self._index
+
+    def _find(self, filename):
+        # Same as OleFileIO._find, but using the directory index instead of
+        # scanning the children of every storage along the path
+        node = self.index.find(filename)
+        if node is None:
+            raise IOError("file not found")
+        return node.entry.sid
+
+    def exists(self, filename):
+        return self.index.exists(filename)
 
     def getStream(self, filename):
         if self.exists(filename):
-            stream = self.openstream(filename)
-            return stream.read()
+            if self.limits is not None:
+                self.limits.reserve(self.get_size(filename))
+            data = self.openstream(filename).read()
+            Instrumentation.addBytes(_streamName(filename), len(data))
+            return data
         else:
             return None
 
+    def openStream(self, filename):
+        """Opens the requested filename as a read-only file object, or returns
+        None if it does not exist.  Streams stored in regular sectors are read
+        on demand (see SectorStream), small ones live in the ministream.
+        """
+        if not self.exists(filename):
+            return None
+        entry = self.direntries[self._find(filename)]
+        if entry.entry_type != OleFile.STGTY_STREAM:
+            raise IOError("%s is not a stream" % filename)
+        name = _streamName(filename)
+        if self.limits is not None:
+            self.limits.checkSize(entry.size)
+        if entry.size < self.minisectorcutoff:
+            # Read at once by olefile
+            if self.limits is not None:
+                self.limits.reserve(entry.size)
+            Instrumentation.addBytes(name, entry.size)
+            return self.openstream(filename)
+        if entry.size > self._filesize:
+            raise IOError("%s is larger than the file" % name)
+        return io.BufferedReader(SectorStream(self, entry.isectStart, entry.size, name), CHUNK_SIZE)
+
     def getStringStream(self, filename, prefer='unicode'):
         """Gets a string representation of the requested filename.
         Checks for both ASCII and Unicode representations and returns
@@ -238,31 +866,67 @@ class OLEMessage(OleFile.OleFileIO):
             # Join with slashes to make it easier to append the type
             filename = "/".join(filename)
 
-        asciiVersion = self.getStream(filename + '001E')
-        unicodeVersion = windowsUnicode(self.getStream(filename + '001F'))
-        if asciiVersion is None:
-            return unicodeVersion
-        elif unicodeVersion is None:
-            return asciiVersion
+        # Only the version that is returned is read
+        hasAscii = self.exists(filename + '001E')
+        hasUnicode = self.exists(filename + '001F')
+        if hasUnicode and (prefer == 'unicode' or not hasAscii):
+            return windowsUnicode(self.getStream(filename + '001F'))
+        elif hasAscii:
+            return windowsAnsi(self.getStream(filename + '001E'))
         else:
-            if prefer == 'unicode':
-                return unicodeVersion
-            else:
-                return asciiVersion
+            return None
 
 class Message():
-    def __init__(self, msgFilePath = None, oleMessage = None,root_path=[]):
+    # msgFilePath can also be the content of the file, or a file object (see openSource)
+    # limits (a FileLimits) only applies to a file opened from msgFilePath
+    def __init__(self, msgFilePath = None, oleMessage = None,root_path=[], snapshot=False, limits=None):
         if msgFilePath is None and oleMessage is None:
             raise Exception("No message specified")
         if (not msgFilePath is None) and (not oleMessage is None):
             raise Exception("Use either a file path or OLEMessage object")
         self.root_path = root_path
         if msgFilePath is not None:
-            self.oleMessage = OLEMessage(msgFilePath)
+            self.oleMessage = OLEMessage(msgFilePath, limits)
         else:
             self.oleMessage = oleMessage
+        self._snapshot = None
+        if snapshot:
+            self.snapshot()
+
+    def snapshot(self, prefer='unicode'):
+        """Reads all the string properties of the message in one pass and
+        keeps them, so that subject, body, header, sender, to and cc never go
+        back to the OLE file.  As with getStringStream, only the /prefer/
+        encoding is read and decoded when a property has both versions.
+        Nested messages found in attachments inherit the snapshot mode.
+        """
+        with Instrumentation.timer('properties'):
+            kinds = {}
+            for name, kid in self.oleMessage.index.find(self.root_path).kids.items():
+                if kid.isStream and len(name) == 20 and name.startswith('__substg1.0_'):
+                    propType = name[16:].upper()
+                    if propType in ('001E', '001F'):
+                        kinds.setdefault(name[12:16].upper(), {})[propType] = kid.entry
+            values = {}
+            limits = self.oleMessage.limits
+            for propId, entries in kinds.items():
+                if '001F' in entries and (prefer == 'unicode' or '001E' not in entries):
+                    entry = entries['001F']
+                    if limits is not None:
+                        limits.reserve(entry.size)
+                    values[propId] = windowsUnicode(self.oleMessage._open(entry.isectStart, entry.size).read())
+                else:
+                    entry = entries['001E']
+                    if limits is not None:
+                        limits.reserve(entry.size)
+                    values[propId] = windowsAnsi(self.oleMessage._open(entry.isectStart, entry.size).read())
+                Instrumentation.addBytes(entry.name, entry.size)
+            self._snapshot = values
 
     def _getStringStream(self, streamPath):
+        if self._snapshot is not None and type(streamPath) is not list:
+            # '__substg1.0_XXXX', XXXX being the property id
+            return self._snapshot.get(streamPath[12:16].upper())
         if type(streamPath) is list:
             return self.oleMessage.getStringStream(self.root_path + streamPath)
         else:
@@ -274,16 +938,14 @@ class Message():
         else:
             return self.oleMessage.getStream(self.root_path + [streamPath])
 
-    def _listDir(self):
+    def _openStream(self, streamPath):
+        if type(streamPath) is list:
+            return self.oleMessage.openStream(self.root_path + streamPath)
+        else:
+            return self.oleMessage.openStream(self.root_path + [streamPath])
 
-        files = self.oleMessage.listdir()
-        rootPath_ = '/'.join(self.root_path)
-        inRootPath = []
-        for f in files:
-            f_ = '/'.join(f)
-            if f_.startswith(rootPath_):
-                inRootPath.append(f)
-        return inRootPath
+    def _listDir(self):
+        return self.oleMessage.index.listdir(self.root_path)
 
     @property
     def subject(self):
@@ -294,38 +956,86 @@ class Message():
         try:
             return self._header
         except Exception:
-            headerText = self._getStringStream('__substg1.0_007D')
+            headerText = self.headerStr
             if headerText is not None:
-                self._header = EmailParser().parsestr(headerText)
+                from email.parser import Parser as EmailParser
+                with Instrumentation.timer('email_parser'):
+                    self._header = EmailParser().parsestr(headerText, headersonly=True)
                 #self._header = headerText
             else:
                 self._header = None
             return self._header
 
+    def headerField(self, name):
+        """Value of the first field of the header called name (e.g. 'From'),
+        as the header parser gives it, or None.  A substring search, the
+        header is not parsed.
+        """
+        headerText = self.headerStr
+        if headerText is None:
+            return None
+        with Instrumentation.timer('header_fields'):
+            return HeaderAnalyzer.firstField(headerText, name)
+
     @property
     def headerStr(self):
         try:
             return self._headeStr
         except Exception:
-            headerText = self._getStringStream('__substg1.0_007D')
-            if headerText is not None:
-                self._headeStr = headerText
-                #self._header = headerText
-            else:
-                self._headeStr = None
+            self._headeStr = self._getStringStream('__substg1.0_007D')
             return self._headeStr
 
     @property
     def date(self):
         # Get the message's header and extract the date
-        if self.header is None:
-            return None
-        else:
-            return self.header['date']
+        return self.headerField('Date')
 
     @property
     def parsedDate(self):
-        return email.utils.parsedate(self.date)
+        """Date of the message as a 9-tuple (see email.utils.parsedate), from
+        the Date header or, for messages without one such as sent items, from
+        the submit or delivery time (UTC).  None when none of them is known.
+        """
+        date = self.date
+        if date is not None:
+            import email.utils
+            parsed = email.utils.parsedate(date)
+            if parsed is not None:
+                return parsed
+        time = self.submitTime or self.deliveryTime
+        if time is None:
+            return None
+        return time.timetuple()[:6] + (0, 1, -1)
+
+    @property
+    def fixedProperties(self):
+        """PropertyTable of the message"""
+        try:
+            return self._fixedProperties
+        except Exception:
+            with Instrumentation.timer('properties'):
+                self._fixedProperties = PropertyTable(self._getStream('__properties_version1.0'),
+                                                      24 if self.root_path else 32)
+            return self._fixedProperties
+
+    @property
+    def submitTime(self):
+        # PR_CLIENT_SUBMIT_TIME, datetime (UTC)
+        return self.fixedProperties.get('0039')
+
+    @property
+    def deliveryTime(self):
+        # PR_MESSAGE_DELIVERY_TIME, datetime (UTC)
+        return self.fixedProperties.get('0E06')
+
+    @property
+    def messageFlags(self):
+        # PR_MESSAGE_FLAGS: 0x01 read, 0x08 unsent, 0x10 has attachments...
+        return self.fixedProperties.get('0E07')
+
+    @property
+    def messageSize(self):
+        return self.fixedProperties.get('0E08')
 
     @property
     def sender(self):
@@ -333,11 +1043,10 @@ class Message():
             return self._sender
         except Exception:
             # Check header first
-            if self.header is not None:
-                headerResult = self.header["from"]
-                if headerResult is not None:
-                    self._sender = headerResult
-                    return headerResult
+            headerResult = self.headerField('From')
+            if headerResult is not None:
+                self._sender = headerResult
+                return headerResult
 
             # Extract from other fields
             text = self._getStringStream('__substg1.0_0C1A')
@@ -359,11 +1068,10 @@ class Message():
             return self._to
         except Exception:
             # Check header first
-            if self.header is not None:
-                headerResult = self.header["to"]
-                if headerResult is not None:
-                    self._to = headerResult
-                    return headerResult
+            headerResult = self.headerField('To')
+            if headerResult is not None:
+                self._to = headerResult
+                return headerResult
 
             # Extract from other fields
             # TODO: This should really extract data from the recip folders,
@@ -378,11 +1086,10 @@ class Message():
             return self._cc
         except Exception:
             # Check header first
-            if self.header is not None:
-                headerResult = self.header["cc"]
-                if headerResult is not None:
-                    self._cc = headerResult
-                    return headerResult
+            headerResult = self.headerField('Cc')
+            if headerResult is not None:
+                self._cc = headerResult
+                return headerResult
 
             # Extract from other fields
             # TODO: This should really extract data from the recip folders,
@@ -398,56 +1105,291 @@ class Message():
 
     @property
     def attachments(self):
-        self._attachments = []
-        attachmentDirs = []
-        for dir_ in self._listDir():
-            idx = len(self.root_path)
-            if dir_[idx + 0].startswith('__attach') and dir_[idx + 0] not in attachmentDirs:
-                if dir_[idx + 1] == '__substg1.0_37010102':
+        try:
+            return self._attachments
+        except Exception:
+            attachments = []
+            node = self.oleMessage.index.find(self.root_path)
+            names = sorted(name for name in node.kids if name.startswith('__attach'))
+            if self.oleMessage.limits is not None:
+                self.oleMessage.limits.addAttachments(len(names))
+            for name in names:
+                kid = node.kids[name]
+                if kid.kid('__substg1.0_37010102') is not None:
                     # Attached file
-                    attachmentDirs.append(dir_[idx + 0])
-                    self._attachments.append(Attachment(self, dir_[idx + 0]))
-                elif dir_[idx + 1] == "__substg1.0_3701000D":
+                    attachments.append(Attachment(self, kid.name))
+                elif kid.kid('__substg1.0_3701000D') is not None:
                     # Nested msg
-                    attachmentDirs.append(dir_[idx + 0])
-                    self._attachments.append(Message(oleMessage=self.oleMessage, root_path=dir_[idx + 0:idx + 2]))
+                    nested = kid.kid('__substg1.0_3701000D')
+                    attachments.append(Message(oleMessage=self.oleMessage,
+                                               root_path=self.root_path + [kid.name, nested.name],
+                                               snapshot=self._snapshot is not None))
+            self._attachments = attachments
+            return self._attachments
 
-                    #Message()
-        return self._attachments
-
-    def toJson(self):
+    def toJson(self, includeBody=True, maxBody=None, hashAttachments=False, nested=True, decodeUtf7=False):
+        """Returns the message as a dict that can be serialized to JSON.
+        The body is left out unless includeBody is set, and truncated to maxBody
+        characters if given.  Attachments are described by their names and size,
+        and SHA-1 if hashAttachments is set.  Nested messages are included in
+        'nested' when /nested/ is set, otherwise only counted.
+        decodeUtf7 decodes the body as modified UTF-7 (IMAP), which requires imapclient.
+        """
         def xstr(s):
             return '' if s is None else str(s)
 
-        attachmentNames = []
-        # Save the attachments
-      #  for attachment in self.attachments:
-       #     attachmentNames.append(attachment.save())
-
-
-        attachmentsJson = [a.toJson() for a in self.attachments]
-        self.body = imapclient.decode_utf7(self.body)
+        attachments = []
+        nestedMessages = []
+        for attachment in self.attachments:
+            if isinstance(attachment, Message):
+                nestedMessages.append(attachment)
+            else:
+                attachments.append(attachment.toJson(hashData=hashAttachments))
 
         emailObj = {
                 'from': xstr(self.sender),
                 'to': xstr(self.to),
                 'cc': xstr(self.cc),
                 'subject': xstr(self.subject),
-                'date': xstr(self.date),
-                'attachments': attachmentNames,
-                'body': self.body,
                 'date': self.parsedDate,
-                'attachments': attachmentsJson,
+                'attachments': attachments,
                 'header': self.headerStr
         }
+        if includeBody:
+            body = self.body
+            if body is not None and decodeUtf7:
+                from imapclient import imapclient
+                body = imapclient.decode_utf7(body)
+            if body is not None and maxBody is not None and len(body) > maxBody:
+                body = body[:maxBody]
+                emailObj['body_truncated'] = True
+            emailObj['body'] = body
+        if not nested:
+            emailObj['nested_count'] = len(nestedMessages)
+            return emailObj
+        emailObj['nested'] = []
+        objects = {id(self): emailObj}
+        walk = NestedWalk(self)
+        for message, parent, depth in walk:
+            if depth == 0:
+                continue
+            obj = message.toJson(includeBody, maxBody, hashAttachments, False, decodeUtf7)
+            del obj['nested_count']
+            obj['nested'] = []
+            objects[id(parent)]['nested'].append(obj)
+            objects[id(message)] = obj
+        if walk.limits:
+            emailObj['nested_limits'] = walk.limits
         return emailObj
 
+    def save(self, directory='.'):
+        """Writes the message to a new folder of directory named after its date
+        and subject ("2013-07-24_0915 Subject"), holding message.text (headers
+        and body) and the attachments.  Nested messages are saved the same way
+        in the folder of the message they are attached to.  Returns the path of
+        the folder.
+        """
+        def xstr(s):
+            return '' if s is None else str(s)
+
+        folders = {}
+        for message, parent, depth in NestedWalk(self):
+            parentFolder = directory if parent is None else folders[id(parent)]
+            folder = message._saveFolder(parentFolder)
+            folders[id(message)] = folder
+            with io.open(os.path.join(folder, 'message.text'), 'w', encoding='utf-8') as f:
+                f.write('From: %s\n' % xstr(message.sender))
+                f.write('To: %s\n' % xstr(message.to))
+                f.write('CC: %s\n' % xstr(message.cc))
+                f.write('Subject: %s\n' % xstr(message.subject))
+                f.write('Date: %s\n' % xstr(message.date))
+                f.write('-----------------\n\n')
+                f.write(xstr(message.body))
+            for attachment in message.attachments:
+                if not isinstance(attachment, Message):
+                    attachment.save(folder)
+        return folders[id(self)]
+
+    def _saveFolder(self, directory):
+        date = self.parsedDate
+        if date is not None:
+            name = '%04d-%02d-%02d_%02d%02d' % date[:5]
+        else:
+            name = 'UnknownDate'
+        subject = safeFilename(self.subject or '')
+        if subject:
+            name = '%s %s' % (name, subject[:100].strip(' .'))
+        path = os.path.join(directory, name)
+        suffix = 1
+        while os.path.exists(path):
+            suffix += 1
+            path = os.path.join(directory, '%s (%d)' % (name, suffix))
+        os.makedirs(path)
+        return path
+
+
+class NestedWalk(object):
+    """Iterates over a message and the messages nested in its attachments,
+    depth first, yielding (message, parent message, depth), the message itself
+    first with depth 0 and parent None.  Messages are created as they are
+    reached and the walk is not recursive, so its cost is linear in the number
+    of messages whatever their nesting.  Nested messages beyond maxDepth, or
+    whose streams would take the total beyond maxBytes, are skipped, and the
+    walk stops after maxCount nested messages. The limits that were reached
+    are listed in /limits/ ('depth', 'bytes', 'count').
+    """
+    def __init__(self, message, maxDepth=MAX_NESTED_DEPTH, maxCount=MAX_NESTED_COUNT, maxBytes=MAX_NESTED_BYTES):
+        self.message = message
+        self.maxDepth = maxDepth
+        self.maxCount = maxCount
+        self.maxBytes = maxBytes
+        self.limits = []
+        self.count = 0
+        self.bytes = 0
+
+    def _limit(self, name):
+        if name not in self.limits:
+            self.limits.append(name)
+
+    @staticmethod
+    def ownBytes(message):
+        """Size of the streams of message, those of its nested messages excepted"""
+        node = message.oleMessage.index.find(message.root_path)
+        total = 0
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for name, kid in node.kids.items():
+                if kid.isStream:
+                    total += kid.entry.size
+                elif name != '__substg1.0_3701000d':
+                    stack.append(kid)
+        return total
+
+    @staticmethod
+    def _nested(message):
+        return iter([a for a in message.attachments if isinstance(a, Message)])
+
+    def __iter__(self):
+        self.bytes = self.ownBytes(self.message)
+        yield self.message, None, 0
+        # One iterator over the nested messages of each level being visited
+        stack = [(self._nested(self.message), self.message, 1)]
+        while stack:
+            nested, parent, depth = stack[-1]
+            message = next(nested, None)
+            if message is None:
+                stack.pop()
+                continue
+            if depth > self.maxDepth:
+                self._limit('depth')
+                stack.pop()
+                continue
+            if self.count >= self.maxCount:
+                self._limit('count')
+                return
+            size = self.ownBytes(message)
+            if self.bytes + size > self.maxBytes:
+                self._limit('bytes')
+                continue
+            self.bytes += size
+            self.count += 1
+            yield message, parent, depth
+            stack.append((self._nested(message), message, depth + 1))
+
+
+def iterArchive(archive, pattern='*.msg', snapshot=False):
+    """Yields (member name, Message) for the members of a zip or tar archive
+    (path or file object) whose name matches pattern, without extracting
+    them to disk.  Members of a zip or compressed tar are read in memory one
+    at a time, those of an uncompressed tar are read in place.  Members that
+    are not valid .msg files are logged and skipped.
+    The messages can be used until the iteration is over.
+    """
+    import tarfile
+    import zipfile
+    if zipfile.is_zipfile(archive):
+        if hasattr(archive, 'seek'):
+            archive.seek(0)
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if info.filename.endswith('/') or not fnmatch.fnmatch(info.filename.lower(), pattern):
+                    continue
+                message = _archiveMessage(info.filename, lambda: io.BytesIO(zf.read(info)), snapshot)
+                if message is not None:
+                    yield info.filename, message
+        return
+
+    if hasattr(archive, 'seek'):
+        archive.seek(0)
+    if isinstance(archive, (str, bytes)):
+        tf = tarfile.open(archive, 'r:*')
+    else:
+        tf = tarfile.open(fileobj=archive, mode='r:*')
+    # Seeking in a decompressed stream means decompressing it again
+    inPlace = tf.fileobj.__class__.__module__ not in ('gzip', 'bz2', 'lzma')
+    try:
+        for info in tf:
+            if not info.isfile() or not fnmatch.fnmatch(info.name.lower(), pattern):
+                continue
+            if inPlace:
+                source = lambda: tf.extractfile(info)
+            else:
+                source = lambda: io.BytesIO(tf.extractfile(info).read())
+            message = _archiveMessage(info.name, source, snapshot)
+            if message is not None:
+                yield info.name, message
+    finally:
+        tf.close()
+
+
+def iterMessages(source, pattern='*.msg', snapshot=False):
+    """Yields (name, Message) for source: every file matching pattern under a
+    directory (walked in sorted order), the members of a zip or tar archive
+    (see iterArchive) or a single .msg file.  Each message is closed when the
+    next one is requested, so only one is open at a time.
+    """
+    import tarfile
+    import zipfile
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if not fnmatch.fnmatch(name.lower(), pattern):
+                    continue
+                path = os.path.join(root, name)
+                message = _archiveMessage(path, lambda: path, snapshot)
+                if message is not None:
+                    try:
+                        yield path, message
+                    finally:
+                        message.oleMessage.close()
+        return
+    with open(source, 'rb') as f:
+        # A message ending with a zip attachment would pass for a zip archive
+        isMessage = f.read(len(OleFile.MAGIC)) == OleFile.MAGIC
+    if not isMessage and (zipfile.is_zipfile(source) or tarfile.is_tarfile(source)):
+        for name, message in iterArchive(source, pattern, snapshot):
+            try:
+                yield source + '!' + name, message
+            finally:
+                message.oleMessage.close()
+        return
+    message = Message(msgFilePath=source, snapshot=snapshot)
+    try:
+        yield source, message
+    finally:
+        message.oleMessage.close()
+
+
+def _archiveMessage(name, source, snapshot):
+    try:
+        return Message(msgFilePath=source(), snapshot=snapshot)
+    except Exception:
+        logging.warning("Skipping %s, not a valid .msg file" % name, exc_info=True)
+        return None
+
 
 if __name__ == "__main__":
-    olemsg = OLEMessage(r"D:\LocalData\a189493\Desktop\Docs\code\msg\msg-extractor-master\Message suspect.msg")
-    msg = Message(oleMessage=olemsg)
-    #msg = Message(r"D:\LocalData\a189493\Desktop\Docs\code\msg\msg-extractor-master\Message suspect.msg")
-    print msg.subject
-    print msg.toJson()
-    #print msg.attachments
-    #msg.save()
\ No newline at end of file
+    import MsgAnalyzer
+    sys.exit(MsgAnalyzer.main(['extract'] + sys.argv[1:]))
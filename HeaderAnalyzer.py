@@ -0,0 +1,141 @@
+"""
+HeaderAnalyzer:
+    Single pass analysis of the transport headers of a message
+
+Scoring only needs the Received-SPF fields added by the internal mail servers,
+which also carry the envelope-from="..." and x-sender="..." parameters.  They
+are located with a single substring search over the header, and compiled
+patterns only run on their values.  From and the Received chain are extracted
+the same way the first time they are asked for.
+"""
+
+import re
+
+DEFAULT_INTERNAL_DOMAIN = 'MYDOMAIN.fr'
+
+_FOLDING = re.compile(r'\r?\n[ \t]+')
+_SPF_SENDER = re.compile(r'\S*?@[^) ]*')
+_PARAMS = re.compile(r'(envelope-from|x-sender)="([^"]*)"')
+
+
+def _fieldEnd(header, start):
+    # A field ends at the first line break not followed by whitespace (folding)
+    end = header.find('\n', start)
+    while end != -1 and header[end + 1:end + 2] in (' ', '\t'):
+        end = header.find('\n', end + 1)
+    if end == -1:
+        return len(header)
+    return end
+
+
+def fieldValues(header, name):
+    """Yields the raw value of every field of header called /name/, which
+    must be spelled as in the header (e.g. 'Received-SPF').
+    """
+    key = '\n' + name + ':'
+    if header.startswith(key[1:]):
+        # As if the line break of key preceded the header
+        pos = -1
+    else:
+        pos = header.find(key)
+        if pos == -1:
+            return
+    while True:
+        start = pos + len(key)
+        end = _fieldEnd(header, start)
+        yield header[start:end]
+        pos = header.find(key, end)
+        if pos == -1:
+            return
+
+
+def firstField(header, name):
+    """Returns the raw value of the first field of header called /name/ in
+    any case (e.g. 'CC' for 'Cc'), without its leading whitespace and line
+    break, or None.  The usual spelling is looked up first.
+    """
+    for value in fieldValues(header, name):
+        break
+    else:
+        match = re.search(r'(?:^|\n)%s:' % re.escape(name), header, re.IGNORECASE)
+        if match is None:
+            return None
+        value = header[match.end():_fieldEnd(header, match.end())]
+    return value.lstrip(' \t').rstrip('\r\n')
+
+
+def unfold(value):
+    return _FOLDING.sub(' ', value).strip()
+
+
+class HeaderAnalysis(object):
+    def __init__(self, header=None):
+        self._header = header
+        # (verdict, comment) of the Received-SPF fields added by the internal domain
+        self.spf = []
+        # True if the header has any Received-SPF field
+        self.has_spf = False
+        self.spf_senders = []
+        self.envelope_from = []
+        self.x_sender = []
+
+    @property
+    def spf_pass(self):
+        return any(verdict.lower() == 'pass' for verdict, comment in self.spf)
+
+    @property
+    def from_(self):
+        """First From field, unfolded"""
+        try:
+            return self._from
+        except AttributeError:
+            self._from = None
+            for value in fieldValues(self._header or '', 'From'):
+                self._from = unfold(value)
+                break
+            return self._from
+
+    @property
+    def received(self):
+        """Unfolded Received fields, most recent first"""
+        try:
+            return self._received
+        except AttributeError:
+            self._received = [unfold(value) for value in fieldValues(self._header or '', 'Received')]
+            return self._received
+
+
+class HeaderAnalyzer(object):
+    """Extracts the Received-SPF verdicts given by the servers of internal_domain with the
+    envelope-from and x-sender they report, From and the Received chain of a header.
+    Instances only hold compiled patterns and can be shared.
+    """
+    def __init__(self, internal_domain=DEFAULT_INTERNAL_DOMAIN):
+        self.internal_domain = internal_domain
+        # Verdict, then a comment from a host of the internal domain: "Pass (mx.domain: ...)"
+        self._spf = re.compile(r'\s*(\w+)\s+(\([^()]*?\.%s: [^()]*\))' % re.escape(internal_domain), re.IGNORECASE)
+
+    def analyze(self, header):
+        analysis = HeaderAnalysis(header)
+        if not header:
+            return analysis
+        spf_senders = set()
+        envelope_from = set()
+        x_sender = set()
+        for value in fieldValues(header, 'Received-SPF'):
+            analysis.has_spf = True
+            spf = self._spf.match(value)
+            if spf is not None:
+                verdict, comment = spf.group(1), unfold(spf.group(2))
+                analysis.spf.append((verdict, comment))
+                if verdict.lower() in ('pass', 'none'):
+                    spf_senders.update(_SPF_SENDER.findall(comment))
+            for param, param_value in _PARAMS.findall(value):
+                if param == 'envelope-from':
+                    envelope_from.add(param_value)
+                else:
+                    x_sender.add(param_value)
+        analysis.spf_senders = list(spf_senders)
+        analysis.envelope_from = list(envelope_from)
+        analysis.x_sender = list(x_sender)
+        return analysis
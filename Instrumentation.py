@@ -0,0 +1,242 @@
+"""
+Instrumentation:
+    Per stage timers and counters of analysis runs
+
+Disabled by default, in which case timer(), count() and addBytes() return
+after a single test of a module global.  Once enable() is called, the
+measures of every file are collected in a FileMetrics (see collect()) that
+can be sent back from a worker process and added to the Metrics of the run:
+
+    Instrumentation.enable()
+    with Instrumentation.collect(path) as record:
+        with Instrumentation.timer('ole_open'):
+            ...
+    metrics.addFile(record)
+
+use(metrics) makes a Metrics collect for the current thread directly, e.g.
+for the stages of a run that do not belong to a file (database commits).
+Stages and counters are free-form names, bytes are counted per OLE stream
+name (e.g. '__substg1.0_1000001F' for a Unicode body).
+"""
+
+import heapq
+import json
+import threading
+import time
+
+_enabled = False
+# Metrics collecting for the current thread, see use() and collect()
+_local = threading.local()
+
+
+def enable(flag=True):
+    global _enabled
+    _enabled = flag
+
+
+def enabled():
+    return _enabled
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.addTime(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def current():
+    """Metrics collecting for the current thread, or None"""
+    if not _enabled:
+        return None
+    return getattr(_local, 'metrics', None)
+
+
+def timer(stage):
+    """Context manager adding its duration to stage"""
+    if not _enabled:
+        return _NULL_TIMER
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is None:
+        return _NULL_TIMER
+    return _Timer(metrics, stage)
+
+
+def count(name, n=1):
+    if not _enabled:
+        return
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is not None:
+        metrics.counters[name] = metrics.counters.get(name, 0) + n
+
+
+def addBytes(stream, n):
+    """Counts n bytes read from the OLE stream called stream"""
+    if not _enabled:
+        return
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is not None:
+        metrics.streamBytes[stream] = metrics.streamBytes.get(stream, 0) + n
+
+
+class Metrics(object):
+    """Totals of an analysis run: time spent and calls per stage, counters, bytes read
+    per stream, and the /slowest/ files.  When jsonLines (a text file) is given, the
+    measures of every file added are written to it, one JSON object per line.
+    """
+    def __init__(self, slowest=10, jsonLines=None):
+        self.stages = {}  # stage -> [calls, seconds]
+        self.counters = {}
+        self.streamBytes = {}
+        self.files = 0
+        self.seconds = 0.0
+        self.slowest = slowest
+        self.jsonLines = jsonLines
+        self._slowest = []  # heap of (seconds, path)
+
+    def addTime(self, stage, seconds):
+        totals = self.stages.get(stage)
+        if totals is None:
+            self.stages[stage] = [1, seconds]
+        else:
+            totals[0] += 1
+            totals[1] += seconds
+
+    def add(self, other):
+        for stage, (calls, seconds) in other.stages.items():
+            totals = self.stages.setdefault(stage, [0, 0.0])
+            totals[0] += calls
+            totals[1] += seconds
+        for name, n in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + n
+        for stream, n in other.streamBytes.items():
+            self.streamBytes[stream] = self.streamBytes.get(stream, 0) + n
+
+    def addFile(self, record):
+        """Adds the FileMetrics of an analyzed file"""
+        if record is None:
+            return
+        self.add(record)
+        self.files += 1
+        self.seconds += record.seconds
+        if self.slowest:
+            if len(self._slowest) < self.slowest:
+                heapq.heappush(self._slowest, (record.seconds, record.path))
+            else:
+                heapq.heappushpop(self._slowest, (record.seconds, record.path))
+        if self.jsonLines is not None:
+            self.jsonLines.write(json.dumps(record.toDict(), sort_keys=True) + '\n')
+
+    def slowestFiles(self):
+        return [(path, seconds) for seconds, path in sorted(self._slowest, reverse=True)]
+
+    def summary(self):
+        return {
+            'files': self.files,
+            'seconds': self.seconds,
+            'stages': dict((stage, {'calls': calls, 'seconds': seconds})
+                           for stage, (calls, seconds) in self.stages.items()),
+            'counters': dict(self.counters),
+            'stream_bytes': dict(self.streamBytes),
+            'slowest': [{'path': path, 'seconds': seconds} for path, seconds in self.slowestFiles()],
+        }
+
+    def dump(self, f):
+        json.dump(self.summary(), f, indent=2, sort_keys=True)
+        f.write('\n')
+
+    def format(self):
+        """Human readable summary"""
+        lines = ["%d files analyzed in %.3f s" % (self.files, self.seconds)]
+        lines.append("%-20s %10s %12s %10s" % ("stage", "calls", "seconds", "ms/call"))
+        for stage, (calls, seconds) in sorted(self.stages.items(), key=lambda item: -item[1][1]):
+            lines.append("%-20s %10d %12.3f %10.3f" % (stage, calls, seconds, seconds * 1000.0 / calls))
+        for name, n in sorted(self.counters.items()):
+            lines.append("%-20s %10d" % (name, n))
+        if self.streamBytes:
+            lines.append("bytes read per stream:")
+            for stream, n in sorted(self.streamBytes.items(), key=lambda item: -item[1]):
+                lines.append("  %-30s %12d" % (stream, n))
+        if self._slowest:
+            lines.append("slowest files:")
+            for path, seconds in self.slowestFiles():
+                lines.append("  %8.3f s  %s" % (seconds, path))
+        return '\n'.join(lines)
+
+
+class FileMetrics(Metrics):
+    """Measures of a single file, small enough to be pickled back from a worker process"""
+    def __init__(self, path):
+        Metrics.__init__(self, slowest=0)
+        self.path = path
+        self.status = None
+
+    def toDict(self):
+        return {
+            'path': self.path,
+            'status': self.status,
+            'seconds': self.seconds,
+            'stages': dict((stage, seconds) for stage, (calls, seconds) in self.stages.items()),
+            'counters': self.counters,
+            'stream_bytes': self.streamBytes,
+        }
+
+
+class use(object):
+    """Context manager making metrics (a Metrics or None) the one collecting for the current thread"""
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def __enter__(self):
+        self._previous = getattr(_local, 'metrics', None)
+        _local.metrics = self.metrics
+        return self.metrics
+
+    def __exit__(self, *exc):
+        _local.metrics = self._previous
+        return False
+
+
+class collect(object):
+    """Context manager collecting the measures of the current thread in a FileMetrics
+    for path, which it returns, or None when instrumentation is disabled.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.record = None
+
+    def __enter__(self):
+        if not _enabled:
+            return None
+        self.record = FileMetrics(self.path)
+        self._use = use(self.record)
+        self._use.__enter__()
+        self._start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, excType, exc, tb):
+        if self.record is not None:
+            self.record.seconds = time.perf_counter() - self._start
+            self.record.status = 'ok' if excType is None else 'failed'
+            self._use.__exit__()
+        return False
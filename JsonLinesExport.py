@@ -0,0 +1,70 @@
+"""
+JsonLinesExport:
+    Streaming export of .msg files to JSON Lines
+
+Writes one JSON object per line for every message of a directory, archive
+or file, nested messages included, each with its own line.  Messages are
+opened one at a time and attachments are hashed in chunks, so memory does
+not depend on the size of the corpus nor of the attachments.
+
+    python JsonLinesExport.py SOURCE [SOURCE ...] [-o out.jsonl] [--no-body] [--max-body N]
+"""
+
+import json
+import logging
+import sys
+
+import ExtractMsg
+
+
+def messageRecords(name, message, includeBody=True, maxBody=None, hashAttachments=True):
+    """Yields the records of message and of its nested messages, depth first
+    and within the limits of ExtractMsg.NestedWalk.
+    'path' locates a nested message in the file (storage names separated by
+    slashes, '' for the message itself) and 'parent' is the path of the
+    message it is attached to.
+    """
+    walk = ExtractMsg.NestedWalk(message)
+    for current, parent, depth in walk:
+        record = {'source': name, 'path': '/'.join(current.root_path),
+                  'parent': '/'.join(parent.root_path) if parent is not None else None, 'depth': depth}
+        record.update(current.toJson(includeBody=includeBody, maxBody=maxBody, hashAttachments=hashAttachments,
+                                     nested=False))
+        yield record
+    if walk.limits:
+        logging.warning("Nested messages of %s skipped, limits reached: %s" % (name, ', '.join(walk.limits)))
+
+
+def export(sources, out, pattern='*.msg', includeBody=True, maxBody=None, hashAttachments=True):
+    """Writes the records of every message of sources (directories, archives or
+    .msg files, see ExtractMsg.iterMessages) to the text file out.  A source or
+    message that can not be exported gets a record with its 'source' and an
+    'error', members of directories and archives that are not .msg files are
+    logged and skipped.
+    Returns (number of records written, number of errors)
+    """
+    records = 0
+    errors = 0
+    for source in sources:
+        try:
+            messages = ExtractMsg.iterMessages(source, pattern, snapshot=includeBody)
+            for name, message in messages:
+                try:
+                    for record in messageRecords(name, message, includeBody, maxBody, hashAttachments):
+                        out.write(json.dumps(record, sort_keys=True))
+                        out.write('\n')
+                        records += 1
+                except Exception as e:
+                    logging.exception("Could not export %s" % name)
+                    out.write(json.dumps({'source': name, 'error': "%s: %s" % (type(e).__name__, e)}) + '\n')
+                    errors += 1
+        except Exception as e:
+            logging.exception("Could not read %s" % source)
+            out.write(json.dumps({'source': source, 'error': "%s: %s" % (type(e).__name__, e)}) + '\n')
+            errors += 1
+    return records, errors
+
+
+if __name__ == "__main__":
+    import MsgAnalyzer
+    sys.exit(MsgAnalyzer.main(['export'] + sys.argv[1:]))
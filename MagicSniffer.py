@@ -0,0 +1,227 @@
+"""
+MagicSniffer:
+    File type identification from the first bytes of a payload
+
+Only the first SNIFF_SIZE bytes are looked at, so classifying an attachment
+never depends on its size.  Signatures are grouped by their first two bytes
+when the table is loaded: sniffing costs a dict lookup and a few prefix
+comparisons, whatever the number of signatures.
+"""
+
+import os
+import struct
+
+SNIFF_SIZE = 4096
+
+# (offset, signature, type), the longest signatures of a type first
+SIGNATURES = [
+    (0, b'MZ', 'exe'),
+    (0, b'\x7fELF', 'elf'),
+    (0, b'\xfe\xed\xfa\xce', 'macho'),
+    (0, b'\xfe\xed\xfa\xcf', 'macho'),
+    (0, b'\xce\xfa\xed\xfe', 'macho'),
+    (0, b'\xcf\xfa\xed\xfe', 'macho'),
+    (0, b'\xca\xfe\xba\xbe', 'class'),
+    (0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'ole'),
+    (0, b'PK\x03\x04', 'zip'),
+    (0, b'PK\x05\x06', 'zip'),
+    (0, b'Rar!\x1a\x07', 'rar'),
+    (0, b'7z\xbc\xaf\x27\x1c', '7z'),
+    (0, b'\x1f\x8b', 'gzip'),
+    (0, b'BZh', 'bzip2'),
+    (0, b'\xfd7zXZ\x00', 'xz'),
+    (0, b'MSCF', 'cab'),
+    (0, b'%PDF', 'pdf'),
+    (0, b'{\\rt', 'rtf'),
+    (0, b'L\x00\x00\x00\x01\x14\x02\x00', 'lnk'),
+    (0, b'\x89PNG\r\n\x1a\n', 'png'),
+    (0, b'\xff\xd8\xff', 'jpeg'),
+    (0, b'GIF87a', 'gif'),
+    (0, b'GIF89a', 'gif'),
+    (0, b'BM', 'bmp'),
+    (0, b'II*\x00', 'tiff'),
+    (0, b'MM\x00*', 'tiff'),
+    (0, b'ID3', 'mp3'),
+    (0, b'OggS', 'ogg'),
+    (0, b'\x1aE\xdf\xa3', 'mkv'),
+    (0, b'MIME-Version:', 'eml'),
+    (257, b'ustar', 'tar'),
+]
+
+# Extensions expected for each type, a file of another type with one of these
+# extensions (or the other way round) is a mismatch
+EXTENSIONS = {
+    'exe': ('.exe', '.com', '.scr', '.pif', '.cpl', '.sys', '.efi'),
+    'dll': ('.dll', '.ocx', '.cpl', '.drv', '.sys', '.ax', '.xll'),
+    'msdos': ('.exe', '.com'),
+    'elf': ('', '.so', '.bin', '.elf', '.o'),
+    'macho': ('', '.dylib', '.bin'),
+    'class': ('.class',),
+    'ole': ('.doc', '.dot', '.xls', '.xlt', '.xla', '.ppt', '.pps', '.pot', '.msi', '.msp', '.mst', '.msg', '.pub',
+            '.vsd', '.mpp', '.xlsb', '.docx', '.xlsx', '.pptx'),  # encrypted OOXML documents are OLE files
+    'zip': ('.zip', '.jar', '.apk', '.xpi', '.odt', '.ods', '.odp', '.epub', '.kmz', '.whl', '.nupkg', '.vsix'),
+    'ooxml': ('.docx', '.docm', '.dotx', '.dotm', '.docb', '.xlsx', '.xlsm', '.xltx', '.xltm', '.xlam', '.pptx',
+              '.pptm', '.potx', '.potm', '.ppsx', '.ppsm', '.ppam', '.sldx', '.sldm', '.vsdx', '.xps'),
+    'jar': ('.jar', '.zip', '.apk'),
+    'rar': ('.rar',),
+    '7z': ('.7z',),
+    'gzip': ('.gz', '.tgz', '.gzip'),
+    'bzip2': ('.bz2', '.tbz2', '.tbz'),
+    'xz': ('.xz', '.txz'),
+    'cab': ('.cab',),
+    'tar': ('.tar',),
+    'pdf': ('.pdf',),
+    'rtf': ('.rtf', '.doc'),
+    'lnk': ('.lnk',),
+    'png': ('.png',),
+    'jpeg': ('.jpg', '.jpeg', '.jpe', '.jfif'),
+    'gif': ('.gif',),
+    'bmp': ('.bmp', '.dib'),
+    'tiff': ('.tif', '.tiff'),
+    'mp3': ('.mp3',),
+    'ogg': ('.ogg', '.oga', '.ogv', '.opus'),
+    'mkv': ('.mkv', '.webm'),
+    'eml': ('.eml', '.mht', '.mhtml'),
+    'html': ('.htm', '.html', '.hta', '.xhtml', '.svg', '.mht'),
+    'xml': ('.xml', '.svg', '.xsl', '.xslt', '.rss', '.config', '.xaml', '.wsf', '.msc'),
+    'script': ('.js', '.jse', '.vbs', '.vbe', '.vba', '.ps1', '.psm1', '.bat', '.cmd', '.sh', '.py', '.wsf', '.hta'),
+    'text': ('.txt', '.csv', '.log', '.ini', '.cfg', '.json', '.md', '.ics', '.vcf', '.eml', '.js', '.vbs', '.bat',
+             '.cmd', '.ps1', '.reg', '.inf', '.sct', '.html', '.htm', '.xml', '.svg', '.url', '.rtf', '.css'),
+}
+
+# Types that run code when opened
+EXECUTABLE_TYPES = frozenset(('exe', 'dll', 'msdos', 'elf', 'macho', 'class', 'jar', 'lnk', 'script'))
+
+_EXTENSION_TYPES = {}
+for _type, _extensions in EXTENSIONS.items():
+    for _extension in _extensions:
+        _EXTENSION_TYPES.setdefault(_extension, set()).add(_type)
+
+# Signatures at offset 0 by their first two bytes, the others checked in order
+_BY_PREFIX = {}
+_AT_OFFSET = []
+for _offset, _signature, _type in SIGNATURES:
+    if _offset == 0:
+        _BY_PREFIX.setdefault(_signature[:2], []).append((_signature, _type))
+    else:
+        _AT_OFFSET.append((_offset, _signature, _type))
+for _candidates in _BY_PREFIX.values():
+    _candidates.sort(key=lambda candidate: -len(candidate[0]))
+
+_CONTROL_BYTES = bytes(bytearray(range(0, 9))) + bytes(bytearray(range(14, 27))) + b'\x1c\x1d\x1e\x1f\x7f'
+_OOXML_PARTS = (b'[Content_Types].xml', b'_rels/', b'docProps/', b'customXml/', b'word/', b'xl/', b'ppt/')
+# Sizes of the DIB headers of the BMP versions
+_BMP_HEADER_SIZES = (12, 16, 40, 52, 56, 64, 108, 124)
+# Only markers that plain text is unlikely to contain
+_SCRIPT_STARTS = (b'#!', b'@echo off', b'<job', b'<package')
+_SCRIPT_MARKERS = (b'wscript.', b'createobject(', b'activexobject(', b'-encodedcommand', b'frombase64string(')
+
+
+def _pe_type(head):
+    # PE header offset at 0x3C, then 'PE\0\0', the COFF header and its characteristics
+    if len(head) >= 0x40:
+        offset = struct.unpack_from('<I', head, 0x3C)[0]
+        if offset + 24 <= len(head) and head[offset:offset + 4] == b'PE\x00\x00':
+            characteristics = struct.unpack_from('<H', head, offset + 22)[0]
+            return 'dll' if characteristics & 0x2000 else 'exe'
+    # Otherwise an MS-DOS header: bytes used in the last 512 bytes page, pages and header
+    # paragraphs, which text starting with "MZ" can not give
+    if len(head) >= 10:
+        last, pages, relocations, paragraphs = struct.unpack_from('<HHHH', head, 2)
+        if last < 512 and pages and paragraphs >= 2:
+            return 'msdos'
+    return None
+
+
+def _bmp_type(head):
+    # File size, two reserved words that are zero, offset of the pixels and size of the DIB header
+    if len(head) < 18:
+        return None
+    size, reserved, offset, header = struct.unpack_from('<IIII', head, 2)
+    if reserved == 0 and 14 + header <= offset < size and header in _BMP_HEADER_SIZES:
+        return 'bmp'
+    return None
+
+
+def _zip_type(head):
+    # Name of the first entry, from its local file header
+    if head[:4] != b'PK\x03\x04' or len(head) < 30:
+        return 'zip'
+    length = struct.unpack_from('<H', head, 26)[0]
+    name = head[30:30 + length]
+    if name.startswith(_OOXML_PARTS):
+        return 'ooxml'
+    if name in (b'META-INF/', b'META-INF/MANIFEST.MF'):
+        return 'jar'
+    return 'zip'
+
+
+def _text_type(head):
+    if not head:
+        return 'empty'
+    if head.startswith(b'\xef\xbb\xbf'):
+        head = head[3:]
+    elif head[:2] in (b'\xff\xfe', b'\xfe\xff'):
+        return 'text'
+    sample = head[:1024]
+    # Text has no NUL and hardly any control characters, 8-bit bytes may be UTF-8 or a code page
+    if b'\x00' in sample or sum(sample.count(c) for c in _CONTROL_BYTES) * 20 > len(sample):
+        return 'data'
+    lower = sample.lstrip().lower()
+    if lower.startswith((b'<!doctype html', b'<html', b'<head', b'<body')) or b'<html' in lower:
+        return 'html'
+    if lower.startswith(b'<?xml'):
+        return 'xml'
+    if lower.startswith(_SCRIPT_STARTS) or any(marker in lower for marker in _SCRIPT_MARKERS):
+        return 'script'
+    return 'text'
+
+
+def sniff(head):
+    """Type of a payload starting with head (its first SNIFF_SIZE bytes or more), e.g. 'exe', 'ooxml',
+    'pdf', 'text' or 'data' when nothing is recognized.
+    """
+    if head is None:
+        return None
+    head = bytes(head[:SNIFF_SIZE])
+    for signature, magic in _BY_PREFIX.get(head[:2], ()):
+        if head.startswith(signature):
+            # Two bytes signatures are checked further, text can start with them
+            if magic == 'exe':
+                magic = _pe_type(head)
+            elif magic == 'bmp':
+                magic = _bmp_type(head)
+            elif magic == 'zip':
+                magic = _zip_type(head)
+            if magic is not None:
+                return magic
+    for offset, signature, magic in _AT_OFFSET:
+        if head[offset:offset + len(signature)] == signature:
+            return magic
+    return _text_type(head)
+
+
+def extension(filename):
+    if not filename:
+        return ''
+    return os.path.splitext(filename)[1].lower()
+
+
+def mismatch(magic, filename):
+    """True if the extension of filename does not match the type of its content: an executable
+    that does not look like one, or a known extension used for another type.
+    """
+    if magic is None or magic in ('data', 'empty'):
+        return False
+    ext = extension(filename)
+    expected = EXTENSIONS.get(magic, ())
+    if ext in expected:
+        return False
+    if magic in EXECUTABLE_TYPES:
+        return True
+    # Unknown extensions say nothing about the content
+    return ext in _EXTENSION_TYPES
+
+
+def is_executable(magic):
+    return magic in EXECUTABLE_TYPES
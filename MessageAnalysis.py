@@ -0,0 +1,443 @@
+"""
+MessageAnalysis:
+    Analysis of .msg files, independent of the database
+
+Parses a message, extracts its URLs, inspects and hashes its attachments,
+checks its headers and scores it.  Nothing here needs SQLAlchemy: analyzing
+only (e.g. "MsgAnalyzer.py analyze --analyze-only") does not load it, and
+EmailAnalyzer stores the results.
+"""
+
+from ExtractMsg import Message as MessageParser
+from ExtractMsg import Attachment as AttachmentParser
+from ExtractMsg import NestedWalk
+from ExtractMsg import FileLimits, ResourceLimitError
+from HeaderAnalyzer import HeaderAnalyzer
+import UrlExtractor
+import MinHash
+import MagicSniffer
+import AttachmentInspector
+import Instrumentation
+import logging
+import hashlib
+import os
+import shutil
+import functools
+import time
+from datetime import datetime
+import re
+
+
+class MessageAnalysis(object):
+    """Fields and scores of a message, independent of the database: cheap to create, pickle and discard
+    when analyzing only (see analyze_files). EmailAnalyzer.Message stores one, EmailAnalyzer.CoreWriter writes
+    it without the ORM.
+    urls is the list of the normalized URLs of the body, attachments the AttachmentAnalysis of the attached
+    files and nested the MessageAnalysis of the nested messages, within nested_limits (keyword arguments of
+    ExtractMsg.NestedWalk, e.g. {'maxDepth': 4}) unless walk_nested is False.
+    """
+    __slots__ = ('sender', 'sender_email', 'to', 'cc', 'subject', 'header', 'body', 'urls', 'date', 'spf_pass',
+                 'distinct_senders_in_header', 'from_mismatch_header', 'internal_mail', 'minhash', 'nested_limits',
+                 'attachments', 'nested', 'header_analysis')
+
+    # Shared by all messages unless one is given to __init__
+    header_analyzer = HeaderAnalyzer()
+    # Caches the inspection of archives and documents by SHA-1 for the whole process
+    inspector = AttachmentInspector.Inspector()
+
+    def __init__(self, msg_parser, blob_store=None, header_analyzer=None, inspector=None, nested_limits=None,
+                 walk_nested=True):
+        header_analyzer = header_analyzer or self.header_analyzer
+        inspector = inspector or self.inspector
+        self.spf_pass = None
+        self.distinct_senders_in_header = None
+        self.from_mismatch_header = None
+        self.internal_mail = None
+        self.nested_limits = None
+        self.sender = msg_parser.sender
+        try:
+            self.sender_email = re.search(r"([a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+)", self.sender).group() #Parse according to RFC5322
+        except (AttributeError, TypeError):
+            self.sender_email = None
+        self.to = msg_parser.to
+        self.cc = msg_parser.cc
+        self.subject = msg_parser.subject
+        self.header = msg_parser.headerStr
+        self.body = msg_parser.body
+        with Instrumentation.timer('url_extraction'):
+            self.urls = UrlExtractor.extract_urls(self.body)
+        with Instrumentation.timer('minhash'):
+            signature = MinHash.signature(MinHash.features(self.subject, self.body, self.urls))
+        self.minhash = MinHash.pack(signature) if signature is not None else None
+        date = msg_parser.parsedDate
+        if date is not None:
+            self.date = datetime(
+                year=date[0],
+                month=date[1],
+                day=date[2],
+                hour=date[3],
+                minute=date[4],
+                second=date[5]
+            )
+        else:
+            self.date = None
+
+        self.attachments = [AttachmentAnalysis(attachment, blob_store=blob_store, inspector=inspector)
+                            for attachment in msg_parser.attachments if isinstance(attachment, AttachmentParser)]
+        self.nested = []
+        if walk_nested:
+            self.walk_nested(msg_parser, blob_store, header_analyzer, inspector, nested_limits)
+
+        with Instrumentation.timer('header_analysis'):
+            self.header_analysis = header_analyzer.analyze(self.header)
+        with Instrumentation.timer('scoring'):
+            self.score_mail()
+
+    def walk_nested(self, msg_parser, blob_store, header_analyzer, inspector, nested_limits):
+        # Iterative, so deeply nested messages can not exhaust the stack
+        analyzed = {id(msg_parser): self}
+        walk = NestedWalk(msg_parser, **(nested_limits or {}))
+        for parser, parent, depth in walk:
+            if depth == 0:
+                continue
+            nested = MessageAnalysis(parser, blob_store=blob_store, header_analyzer=header_analyzer,
+                                     inspector=inspector, walk_nested=False)
+            analyzed[id(parent)].nested.append(nested)
+            analyzed[id(parser)] = nested
+        if walk.limits:
+            logging.warning("Nested messages skipped, limits reached: %s" % ', '.join(walk.limits))
+            self.nested_limits = ','.join(walk.limits)
+
+    def walk(self):
+        """Yields this analysis and those of the nested messages, depth first"""
+        stack = [self]
+        while stack:
+            analysis = stack.pop()
+            yield analysis
+            stack.extend(reversed(analysis.nested))
+
+    def to_dict(self):
+        """The analysis as a dict that can be serialized to JSON"""
+        return {
+            'sender': self.sender,
+            'sender_email': self.sender_email,
+            'to': self.to,
+            'cc': self.cc,
+            'subject': self.subject,
+            'date': self.date.isoformat() if self.date is not None else None,
+            'urls': self.urls,
+            'spf_pass': self.spf_pass,
+            'internal_mail': self.internal_mail,
+            'distinct_senders_in_header': self.distinct_senders_in_header,
+            'from_mismatch_header': self.from_mismatch_header,
+            'nested_limits': self.nested_limits,
+            'attachments': [attachment.to_dict() for attachment in self.attachments],
+            'nested': [nested.to_dict() for nested in self.nested],
+        }
+
+    def score_mail(self):
+        status, spf_senders = self.spf()
+        envelope_from, x_sender = self.check_sender()
+        if not self.internal_mail:
+            all_senders = spf_senders + envelope_from + x_sender
+            all_senders = list(set(all_senders))
+            if len(all_senders) > 1:
+                logging.warning("/!\ Multiple senders declared : %s"%all_senders)
+                self.distinct_senders_in_header = len(all_senders)
+            if self.sender_email not in all_senders:
+                logging.warning("/!\ sender email %s is not present in server generated headers (%s), email must be forged"%(self.sender_email, all_senders))
+                self.from_mismatch_header = True
+        else:
+            #Internal
+            pass
+
+    def check_sender(self):
+        envelope_from = self.header_analysis.envelope_from
+        logging.debug("enveloppe from : %s" % envelope_from)
+        x_sender = self.header_analysis.x_sender
+        logging.debug("xsender : %s" % x_sender)
+        return envelope_from, x_sender
+
+    def spf(self):
+        spfs = self.header_analysis.spf
+        for spf in spfs:
+            logging.debug("SPF : %s, %s"%spf)
+        spf_pass = self.header_analysis.spf_pass
+        if spf_pass:
+            logging.debug("SPF is OK : %s" % spfs)
+        else:
+            if not self.header_analysis.has_spf:
+                logging.debug("Internal email : %s"%self.header)
+                self.internal_mail = True
+                spf_pass = True
+            else:
+                logging.debug("SPF is KO : %s"%spfs)
+        senders = self.header_analysis.spf_senders
+        logging.debug("SPF Senders : %s"%senders)
+        self.spf_pass = spf_pass
+        return spf_pass, senders
+
+
+class AttachmentAnalysis(object):
+    """Analysis of an attached file, independent of the database (see MessageAnalysis)"""
+    __slots__ = ('short_name', 'long_name', 'sha1', 'magic', 'type_mismatch', 'size', 'stored', 'inspection',
+                 'risky')
+    risky_ext = {'.bat': '', '.bin': '',  '.cmd': '',  '.com': '',  '.cpl': '',  '.dll': '',  '.doc': '',  '.docb': '',  '.docm': '',  '.docx': '',  '.dot': '',  '.dotm': '',  '.dotx': '',  '.exe': '',  '.hta': '',  '.htm': '',  '.html': '',
+        '.jar': '',  '.msc': '',  '.msi': '',  '.msp': '',  '.mst': '',  '.pdf': '',  '.pif': '',  '.pot': '',  '.potm': '',  '.potx': '',  '.ppam': '',  '.pps': '',  '.ppsm': '',  '.ppsx': '',  '.ppt': '',  '.pptm': '',  '.pptx': '',
+        '.ps1': '',  '.ps1xml': '',  '.ps2': '',  '.ps2xml': '',  '.psc1': '',  '.psc2': '',  '.reg': '',  '.rgs': '',  '.scr': '',  '.sct': '',  '.shb': '',  '.shs': '',  '.sldm': '',  '.sldx': '',  '.vb': '',  '.vba': '',  '.vbe': '',
+        '.vbs': '',  '.vbscript': '',  '.ws': '',  '.wsh': '',  '.xla': '',  '.xlam': '',  '.xll': '',  '.xlm': '',  '.xls': '',  '.xlsb': '',  '.xlsm': '',  '.xlsx': '',  '.xlt': '',  '.xltm': '',  '.xltx': '',  '.xlw': '',  '.zip': ''
+    }
+
+    def __init__(self, attachment_obj, blob_store=None, inspector=None):
+        self.short_name = attachment_obj.shortFilename
+        self.long_name = attachment_obj.longFilename
+        self.sha1 = attachment_obj.sha1
+        self.magic = attachment_obj.magic
+        self.type_mismatch = attachment_obj.typeMismatch
+        self.size = attachment_obj.size
+        self.stored = False
+        if blob_store is not None and self.sha1 is not None:
+            self.stored = blob_store.put(self.sha1, attachment_obj.open)
+        self.inspection = None
+        if inspector is not None:
+            with Instrumentation.timer('inspection'):
+                self.inspection = inspector.inspect(self.sha1, self.magic, attachment_obj.open)
+        self.risky = self.is_risky()
+
+    def is_risky(self):
+        if MagicSniffer.is_executable(self.magic) or self.type_mismatch:
+            return True
+        if self.inspection is not None and 'error' not in self.inspection:
+            # Archives and documents are judged on their content, not on their extension
+            return AttachmentInspector.is_risky(self.inspection)
+        # Either name may be missing
+        return MagicSniffer.extension(self.long_name or self.short_name) in self.risky_ext
+
+    def to_dict(self):
+        return {
+            'short_name': self.short_name,
+            'long_name': self.long_name,
+            'sha1': self.sha1,
+            'magic': self.magic,
+            'size': self.size,
+            'type_mismatch': self.type_mismatch,
+            'risky': self.risky,
+            'inspection': self.inspection,
+        }
+
+
+class BlobStore(object):
+    """On-disk content-addressed store of attachment payloads, <root>/<sha1[:2]>/<sha1>.
+    A payload is written once, later copies only cost a stat().
+    Several processes can share the same store.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, sha1):
+        return os.path.join(self.root, sha1[:2], sha1)
+
+    def __contains__(self, sha1):
+        return os.path.exists(self.path(sha1))
+
+    def put(self, sha1, open_stream):
+        """Stores the payload returned by open_stream() under sha1 unless already present.
+        Returns True if the payload is in the store."""
+        path = self.path(sha1)
+        if os.path.exists(path):
+            return True
+        stream = open_stream()
+        if stream is None:
+            return False
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another worker in the meantime
+                pass
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(stream, f, 64 * 1024)
+            # Same content if another worker stored it in the meantime, os.rename would fail on Windows
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return True
+
+    def open(self, sha1):
+        return open(self.path(sha1), 'rb')
+
+
+def file_signature(path):
+    """Returns (size, mtime, sha1) of the file at path"""
+    stat = os.stat(path)
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            sha1.update(chunk)
+    return stat.st_size, stat.st_mtime, sha1.hexdigest()
+
+
+# Status of the files whose analysis went beyond their limits, see file_status
+QUARANTINED = 'quarantined'
+
+
+def file_status(analysis, error):
+    """'ok', 'failed' or QUARANTINED (a limit of ExtractMsg.FileLimits was exceeded) for a result of analyze_file"""
+    if analysis is not None:
+        return 'ok'
+    if error is not None and error.startswith(ResourceLimitError.__name__ + ':'):
+        return QUARANTINED
+    return 'failed'
+
+
+def analyze_file(path, blob_store=None, header_analyzer=None, instrument=False, nested_limits=None,
+                 file_limits=None, known_inspections=None):
+    """Parses, scores and hashes a single .msg file, storing new attachment payloads in blob_store if given.
+    Returns (path, signature, analysis, error, metrics), analysis being the MessageAnalysis of the file or None
+    when it could not be analyzed, signature (see file_signature) None when it could not be read and metrics the
+    Instrumentation.FileMetrics of the file when instrument is set (None otherwise). nested_limits bounds the
+    analysis of nested messages, see MessageAnalysis. file_limits (keyword arguments of ExtractMsg.FileLimits,
+    its defaults when None) bounds the time, bytes, streams and attachments spent on the file: beyond, the file
+    is given up and its error starts with ResourceLimitError (see file_status). known_inspections, when given,
+    returns the inspection result of an attachment payload already analyzed by SHA-1 (see
+    AttachmentInspector.Inspector.lookup), which is then not inspected again.
+    """
+    if instrument:
+        # Worker processes do not inherit the state of the parent on every platform
+        Instrumentation.enable()
+    # The inspector of the process, its cache outlives the file
+    MessageAnalysis.inspector.lookup = known_inspections
+    signature = None
+    msg = None
+    error = None
+    with Instrumentation.collect(path) as record:
+        try:
+            with Instrumentation.timer('file_signature'):
+                signature = file_signature(path)
+            limits = FileLimits(**(file_limits or {}))
+            msg_parser = MessageParser(msgFilePath=path, snapshot=True, limits=limits)
+            try:
+                msg = MessageAnalysis(msg_parser, blob_store=blob_store, header_analyzer=header_analyzer,
+                                      nested_limits=nested_limits)
+            finally:
+                msg_parser.oleMessage.close()
+            if limits.exceeded is not None:
+                # Raised where it was caught, e.g. while inspecting an attachment
+                raise limits.exceeded
+        except ResourceLimitError as e:
+            logging.warning("Quarantined %s: %s" % (path, e))
+            msg = None
+            error = "%s: %s" % (type(e).__name__, e)
+        except Exception as e:
+            logging.exception("Could not analyze %s" % path)
+            msg = None
+            error = "%s: %s" % (type(e).__name__, e)
+    if record is not None and error is not None:
+        record.status = file_status(msg, error)
+    return path, signature, msg, error, record
+
+
+# Seconds past maxSeconds a file is left to its own checks before its worker is killed, and interval of the checks
+WATCHDOG_GRACE = 5
+WATCHDOG_POLL = 1.0
+
+# In worker processes: time each file of the pool started, by index
+_started = None
+
+
+def _watch(started):
+    global _started
+    _started = started
+
+
+def _analyze_chunk(analyze, chunk):
+    results = []
+    for index, path in chunk:
+        _started[index] = time.monotonic()
+        results.append(analyze(path))
+    return results
+
+
+def timed_out(path, max_seconds):
+    """Result of analyze_file for path, whose worker was killed after max_seconds"""
+    error = ResourceLimitError('seconds', "more than %s s spent on the file, its analysis was killed" % max_seconds)
+    logging.warning("Quarantined %s: %s" % (path, error))
+    signature = None
+    with Instrumentation.collect(path) as record:
+        try:
+            # Lets the manifest tell when the file changes
+            signature = file_signature(path)
+        except (IOError, OSError):
+            pass
+    if record is not None:
+        record.status = QUARANTINED
+    return path, signature, None, "%s: %s" % (type(error).__name__, error), record
+
+
+def analyze_files(paths, workers=1, chunksize=8, **options):
+    """Yields the result of analyze_file (called with options) for every path, in order.
+    With workers > 1 the files are analyzed in a pool of processes, chunksize files at a time.
+    The analysis only checks its time limit between two reads, so unless file_limits sets no maxSeconds the
+    files are analyzed in worker processes (a single one if workers <= 1) watched from this one: a worker still
+    on a file WATCHDOG_GRACE seconds past maxSeconds is killed and the file quarantined, the pool is restarted
+    for the next files. Starting a worker costs some 30 ms, a single file with workers <= 1 is analyzed in this
+    process, where its time limit is only checked between reads.
+    """
+    analyze = functools.partial(analyze_file, **options)
+    max_seconds = FileLimits(**(options.get('file_limits') or {})).maxSeconds
+    paths = list(paths)
+    if workers <= 1 and (max_seconds is None or len(paths) <= 1):
+        for path in paths:
+            yield analyze(path)
+        return
+    import multiprocessing
+    killed = {}  # index -> result of the files whose worker was killed
+    position = 0  # index of the next result
+    while position < len(paths):
+        todo = [index for index in range(position, len(paths)) if index not in killed]
+        chunks = [todo[i:i + chunksize] for i in range(0, len(todo), chunksize)]
+        started = multiprocessing.RawArray('d', len(paths))
+        pool = multiprocessing.Pool(processes=max(workers, 1), initializer=_watch, initargs=(started,))
+        stuck = None
+        try:
+            # Chunks are sent as single tasks, pool.imap only gives a timeout to results sent one by one
+            results = pool.imap(functools.partial(_analyze_chunk, analyze),
+                                [[(index, paths[index]) for index in chunk] for chunk in chunks])
+            for chunk in chunks:
+                while stuck is None:
+                    try:
+                        chunk_results = results.next(WATCHDOG_POLL)
+                        break
+                    except multiprocessing.TimeoutError:
+                        # Files of a chunk are analyzed in turn, the last one started is the current one
+                        current = [index for index in chunk if started[index]]
+                        if max_seconds is not None and current \
+                                and time.monotonic() - started[current[-1]] > max_seconds + WATCHDOG_GRACE:
+                            stuck = current[-1]
+                if stuck is not None:
+                    break
+                for index, result in zip(chunk, chunk_results):
+                    while position < index:
+                        yield killed.pop(position)
+                        position += 1
+                    yield result
+                    position += 1
+        finally:
+            if stuck is not None:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+        if stuck is not None:
+            # The files of its chunk before it are analyzed again
+            killed[stuck] = timed_out(paths[stuck], max_seconds)
+        while position in killed:
+            yield killed.pop(position)
+            position += 1
@@ -0,0 +1,125 @@
+"""
+MinHash:
+    Similarity signatures of messages, for near-duplicate detection
+
+A message is reduced to a set of features (word 3-grams of its normalized
+body, words of its subject, hosts and first path segments of its links),
+the set to a MinHash signature of NUM_PERM values, and the signature to
+BANDS band keys for locality-sensitive hashing: two messages whose feature
+sets have a Jaccard similarity s share at least one band key with
+probability 1 - (1 - s^ROWS)^BANDS, about 0.87 for s = 0.5 and 0.999 for
+s = 0.8.  Recipients' names, numbers, e-mail addresses, tracking tokens and
+URL query strings are normalized away, so the copies of a campaign get
+nearly the same features.
+
+Signatures use one-permutation hashing: every feature is hashed once, its
+hash picking one of NUM_PERM bins and the smallest value of each bin being
+kept, empty bins borrowing the value of the next non-empty one.  Computing a
+signature costs one hash per feature whatever NUM_PERM.
+
+    signature = MinHash.signature(MinHash.features(subject, body, urls))
+    MinHash.similarity(signature, other)   # estimated Jaccard similarity
+    MinHash.band_keys(signature)           # BANDS integers, see EmailAnalyzer.CampaignRegistry
+"""
+
+import hashlib
+import re
+import struct
+
+NUM_PERM = 128
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+# Beyond this number of characters bodies are not looked at
+MAX_BODY = 100000
+
+_BIN_BITS = 7  # log2(NUM_PERM)
+_VALUE_BITS = 57
+_PACK = struct.Struct('<%dQ' % NUM_PERM)
+_BAND = struct.Struct('<B%dQ' % ROWS)
+
+_URL = re.compile(r'(?i)\b(?:https?|ftp)://([^\s/<>"\'?#]+)(/[^\s/<>"\'?#]*)?[^\s<>"\']*')
+_EMAIL = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+# Words with digits, e.g. invoice numbers and tracking identifiers
+_TOKEN = re.compile(r'\w*\d\w*')
+_WORD = re.compile(r'\w+', re.UNICODE)
+_SUBJECT_PREFIX = re.compile(r'^(?:\s*(?:re|fw|fwd|tr|aw|wg|sv)\s*(?:\[\d+\])?\s*:)+', re.IGNORECASE)
+
+
+def _words(text):
+    text = _URL.sub(lambda match: ' %s ' % match.group(1).lower(), text.lower())
+    text = _EMAIL.sub(' email ', text)
+    text = _TOKEN.sub(' 0 ', text)
+    return _WORD.findall(text)
+
+
+def features(subject, body, urls=()):
+    """Set of the features of a message, urls being the normalized URLs of its body (see UrlExtractor)"""
+    result = set()
+    words = _words((body or '')[:MAX_BODY])
+    if len(words) < 3:
+        result.update('b:' + word for word in words)
+    for i in range(len(words) - 2):
+        result.add('b:%s %s %s' % (words[i], words[i + 1], words[i + 2]))
+    result.update('s:' + word for word in _words(_SUBJECT_PREFIX.sub('', subject or '')))
+    for url in urls:
+        match = _URL.match(url)
+        if match is None:
+            continue
+        host = match.group(1).lower()
+        result.add('u:' + host)
+        if match.group(2):
+            result.add('u:%s%s' % (host, match.group(2)))
+    return result
+
+
+def _hash(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+def signature(features):
+    """MinHash signature (a tuple of NUM_PERM integers) of a set of strings, None if it is empty"""
+    bins = [None] * NUM_PERM
+    mask = NUM_PERM - 1
+    for feature in features:
+        h = _hash(feature.encode('utf-8'))
+        index = h & mask
+        value = h >> _BIN_BITS
+        current = bins[index]
+        if current is None or value < current:
+            bins[index] = value
+    if all(value is None for value in bins):
+        return None
+    dense = list(bins)
+    for i, value in enumerate(bins):
+        if value is None:
+            # Densification: an empty bin takes the value of the next non-empty bin, tagged with the
+            # distance so that it can only be equal to a value borrowed the same way
+            distance = 1
+            while bins[(i + distance) % NUM_PERM] is None:
+                distance += 1
+            dense[i] = bins[(i + distance) % NUM_PERM] | (distance << _VALUE_BITS)
+    return tuple(dense)
+
+
+def similarity(a, b):
+    """Estimated Jaccard similarity of the feature sets of two signatures"""
+    return sum(1 for x, y in zip(a, b) if x == y) / float(NUM_PERM)
+
+
+def band_keys(signature):
+    """BANDS keys of signature: similar signatures have keys in common. Keys are signed 64-bit integers
+    and differ from one band to the other, so they can all be stored in the same indexed column.
+    """
+    keys = []
+    for band in range(BANDS):
+        packed = _BAND.pack(band, *signature[band * ROWS:(band + 1) * ROWS])
+        keys.append(int.from_bytes(hashlib.blake2b(packed, digest_size=8).digest(), 'little', signed=True))
+    return keys
+
+
+def pack(signature):
+    return _PACK.pack(*signature)
+
+
+def unpack(data):
+    return _PACK.unpack(data)
@@ -0,0 +1,301 @@
+"""
+MsgAnalyzer:
+    Command line of the analyzer
+
+    python MsgAnalyzer.py extract example.msg [--json | --raw] [--output-dir DIR]
+    python MsgAnalyzer.py analyze "mails/*.msg" [--database URL] [--workers N] [--analyze-only]
+    python MsgAnalyzer.py export SOURCE [SOURCE ...] [-o out.jsonl]
+    python MsgAnalyzer.py columnar OUTPUT_DIR [--database URL] [--format parquet|arrow]
+
+Only argparse is imported at startup, every command imports what it needs
+when it runs: extract and export never load SQLAlchemy, nor does analyze
+with --analyze-only, and pyarrow is only loaded by columnar.  ExtractMsg.py, EmailAnalyzer.py and JsonLinesExport.py
+run the extract, analyze and export commands respectively.
+"""
+
+import argparse
+import logging
+import sys
+
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+
+def _nested_limits(args):
+    import ExtractMsg
+    return {
+        'maxDepth': args.max_nested_depth if args.max_nested_depth is not None else ExtractMsg.MAX_NESTED_DEPTH,
+        'maxCount': args.max_nested_count if args.max_nested_count is not None else ExtractMsg.MAX_NESTED_COUNT,
+        'maxBytes': args.max_nested_bytes if args.max_nested_bytes is not None else ExtractMsg.MAX_NESTED_BYTES,
+    }
+
+
+def _file_limits(args):
+    # Defaults of ExtractMsg.FileLimits for the options not given, 0 disables a limit
+    limits = {}
+    for name, value in (('maxSeconds', args.max_file_seconds), ('maxBytes', args.max_file_bytes),
+                        ('maxStreams', args.max_file_streams), ('maxAttachments', args.max_file_attachments)):
+        if value is not None:
+            limits[name] = value or None
+    return limits
+
+
+def _expand(patterns):
+    # Shells on Windows do not expand wildcards
+    import glob
+    import os
+    paths = []
+    seen = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches and not glob.has_magic(pattern):
+            # Reported as an error by the command
+            matches = [pattern]
+        for path in matches:
+            # A file given twice would be analyzed, and recorded, twice
+            if os.path.abspath(path) not in seen:
+                seen.add(os.path.abspath(path))
+                paths.append(path)
+    return paths
+
+
+def saveRaw(msg, directory):
+    """Writes every stream of the file of msg under a new directory/raw folder,
+    storages becoming folders.  Returns the path of the raw folder.
+    """
+    import os
+    import shutil
+    import ExtractMsg
+    raw = os.path.join(directory, 'raw')
+    suffix = 1
+    while os.path.exists(raw):
+        suffix += 1
+        raw = os.path.join(directory, 'raw (%d)' % suffix)
+    for path in msg.oleMessage.listdir(streams=True, storages=False):
+        folder = os.path.join(raw, *[ExtractMsg.safeFilename(name) for name in path[:-1]])
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, ExtractMsg.safeFilename(path[-1])), 'wb') as f:
+            shutil.copyfileobj(msg.oleMessage.openstream(path), f)
+    return raw
+
+
+def extract(args):
+    import json
+    import os
+    import ExtractMsg
+    if args.output_dir and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    errors = 0
+    for path in _expand(args.files):
+        try:
+            msg = ExtractMsg.Message(path)
+        except Exception:
+            logging.exception("Cannot open %s" % path)
+            errors += 1
+            continue
+        try:
+            if args.json:
+                print(json.dumps(msg.toJson(), default=str))
+            elif args.raw:
+                logging.info("%s: %s" % (path, saveRaw(msg, args.output_dir or '.')))
+            else:
+                logging.info("%s: %s" % (path, msg.save(args.output_dir or '.')))
+        except Exception:
+            logging.exception("Cannot extract %s" % path)
+            errors += 1
+        finally:
+            msg.oleMessage.close()
+    return 1 if errors else 0
+
+
+def analyze(args):
+    import Instrumentation
+    from HeaderAnalyzer import HeaderAnalyzer, DEFAULT_INTERNAL_DOMAIN
+    from MessageAnalysis import BlobStore
+    metrics = None
+    json_lines = None
+    if args.metrics or args.metrics_json or args.metrics_jsonl:
+        if args.metrics_jsonl:
+            json_lines = open(args.metrics_jsonl, 'w')
+        metrics = Instrumentation.Metrics(slowest=args.slowest, jsonLines=json_lines)
+    blob_store = BlobStore(args.blob_store) if args.blob_store else None
+    header_analyzer = HeaderAnalyzer(args.internal_domain or DEFAULT_INTERNAL_DOMAIN)
+    paths = _expand(args.patterns)
+    if args.analyze_only:
+        # Without the database, hence without SQLAlchemy
+        import json
+        from MessageAnalysis import analyze_files
+        if metrics is not None:
+            Instrumentation.enable()
+        with Instrumentation.use(metrics):
+            for path, signature, msg, error, record in analyze_files(
+                    paths, args.workers, args.chunksize, blob_store=blob_store, header_analyzer=header_analyzer,
+                    instrument=metrics is not None, nested_limits=_nested_limits(args),
+                    file_limits=_file_limits(args)):
+                if record is not None:
+                    metrics.addFile(record)
+                result = {'path': path, 'error': error, 'analysis': msg.to_dict() if msg is not None else None}
+                print(json.dumps(result, sort_keys=True))
+    else:
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        import EmailAnalyzer
+        engine = create_engine(args.database, echo=args.echo)
+        EmailAnalyzer.Base.metadata.create_all(engine)
+        if not args.no_search_index:
+            import SearchIndex
+            SearchIndex.install(engine)
+        session = sessionmaker(bind=engine)()
+        EmailAnalyzer.ingest(paths, session, workers=args.workers, chunksize=args.chunksize,
+                             batch_size=args.batch_size, force=args.force, retry_failed=not args.no_retry,
+                             blob_store=blob_store, header_analyzer=header_analyzer, metrics=metrics,
+                             nested_limits=_nested_limits(args), core=args.core, file_limits=_file_limits(args),
+                             retry_quarantined=args.retry_quarantined)
+        session.close()
+    if json_lines is not None:
+        json_lines.close()
+    if metrics is not None:
+        if args.metrics:
+            print(metrics.format())
+        if args.metrics_json:
+            with open(args.metrics_json, 'w') as f:
+                metrics.dump(f)
+    return 0
+
+
+def export(args):
+    import JsonLinesExport
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        records, errors = JsonLinesExport.export(args.sources, out, pattern=args.pattern,
+                                                 includeBody=not args.no_body, maxBody=args.max_body,
+                                                 hashAttachments=not args.no_hash)
+    finally:
+        if args.output:
+            out.close()
+    logging.info("%d records written, %d errors" % (records, errors))
+    return 1 if errors else 0
+
+
+def columnar(args):
+    from sqlalchemy import create_engine
+    import ColumnarExport
+    engine = create_engine(args.database)
+    with engine.connect() as connection:
+        try:
+            ColumnarExport.export(connection, args.output_dir, fmt=args.format, batch_size=args.batch_size,
+                                  row_group_size=args.row_group_size, include_body=args.with_body)
+        except (IOError, ImportError) as e:
+            logging.error(str(e))
+            return 1
+    return 0
+
+
+def build_parser():
+    # --log-level is accepted before and after the command name
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--log-level", default=argparse.SUPPRESS, choices=LOG_LEVELS,
+                        help="DEBUG also logs the SPF and sender checks of every message (default: INFO)")
+    parser = argparse.ArgumentParser(description="Extract and analyze Outlook .msg files", parents=[common])
+    parser.set_defaults(log_level="INFO")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    commands.required = True
+
+    p = commands.add_parser("extract", parents=[common],
+                            help="save messages in folders named after their date and subject",
+                            description="Save every message in a new folder named after its date, time and subject "
+                                        "(for example \"2013-07-24_0915 Example\") holding message.text and the "
+                                        "attachments, nested messages in subfolders")
+    p.add_argument("files", nargs="+", metavar="FILE", help=".msg files")
+    output = p.add_mutually_exclusive_group()
+    output.add_argument("--json", action="store_true", help="print the messages as JSON instead")
+    output.add_argument("--raw", action="store_true", help="dump every stream of the files under a raw folder instead")
+    p.add_argument("--output-dir", help="folder where the messages are saved (default: current folder)")
+    p.set_defaults(run=extract)
+
+    p = commands.add_parser("analyze", parents=[common], help="analyze messages and store the results",
+                            description="Analyze Outlook .msg files and store the results in a database")
+    p.add_argument("patterns", nargs="*", default=["mails/*.msg"], metavar="PATTERN",
+                   help="files or wildcard patterns (default: mails/*.msg)")
+    p.add_argument("--database", default="sqlite:///db.sqlite",
+                   help="SQLAlchemy URL of the database (default: %(default)s)")
+    p.add_argument("-w", "--workers", type=int, default=1, help="number of worker processes (default: 1, serial). Unless --max-file-seconds "
+                        "is 0, files are analyzed in worker processes killed past that time, even when "
+                        "serial, which adds some 30 ms to a run; a single file with -w 1 is analyzed in "
+                        "process")
+    p.add_argument("--chunksize", type=int, default=8, help="files handed to a worker at once")
+    p.add_argument("--batch-size", type=int, default=500, help="messages committed at once")
+    p.add_argument("--echo", action="store_true", help="log every SQL statement")
+    p.add_argument("--force", action="store_true", help="analyze again files that did not change")
+    p.add_argument("--no-retry", action="store_true", help="do not retry files that failed on a previous run")
+    p.add_argument("--blob-store", help="directory where attachment payloads are stored, once per SHA-1")
+    p.add_argument("--internal-domain",
+                   help="domain whose servers add the trusted Received-SPF headers "
+                        "(default: HeaderAnalyzer.DEFAULT_INTERNAL_DOMAIN)")
+    p.add_argument("--no-search-index", action="store_true",
+                   help="do not maintain the full-text index of the messages (see SearchIndex)")
+    p.add_argument("--metrics", action="store_true", help="print time spent per stage and bytes read at the end")
+    p.add_argument("--metrics-json", metavar="FILE", help="write the summary of the run measures as JSON to FILE")
+    p.add_argument("--metrics-jsonl", metavar="FILE", help="write the measures of every file as JSON lines to FILE")
+    p.add_argument("--slowest", type=int, default=10, help="number of slowest files reported (default: 10)")
+    p.add_argument("--max-nested-depth", type=int,
+                   help="nesting level beyond which nested messages are skipped (default: ExtractMsg.MAX_NESTED_DEPTH)")
+    p.add_argument("--max-nested-count", type=int,
+                   help="number of nested messages analyzed per file (default: ExtractMsg.MAX_NESTED_COUNT)")
+    p.add_argument("--max-nested-bytes", type=int,
+                   help="size of the streams read per file, nested messages included "
+                        "(default: ExtractMsg.MAX_NESTED_BYTES)")
+    p.add_argument("--max-file-seconds", type=float,
+                   help="wall time spent on a file before it is quarantined, 0 for no limit "
+                        "(default: ExtractMsg.MAX_FILE_SECONDS). Enforced by a watchdog process "
+                        "(see --workers)")
+    p.add_argument("--max-file-bytes", type=int,
+                   help="bytes read from the streams of a file before it is quarantined "
+                        "(default: ExtractMsg.MAX_FILE_BYTES)")
+    p.add_argument("--max-file-streams", type=int,
+                   help="directory entries beyond which a file is quarantined (default: ExtractMsg.MAX_FILE_STREAMS)")
+    p.add_argument("--max-file-attachments", type=int,
+                   help="attachments, those of nested messages included, beyond which a file is quarantined "
+                        "(default: ExtractMsg.MAX_FILE_ATTACHMENTS)")
+    p.add_argument("--retry-quarantined", action="store_true",
+                   help="analyze again quarantined files that did not change, e.g. after raising the limits")
+    p.add_argument("--core", action="store_true",
+                   help="write with SQLAlchemy Core statements rather than ORM objects (see EmailAnalyzer.CoreWriter)")
+    p.add_argument("--analyze-only", action="store_true",
+                   help="print the analysis of every file as JSON lines instead of storing it, without SQLAlchemy")
+    p.set_defaults(run=analyze)
+
+    p = commands.add_parser("export", parents=[common], help="export messages as JSON Lines",
+                            description="Export .msg files as JSON Lines, one record per message")
+    p.add_argument("sources", nargs="+", help=".msg files, directories or zip/tar archives")
+    p.add_argument("-o", "--output", help="output file (default: standard output)")
+    p.add_argument("--pattern", default="*.msg", help="files to export in directories and archives")
+    p.add_argument("--no-body", action="store_true", help="leave the bodies out")
+    p.add_argument("--max-body", type=int, help="truncate bodies to this number of characters")
+    p.add_argument("--no-hash", action="store_true", help="do not compute the SHA-1 of attachments")
+    p.set_defaults(run=export)
+
+    p = commands.add_parser("columnar", parents=[common], help="export analyzed messages to Parquet or Arrow files",
+                            description="Export the messages, attachments and URLs of the database to columnar "
+                                        "files partitioned by month (see ColumnarExport), requires pyarrow")
+    p.add_argument("output_dir", metavar="OUTPUT_DIR", help="folder of the messages, attachments and urls datasets")
+    p.add_argument("--database", default="sqlite:///db.sqlite",
+                   help="SQLAlchemy URL of the database (default: %(default)s)")
+    p.add_argument("--format", default="parquet", choices=("parquet", "arrow"),
+                   help="Parquet or Arrow IPC files (default: %(default)s)")
+    p.add_argument("--batch-size", type=int, default=10000, help="rows read from the database at once")
+    p.add_argument("--row-group-size", type=int, default=100000, help="rows per row group (default: %(default)s)")
+    p.add_argument("--with-body", action="store_true", help="also export the header and body of the messages")
+    p.set_defaults(run=columnar)
+    return parser
+
+
+def main(argv=None):
+    """Runs the command of argv (sys.argv[1:] by default), returns the exit status"""
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=getattr(logging, args.log_level))
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+"""
+SearchIndex:
+    Full-text search over the analyzed messages (SQLite FTS5)
+
+The message_fts table indexes the subject, body, sender and attachment long
+names of every EmailAnalyzer.Message, its rowid being the id of the message.
+Once install() is called for an engine, rows are added and removed in the
+same transaction as the messages, nested ones included.
+
+    SearchIndex.install(engine)
+    for hit in SearchIndex.search(session, 'verify your account'):
+        print(hit.message_id, hit.subject, hit.snippet)
+"""
+
+import collections
+import logging
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Mapper
+
+import EmailAnalyzer
+
+FTS_TABLE = 'message_fts'
+# bm25 weights of subject, body, sender and attachments
+RANK = 'bm25(10.0, 1.0, 5.0, 5.0)'
+
+SearchHit = collections.namedtuple('SearchHit', 'message_id score subject sender snippet')
+
+# Engines whose messages are indexed
+_engines = set()
+
+
+def supported(connection):
+    """True if the SQLite library of connection was built with FTS5"""
+    if connection.dialect.name != 'sqlite':
+        return False
+    options = [row[0] for row in connection.execute(text("PRAGMA compile_options"))]
+    return 'ENABLE_FTS5' in options
+
+
+def install(engine):
+    """Creates the index of the messages of engine if needed, filling it from the existing messages,
+    and keeps it up to date from then on. Returns False (and does nothing) if SQLite lacks FTS5.
+    """
+    with engine.begin() as connection:
+        if not supported(connection):
+            logging.warning("Full-text search disabled, SQLite was built without FTS5")
+            return False
+        exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                                    {'name': FTS_TABLE}).first() is not None
+        if not exists:
+            connection.execute(text("CREATE VIRTUAL TABLE %s USING fts5(subject, body, sender, attachments, "
+                                    "tokenize = 'unicode61 remove_diacritics 2')" % FTS_TABLE))
+            connection.execute(text("INSERT INTO %s(%s, rank) VALUES ('rank', :rank)" % (FTS_TABLE, FTS_TABLE)),
+                               {'rank': RANK})
+            rebuild(connection)
+    _engines.add(engine)
+    # Listening to every mapper rather than to EmailAnalyzer.Message also covers
+    # EmailAnalyzer run as a script, where Message is __main__.Message
+    if not event.contains(Mapper, 'after_insert', _after_insert):
+        event.listen(Mapper, 'after_insert', _after_insert)
+        event.listen(Mapper, 'after_delete', _after_delete)
+    return True
+
+
+def rebuild(connection):
+    """Indexes again every message"""
+    connection.execute(text("DELETE FROM %s" % FTS_TABLE))
+    connection.execute(text(
+        "INSERT INTO %(fts)s(rowid, subject, body, sender, attachments) "
+        "SELECT m.id, m.subject, m.body, m.sender, "
+        "(SELECT group_concat(a.long_name, ' ') FROM %(attachments)s a WHERE a.message_id = m.id) "
+        "FROM %(messages)s m" % {'fts': FTS_TABLE, 'attachments': EmailAnalyzer.Attachment.__tablename__,
+                                  'messages': EmailAnalyzer.Message.__tablename__}))
+
+
+def installed(engine):
+    """True if the messages of engine are indexed"""
+    return engine in _engines
+
+
+def add(connection, rows):
+    """Indexes messages given as dicts with their id, subject, body, sender and attachments (long names
+    separated by spaces), for writers that bypass the ORM (see EmailAnalyzer.CoreWriter)"""
+    if rows:
+        connection.execute(text("INSERT INTO %s(rowid, subject, body, sender, attachments) "
+                                "VALUES (:id, :subject, :body, :sender, :attachments)" % FTS_TABLE), rows)
+
+
+def remove(connection, ids):
+    """Removes messages from the index by id"""
+    for message_id in ids:
+        connection.execute(text("DELETE FROM %s WHERE rowid = :id" % FTS_TABLE), {'id': message_id})
+
+
+def _indexed(mapper, connection):
+    return mapper.local_table.name == EmailAnalyzer.Message.__tablename__ and connection.engine in _engines
+
+
+def _after_insert(mapper, connection, target):
+    if not _indexed(mapper, connection):
+        return
+    # Attachments are inserted after their message but are already known
+    names = ' '.join(attachment.long_name for attachment in target.attachments if attachment.long_name)
+    add(connection, [{'id': target.id, 'subject': target.subject, 'body': target.body, 'sender': target.sender,
+                      'attachments': names}])
+
+
+def _after_delete(mapper, connection, target):
+    if _indexed(mapper, connection):
+        remove(connection, [target.id])
+
+
+def phrase(words):
+    """FTS5 query matching words as a phrase, whatever characters they contain"""
+    return '"%s"' % words.replace('"', '""')
+
+
+def search(session, query, limit=20, offset=0, raw=False):
+    """Returns the SearchHit of the messages matching query, best first.
+    query is a phrase unless raw is set, in which case it uses the FTS5 query syntax
+    (e.g. 'subject:invoice AND body:"wire transfer"', 'passw*').
+    The snippet shows the matching part of the body, matches between [ and ].
+    """
+    if not raw:
+        query = phrase(query)
+    rows = session.execute(text(
+        "SELECT rowid, rank, subject, sender, snippet(%s, 1, '[', ']', '...', 16) FROM %s "
+        "WHERE %s MATCH :query ORDER BY rank LIMIT :limit OFFSET :offset" % (FTS_TABLE, FTS_TABLE, FTS_TABLE)),
+        {'query': query, 'limit': limit, 'offset': offset})
+    # bm25 is negative, lower is better
+    return [SearchHit(rowid, -rank, subject, sender, snippet) for rowid, rank, subject, sender, snippet in rows]
+
+
+def count(session, query, raw=False):
+    """Number of messages matching query (see search)"""
+    if not raw:
+        query = phrase(query)
+    return session.execute(text("SELECT count(*) FROM %s WHERE %s MATCH :query" % (FTS_TABLE, FTS_TABLE)),
+                           {'query': query}).scalar()
+
+
+if __name__ == "__main__":
+    import argparse
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    parser = argparse.ArgumentParser(description="Search the analyzed messages")
+    parser.add_argument("query", nargs="?")
+    parser.add_argument("--database", default="sqlite:///db.sqlite", help="SQLAlchemy URL (default: %(default)s)")
+    parser.add_argument("--raw", action="store_true", help="query uses the FTS5 syntax rather than being a phrase")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--rebuild", action="store_true", help="index all the messages again")
+    args = parser.parse_args()
+
+    engine = create_engine(args.database)
+    EmailAnalyzer.Base.metadata.create_all(engine)
+    if install(engine) and args.rebuild:
+        with engine.begin() as connection:
+            rebuild(connection)
+    if args.query:
+        session = sessionmaker(bind=engine)()
+        for hit in search(session, args.query, limit=args.limit, raw=args.raw):
+            print("%6d %7.2f  %s | %s\n        %s" % (hit.message_id, hit.score, hit.sender, hit.subject,
+                                                    (hit.snippet or '').replace('\r', '').replace('\n', ' ')))
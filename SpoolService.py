@@ -0,0 +1,409 @@
+"""
+SpoolService:
+    Continuous ingestion of the .msg files dropped in a spool directory
+
+The spool is polled, files that were not modified for `settle` seconds are
+put in a bounded asyncio queue and analyzed by a pool of processes (see
+MessageAnalysis.analyze_file).  Results are persisted in batches by a single
+writer thread, which is the only one to use the database session.  When the
+workers can not keep up, the queue fills and the scanner waits: a flood of
+reports delays the ingestion instead of exhausting memory.  A file still in
+analysis WATCHDOG_GRACE seconds past its time limit has the pool killed and is
+quarantined, files whose worker died are analyzed again in a new pool.
+
+    python SpoolService.py SPOOL_DIR [--workers N] [--queue-size N] ...
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import fnmatch
+import functools
+import logging
+import os
+import shutil
+import time
+
+import EmailAnalyzer
+import Instrumentation
+from HeaderAnalyzer import HeaderAnalyzer, DEFAULT_INTERNAL_DOMAIN
+from MessageAnalysis import BlobStore, analyze_file, timed_out, WATCHDOG_GRACE
+from ExtractMsg import FileLimits
+
+_STOP = object()
+# Analyses of a file whose worker process died before it is recorded as failed
+MAX_ATTEMPTS = 3
+
+
+class SpoolStats(object):
+    """Counters of a running service, the latency being the time from the file being queued to its
+    analysis being committed, over the last `window` files.
+    """
+    def __init__(self, window=1000):
+        self.queued = 0
+        self.stored = 0
+        self.failed = 0
+        self.quarantined = 0
+        self.in_flight = 0
+        self.pending_writes = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.started = time.time()
+
+    def latency(self, percentile):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))]
+
+    def as_dict(self, queue_depth):
+        elapsed = time.time() - self.started
+        return {
+            'queue_depth': queue_depth,
+            'in_flight': self.in_flight,
+            'pending_writes': self.pending_writes,
+            'queued': self.queued,
+            'stored': self.stored,
+            'failed': self.failed,
+            'quarantined': self.quarantined,
+            'files_per_second': (self.stored + self.failed + self.quarantined) / elapsed if elapsed else 0.0,
+            'latency_p50': self.latency(50),
+            'latency_p95': self.latency(95),
+            'latency_max': max(self.latencies) if self.latencies else None,
+        }
+
+
+class SpoolService(object):
+    """Watches spool_dir for files matching pattern and ingests them into the database of session.
+    A file is analyzed again when its size or modification time change, processed files are
+    moved to done_dir (or failed_dir) when given, otherwise the manifest (EmailAnalyzer.ProcessedFile)
+    tells which files of the spool were already processed, including across restarts.
+    Files beyond file_limits (see MessageAnalysis.analyze_file) are quarantined: recorded as such in the
+    manifest and moved to quarantine_dir (failed_dir if not given). The time limit is also enforced from
+    outside the analysis: the processes of the executor are killed and a new executor is started.
+    """
+    def __init__(self, spool_dir, session, pattern='*.msg', workers=2, queue_size=100, batch_size=50,
+                 batch_interval=2.0, poll_interval=1.0, settle=1.0, done_dir=None, failed_dir=None,
+                 blob_store=None, header_analyzer=None, metrics=None, report_interval=60.0, executor=None,
+                 nested_limits=None, file_limits=None, quarantine_dir=None):
+        self.spool_dir = os.path.abspath(spool_dir)
+        self.session = session
+        self.pattern = pattern
+        self.workers = workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.done_dir = done_dir
+        self.failed_dir = failed_dir
+        self.quarantine_dir = quarantine_dir if quarantine_dir is not None else failed_dir
+        self.metrics = metrics
+        self.report_interval = report_interval
+        self.analyze = functools.partial(analyze_file, blob_store=blob_store,
+                                         header_analyzer=header_analyzer, instrument=metrics is not None,
+                                         nested_limits=nested_limits, file_limits=file_limits,
+                                         known_inspections=EmailAnalyzer.inspection_lookup(session))
+        self.executor = executor
+        self._own_executor = False
+        self.max_seconds = FileLimits(**(file_limits or {})).maxSeconds
+        self.stats = SpoolStats()
+        self._seen = {}  # path -> (size, mtime) of the version queued or processed
+        self._known = set()  # paths in the manifest, only used by the database thread
+        self._queue = None
+        self._results = None
+        self._stopping = None
+
+    # --- Scanning -------------------------------------------------------------
+
+    def _load_manifest(self):
+        """Runs in the database thread, returns the versions of the spool files already processed"""
+        seen = {}
+        prefix = self.spool_dir + os.sep
+        for entry in self.session.query(EmailAnalyzer.ProcessedFile).filter(
+                EmailAnalyzer.ProcessedFile.path.startswith(prefix)):
+            seen[entry.path] = (entry.size, entry.mtime)
+            self._known.add(entry.path)
+        self.session.expunge_all()
+        return seen
+
+    def scan(self):
+        """Paths of the files of the spool that are ready to be analyzed"""
+        ready = []
+        present = set()
+        now = time.time()
+        for entry in os.scandir(self.spool_dir):
+            if not entry.is_file() or not fnmatch.fnmatch(entry.name, self.pattern):
+                continue
+            path = entry.path
+            present.add(path)
+            stat = entry.stat()
+            version = (stat.st_size, stat.st_mtime)
+            if self._seen.get(path) == version:
+                continue
+            if now - stat.st_mtime < self.settle:
+                # Probably still being written
+                continue
+            self._seen[path] = version
+            ready.append(path)
+        # Forget the files that left the spool
+        for path in [path for path in self._seen if path not in present]:
+            del self._seen[path]
+        ready.sort()
+        return ready
+
+    async def _watch(self):
+        while not self._stopping.is_set():
+            for path in self.scan():
+                # Waits when the queue is full
+                await self._queue.put((path, time.time()))
+                self.stats.queued += 1
+                if self._stopping.is_set():
+                    break
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    # --- Analysis -------------------------------------------------------------
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                path, queued_at = item
+                self.stats.in_flight += 1
+                try:
+                    result = await self._analyze(loop, path)
+                finally:
+                    self.stats.in_flight -= 1
+                self.stats.pending_writes += 1
+                await self._results.put((result, queued_at))
+            finally:
+                self._queue.task_done()
+
+    async def _analyze(self, loop, path):
+        timeout = self.max_seconds + WATCHDOG_GRACE if self.max_seconds is not None else None
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            executor = self.executor
+            try:
+                return await asyncio.wait_for(loop.run_in_executor(executor, self.analyze, path), timeout)
+            except asyncio.TimeoutError:
+                # Its worker can not be interrupted, the files analyzed next to it are analyzed again
+                self._restart_executor(executor, kill=True)
+                return timed_out(path, self.max_seconds)
+            except concurrent.futures.BrokenExecutor as e:
+                # A worker died (killed above, out of memory...), with every file in analysis
+                self._restart_executor(executor)
+                if attempt < MAX_ATTEMPTS:
+                    logging.warning("Worker lost while analyzing %s, analyzing it again" % path)
+                    continue
+                logging.error("Could not analyze %s, its worker died %d times" % (path, attempt))
+                return (path, None, None, "%s: %s" % (type(e).__name__, e), None)
+            except Exception as e:
+                # analyze_file handles analysis errors, this is the executor failing
+                logging.exception("Could not analyze %s" % path)
+                return (path, None, None, "%s: %s" % (type(e).__name__, e), None)
+
+    def _restart_executor(self, executor, kill=False):
+        """Replaces executor, unless another worker already did"""
+        if executor is not self.executor:
+            return
+        if kill:
+            # ProcessPoolExecutor has no public way to stop a running task
+            processes = getattr(executor, '_processes', None) or {}
+            for process in list(processes.values()):
+                process.terminate()
+        executor.shutdown(wait=False)
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        self._own_executor = True
+
+    # --- Persistence ----------------------------------------------------------
+
+    async def _write(self, db_executor):
+        loop = asyncio.get_running_loop()
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if not batch else max(0.0, deadline - loop.time())
+            try:
+                item = await asyncio.wait_for(self._results.get(), timeout)
+            except asyncio.TimeoutError:
+                item = None
+            if item is not None and item is not _STOP:
+                batch.append(item)
+                if len(batch) == 1:
+                    deadline = loop.time() + self.batch_interval
+            if batch and (item is _STOP or len(batch) >= self.batch_size or loop.time() >= deadline):
+                committed = await loop.run_in_executor(db_executor, self._persist, batch)
+                now = time.time()
+                for (path, signature, msg, error, record), queued_at in batch:
+                    if not committed:
+                        # Queued again at the next scan
+                        self._seen.pop(path, None)
+                    elif EmailAnalyzer.file_status(msg, error) == EmailAnalyzer.QUARANTINED:
+                        self.stats.quarantined += 1
+                    elif msg is None:
+                        self.stats.failed += 1
+                    else:
+                        self.stats.stored += 1
+                    if committed:
+                        self.stats.latencies.append(now - queued_at)
+                self.stats.pending_writes -= len(batch)
+                batch = []
+            if item is _STOP:
+                return
+
+    def _persist(self, batch):
+        """Runs in the database thread, returns False if the batch could not be committed"""
+        with Instrumentation.use(self.metrics):
+            writer = EmailAnalyzer.BulkWriter(self.session, batch_size=len(batch) + 1)
+            moves = []
+            try:
+                for (path, signature, msg, error, record), queued_at in batch:
+                    if record is not None:
+                        self.metrics.addFile(record)
+                    with Instrumentation.timer('registry'):
+                        entry = EmailAnalyzer.persist_result(self.session, self._known, path, signature, msg,
+                                                             error, self._registry, self._url_registry,
+                                                             self._campaign_registry)
+                    writer.add(entry)
+                    status = EmailAnalyzer.file_status(msg, error)
+                    if status == EmailAnalyzer.QUARANTINED:
+                        target = self.quarantine_dir
+                    else:
+                        target = self.failed_dir if msg is None else self.done_dir
+                    if target is not None:
+                        moves.append((path, target))
+                writer.flush()
+            except Exception:
+                logging.exception("Could not persist a batch of %d files, they will be retried" % len(batch))
+                self.session.rollback()
+                self.session.expunge_all()
+                # Registries may know rows that were rolled back
+                self._registry = EmailAnalyzer.ContentRegistry(self.session)
+                self._url_registry = EmailAnalyzer.UrlRegistry(self.session)
+                self._campaign_registry = EmailAnalyzer.CampaignRegistry(self.session)
+                return False
+        for (path, signature, msg, error, record), queued_at in batch:
+            self._known.add(path)
+        for path, target in moves:
+            try:
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                shutil.move(path, os.path.join(target, os.path.basename(path)))
+            except (IOError, OSError):
+                logging.exception("Could not move %s to %s" % (path, target))
+        return True
+
+    # --- Service --------------------------------------------------------------
+
+    def status(self):
+        """Queue depth, files being analyzed or waiting to be committed, counters and latencies"""
+        return self.stats.as_dict(self._queue.qsize() if self._queue is not None else 0)
+
+    async def _report(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.report_interval)
+            except asyncio.TimeoutError:
+                pass
+            status = self.status()
+            logging.info("Spool: %(queue_depth)d queued, %(in_flight)d in analysis, %(pending_writes)d to commit, "
+                         "%(stored)d stored, %(failed)d failed, %(quarantined)d quarantined, "
+                         "%(files_per_second).1f files/s, p95 latency %(latency_p95)s s" % status)
+
+    def stop(self):
+        """Asks the service to stop once the files already queued are processed"""
+        if self._stopping is not None:
+            self._stopping.set()
+
+    async def run(self):
+        """Runs until stop() is called"""
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        # Bounded as well so that slow commits also hold back the workers
+        self._results = asyncio.Queue(maxsize=max(self.batch_size, self.workers) * 2)
+        self._stopping = asyncio.Event()
+        self._registry = EmailAnalyzer.ContentRegistry(self.session)
+        self._url_registry = EmailAnalyzer.UrlRegistry(self.session)
+        self._campaign_registry = EmailAnalyzer.CampaignRegistry(self.session)
+        was_enabled = Instrumentation.enabled()
+        if self.metrics is not None:
+            Instrumentation.enable()
+        self._own_executor = self.executor is None
+        if self._own_executor:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        loop = asyncio.get_running_loop()
+        try:
+            self._seen.update(await loop.run_in_executor(db_executor, self._load_manifest))
+            workers = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+            writer = asyncio.ensure_future(self._write(db_executor))
+            reporter = asyncio.ensure_future(self._report())
+            await self._watch()
+            # Drain: every worker stops after the files queued before it
+            for _ in workers:
+                await self._queue.put(_STOP)
+            await asyncio.gather(*workers)
+            await self._results.put(_STOP)
+            await writer
+            await reporter
+        finally:
+            Instrumentation.enable(was_enabled)
+            db_executor.shutdown()
+            if self._own_executor:
+                self.executor.shutdown()
+                self.executor = None
+
+
+if __name__ == "__main__":
+    import argparse
+    import signal
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import SearchIndex
+
+    parser = argparse.ArgumentParser(description="Ingest the .msg files dropped in a spool directory")
+    parser.add_argument("spool", help="directory to watch")
+    parser.add_argument("--pattern", default="*.msg")
+    parser.add_argument("--database", default="sqlite:///db.sqlite", help="SQLAlchemy URL (default: %(default)s)")
+    parser.add_argument("-w", "--workers", type=int, default=2, help="analysis processes (default: 2)")
+    parser.add_argument("--queue-size", type=int, default=100, help="files waiting for a worker at most")
+    parser.add_argument("--batch-size", type=int, default=50, help="files committed at once")
+    parser.add_argument("--batch-interval", type=float, default=2.0, help="seconds a result waits for its batch at most")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between two scans of the spool")
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds a file must be left unmodified")
+    parser.add_argument("--done-dir", help="move analyzed files there")
+    parser.add_argument("--failed-dir", help="move the files that could not be analyzed there")
+    parser.add_argument("--quarantine-dir", help="move the files beyond the per-file limits there "
+                                                 "(default: --failed-dir)")
+    parser.add_argument("--blob-store", help="directory where attachment payloads are stored, once per SHA-1")
+    parser.add_argument("--internal-domain", default=DEFAULT_INTERNAL_DOMAIN)
+    parser.add_argument("--report-interval", type=float, default=60.0, help="seconds between two status logs")
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level))
+    engine = create_engine(args.database)
+    EmailAnalyzer.Base.metadata.create_all(engine)
+    SearchIndex.install(engine)
+    session = sessionmaker(bind=engine)()
+    service = SpoolService(
+        args.spool, session, pattern=args.pattern, workers=args.workers, queue_size=args.queue_size,
+        batch_size=args.batch_size, batch_interval=args.batch_interval, poll_interval=args.poll_interval,
+        settle=args.settle, done_dir=args.done_dir, failed_dir=args.failed_dir, quarantine_dir=args.quarantine_dir,
+        blob_store=BlobStore(args.blob_store) if args.blob_store else None,
+        header_analyzer=HeaderAnalyzer(args.internal_domain), report_interval=args.report_interval)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, service.stop)
+            except (NotImplementedError, RuntimeError):  # Windows
+                pass
+        await service.run()
+
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+"""
+UrlExtractor:
+    Linear time extraction of the URLs of a message body
+
+Handles plain text bodies, HTML (href="...", &amp; entities) and the text
+Outlook derives from RTF bodies, where links read "text <http://...>" and may
+be wrapped over several lines inside the angle brackets.
+"""
+
+import re
+
+try:  # Python 3
+    from urllib.parse import urlsplit, urlunsplit
+except ImportError:  # Python 2
+    from urlparse import urlsplit, urlunsplit
+
+# Either a URL between angle brackets, which may contain line breaks, or a
+# bare URL ending at the first whitespace, quote or bracket.  Both character
+# classes stop at '<' so every character is scanned a bounded number of times.
+_URL = re.compile(r'<((?i:https?)://[^<>]*)>|((?i:https?)://[^\s<>"\']+)')
+_TRAILING = '.,;:!?\'"]}'
+
+
+def normalize_url(url):
+    """Lower-cases the scheme and host of url, removes a trailing dot from the host
+    and gives an empty path the value '/'. Returns None if url has no host.
+    """
+    url = url.replace('&amp;', '&')
+    try:
+        parts = urlsplit(url)
+        host = parts.hostname
+        port = parts.port
+    except ValueError:
+        return None
+    if not host:
+        return None
+    host = host.rstrip('.')
+    if ':' in host:
+        # IPv6 address
+        host = '[%s]' % host
+    if port is not None:
+        host = '%s:%d' % (host, port)
+    userinfo = parts.netloc.rpartition('@')[0]
+    netloc = userinfo + '@' + host if userinfo else host
+    return urlunsplit((parts.scheme.lower(), netloc, parts.path or '/', parts.query, parts.fragment))
+
+
+def host_of(url):
+    """Host name of a normalized url"""
+    try:
+        host = urlsplit(url).hostname
+    except ValueError:
+        return None
+    if host:
+        host = host.rstrip('.')
+    return host
+
+
+def extract_urls(text):
+    """Returns the distinct normalized URLs of text, in order of appearance"""
+    urls = []
+    if not text:
+        return urls
+    seen = set()
+    for bracketed, bare in _URL.findall(text):
+        if bracketed:
+            # Wrapped over several lines
+            url = ''.join(bracketed.split())
+        else:
+            url = bare.rstrip(_TRAILING)
+            # Closing parenthesis of the surrounding text, not of the URL
+            unbalanced = url.count(')') - url.count('(')
+            end = len(url)
+            while unbalanced > 0 and end and url[end - 1] == ')':
+                end -= 1
+                unbalanced -= 1
+                while end and url[end - 1] in _TRAILING:
+                    end -= 1
+            url = url[:end]
+        url = normalize_url(url)
+        if url is not None and url not in seen:
+            seen.add(url)
+            urls.append(url)
+    return urls
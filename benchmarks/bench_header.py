@@ -0,0 +1,71 @@
+"""
+Microbenchmark of the header analysis: the former EmailAnalyzer regexes
+(one DOTALL findall per item plus a findall per SPF match) against
+HeaderAnalyzer, on headers with growing Received chains.  The last column
+also extracts the Received chain, which HeaderAnalyzer only parses on demand.
+
+    python benchmarks/bench_header.py [--repeat N]
+"""
+
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from HeaderAnalyzer import HeaderAnalyzer
+
+
+def legacy_analyze(header):
+    spfs = re.findall("Received-SPF: (Pass|None) (\\(.*?\\.MYDOMAIN\\.fr: .*?\\))", header, flags=re.MULTILINE | re.DOTALL)
+    senders = []
+    for spf in spfs:
+        senders += re.findall("\\S*?@[^) ]*", spf[1])
+    envelope_from = list(set(re.findall("envelope-from=\"(.*?)\"", header, flags=re.MULTILINE | re.DOTALL)))
+    x_sender = list(set(re.findall("x-sender=\"(.*?)\"", header, flags=re.MULTILINE | re.DOTALL)))
+    internal = "Received-SPF" not in header
+    return spfs, list(set(senders)), envelope_from, x_sender, internal
+
+
+def make_header(received):
+    lines = []
+    for i in range(received):
+        lines.append("Received: from relay%d.example.net (relay%d.example.net [192.0.2.%d])\r\n"
+                     "\tby relay%d.example.org (Postfix) with ESMTPS id %08X\r\n"
+                     "\tfor <victim@MYDOMAIN.fr>; Mon, 1 Jan 2018 10:%02d:00 +0100" % (i, i, i % 250, i + 1, i, i % 60))
+    lines.append("Received-SPF: Pass (mx1.MYDOMAIN.fr: domain of bob@evil.com designates 192.0.2.1 as\r\n"
+                 " permitted sender) identity=mailfrom; client-ip=192.0.2.1;\r\n"
+                 " receiver=mx1.MYDOMAIN.fr; envelope-from=\"bob@evil.com\"; x-sender=\"bob@evil.com\"")
+    lines.append("From: Alice <alice@bank.com>")
+    lines.append("To: victim@MYDOMAIN.fr")
+    lines.append("Subject: Invoice")
+    lines.append("Date: Mon, 1 Jan 2018 10:00:00 +0100")
+    return "\r\n".join(lines) + "\r\n\r\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    analyzer = HeaderAnalyzer()
+    print("%10s %12s %12s %8s %22s" % ("received", "legacy (us)", "engine (us)", "speedup", "with Received (us)"))
+    for received in (1, 10, 50, 200, 1000):
+        header = make_header(received)
+        legacy = legacy_analyze(header)
+        analysis = analyzer.analyze(header)
+        assert sorted(legacy[1]) == sorted(analysis.spf_senders)
+        assert sorted(legacy[2]) == sorted(analysis.envelope_from)
+        assert sorted(legacy[3]) == sorted(analysis.x_sender)
+        assert len(analysis.received) == received
+        legacy_time = min(timeit.repeat(lambda: legacy_analyze(header), number=args.repeat, repeat=3)) / args.repeat
+        engine_time = min(timeit.repeat(lambda: analyzer.analyze(header), number=args.repeat, repeat=3)) / args.repeat
+        chain_time = min(timeit.repeat(lambda: analyzer.analyze(header).received, number=args.repeat, repeat=3)) / args.repeat
+        print("%10d %12.1f %12.1f %7.1fx %22.1f" % (received, legacy_time * 1e6, engine_time * 1e6,
+                                                 legacy_time / engine_time, chain_time * 1e6))
+
+
+if __name__ == "__main__":
+    main()
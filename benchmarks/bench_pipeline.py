@@ -0,0 +1,251 @@
+"""
+End to end benchmark of the analysis pipeline on a synthetic corpus (see
+msggen.py) or on existing .msg files.  Every file goes through the same
+stages as EmailAnalyzer.ingest, timed separately:
+
+    open         OLEMessage: header, FAT and directory index
+    properties   string properties of the top level message
+    attachments  discovery of attachments and nested messages, with their properties
+    hashing      chunked SHA-1 of every attachment payload
+    scoring      EmailAnalyzer.MessageAnalysis: header analysis, URLs and scoring
+    db_insert    ORM objects, registries and batched commits to a scratch SQLite
+                 database, or the same rows through EmailAnalyzer.CoreWriter with
+                 --writer core
+
+The report (per stage totals, throughput and peak memory) is written as
+JSON so runs can be compared:
+
+    python benchmarks/bench_pipeline.py --count 200 --output before.json
+    python benchmarks/bench_pipeline.py --count 200 --compare before.json
+    python benchmarks/bench_pipeline.py --count 200 --writer core --compare before.json
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import msggen
+
+STAGES = ('open', 'properties', 'attachments', 'hashing', 'scoring', 'db_insert')
+
+
+class StageTimer(object):
+    def __init__(self, trace_memory=False):
+        self.seconds = dict((stage, 0.0) for stage in STAGES)
+        self.peak = dict((stage, 0) for stage in STAGES)
+        self.trace_memory = trace_memory
+        self._stage = None
+
+    def start(self, stage):
+        self._stage = stage
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        self._start = time.perf_counter()
+
+    def stop(self):
+        self.seconds[self._stage] += time.perf_counter() - self._start
+        if self.trace_memory:
+            self.peak[self._stage] = max(self.peak[self._stage], tracemalloc.get_traced_memory()[1])
+
+
+def walk(parser):
+    """Attachments of parser and of its nested messages"""
+    from ExtractMsg import Message as MessageParser
+    attachments = []
+    stack = [parser]
+    while stack:
+        message = stack.pop()
+        for attachment in message.attachments:
+            if isinstance(attachment, MessageParser):
+                read_properties(attachment)
+                stack.append(attachment)
+            else:
+                attachments.append(attachment)
+    return attachments
+
+
+def read_properties(parser):
+    parser.snapshot()
+    return (parser.subject, parser.body, parser.headerStr, parser.sender, parser.to, parser.cc, parser.parsedDate)
+
+
+def run(paths, batch_size=500, trace_memory=False, writer_type='orm'):
+    from ExtractMsg import Message as MessageParser
+    import EmailAnalyzer
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    # Scoring logs every forged sender, which would dominate the timings
+    logging.getLogger().setLevel(logging.ERROR)
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    engine = create_engine('sqlite:///%s' % os.path.join(workdir, 'bench.sqlite'))
+    EmailAnalyzer.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    if writer_type == 'core':
+        writer = EmailAnalyzer.CoreWriter(session, batch_size=batch_size)
+    else:
+        writer = EmailAnalyzer.BulkWriter(session, batch_size=batch_size)
+        registry = EmailAnalyzer.ContentRegistry(session)
+        url_registry = EmailAnalyzer.UrlRegistry(session)
+        campaign_registry = EmailAnalyzer.CampaignRegistry(session)
+    timer = StageTimer(trace_memory)
+    if trace_memory:
+        tracemalloc.start()
+    total_bytes = 0
+    attachment_count = 0
+    failed = 0
+    start = time.perf_counter()
+    try:
+        for path in paths:
+            total_bytes += os.path.getsize(path)
+            try:
+                timer.start('open')
+                parser = MessageParser(path)
+                timer.stop()
+
+                timer.start('properties')
+                read_properties(parser)
+                timer.stop()
+
+                timer.start('attachments')
+                attachments = walk(parser)
+                timer.stop()
+
+                timer.start('hashing')
+                for attachment in attachments:
+                    attachment.sha1
+                timer.stop()
+                attachment_count += len(attachments)
+
+                timer.start('scoring')
+                analysis = EmailAnalyzer.MessageAnalysis(parser)
+                parser.oleMessage.close()
+                timer.stop()
+            except Exception:
+                logging.exception("%s can not be analyzed" % path)
+                failed += 1
+                continue
+
+            timer.start('db_insert')
+            if writer_type == 'core':
+                writer.add(path, None, analysis, None)
+            else:
+                msg = EmailAnalyzer.Message(analysis=analysis)
+                registry.register(msg)
+                url_registry.register(msg)
+                campaign_registry.register(msg)
+                writer.add(msg)
+            timer.stop()
+        timer.start('db_insert')
+        writer.close()
+        timer.stop()
+    finally:
+        elapsed = time.perf_counter() - start
+        if trace_memory:
+            tracemalloc.stop()
+        session.close()
+        engine.dispose()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'files': len(paths),
+        'writer': writer_type,
+        'failed': failed,
+        'attachments': attachment_count,
+        'bytes': total_bytes,
+        'seconds': elapsed,
+        'throughput': {
+            'files_per_second': len(paths) / elapsed if elapsed else 0.0,
+            'mb_per_second': total_bytes / 1048576.0 / elapsed if elapsed else 0.0,
+            'db_rows_per_second': writer.rows_per_second,
+        },
+        'stages': dict((stage, {
+            'seconds': timer.seconds[stage],
+            'ms_per_file': timer.seconds[stage] * 1000.0 / len(paths) if paths else 0.0,
+        }) for stage in STAGES),
+        'peak_memory': {},
+    }
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, kilobytes elsewhere
+        report['peak_memory']['max_rss_bytes'] = maxrss if sys.platform == 'darwin' else maxrss * 1024
+    if trace_memory:
+        report['peak_memory']['traced_bytes_per_stage'] = timer.peak
+    return report
+
+
+def compare(report, baseline):
+    print("%-12s %12s %12s %8s" % ("stage", "baseline ms", "current ms", "ratio"))
+    for stage in STAGES:
+        old = baseline['stages'][stage]['ms_per_file']
+        new = report['stages'][stage]['ms_per_file']
+        print("%-12s %12.3f %12.3f %7.2fx" % (stage, old, new, old / new if new else float('inf')))
+    old = baseline['throughput']['files_per_second']
+    new = report['throughput']['files_per_second']
+    print("%-12s %12.1f %12.1f %7.2fx  files/s" % ("total", old, new, new / old if old else float('inf')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--corpus", help="existing .msg files to use (glob pattern) instead of a generated corpus")
+    parser.add_argument("--keep", help="generate the corpus in this directory and keep it")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--writer", choices=('orm', 'core'), default='orm',
+                        help="persist with ORM objects (as ingest does by default) or EmailAnalyzer.CoreWriter")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="also report the peak of Python allocations per stage (slower)")
+    parser.add_argument("--output", help="write the JSON report to this file rather than to stdout")
+    parser.add_argument("--compare", help="JSON report of a previous run to compare with")
+    msggen.add_corpus_arguments(parser)
+    args = parser.parse_args()
+
+    directory = None
+    if args.corpus:
+        paths = sorted(glob.glob(args.corpus))
+        corpus = {'pattern': args.corpus}
+    else:
+        directory = args.keep or tempfile.mkdtemp(prefix='corpus-')
+        corpus = msggen.corpus_options(args)
+        paths = msggen.generate_corpus(directory, **corpus)
+    try:
+        report = run(paths, batch_size=args.batch_size, trace_memory=args.tracemalloc, writer_type=args.writer)
+    finally:
+        if directory is not None and not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+    report['corpus'] = corpus
+    report['environment'] = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    elif not args.compare:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
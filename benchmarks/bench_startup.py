@@ -0,0 +1,105 @@
+"""
+Startup benchmark of the command line (MsgAnalyzer.py) on a single generated
+message (see msggen.py): median wall time of each command run as a new
+process, next to the time of an empty interpreter, and whether the command
+loaded SQLAlchemy or imapclient.
+
+    python benchmarks/bench_startup.py [--repeat 10] [--output startup.json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import msggen
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+CLI = os.path.join(ROOT, 'MsgAnalyzer.py')
+WATCHED = ('sqlalchemy', 'imapclient')
+
+# Runs the command line in the interpreter and reports the watched modules it loaded on exit
+_PROBE = '''
+import atexit, json, runpy, sys
+atexit.register(lambda: sys.stderr.write("\\nLOADED %%s\\n" %% json.dumps([m for m in %r if m in sys.modules])))
+sys.argv = sys.argv[1:]
+sys.path.insert(0, %r)
+runpy.run_path(sys.argv[0], run_name="__main__")
+'''
+
+
+def commands(msg_path, directory):
+    return [
+        ('python', []),
+        ('help', [CLI, '--help']),
+        ('extract', [CLI, 'extract', '--output-dir', os.path.join(directory, 'extract'), msg_path]),
+        ('extract --json', [CLI, 'extract', '--json', msg_path]),
+        ('export', [CLI, 'export', '-o', os.path.join(directory, 'export.jsonl'), msg_path]),
+        ('analyze --analyze-only', [CLI, 'analyze', '--analyze-only', msg_path]),
+        ('analyze', [CLI, 'analyze', '--database', 'sqlite:///' + os.path.join(directory, 'db.sqlite'), '--force',
+                     msg_path]),
+    ]
+
+
+def run(args, directory):
+    if not args:
+        args = ['-c', 'pass']
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                   check=True)
+    return time.perf_counter() - start
+
+
+def loaded(args, directory):
+    if not args:
+        return []
+    probe = _PROBE % (WATCHED, os.path.abspath(ROOT))
+    result = subprocess.run([sys.executable, '-c', probe] + args, cwd=directory, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    for line in result.stderr.splitlines():
+        if line.startswith('LOADED '):
+            return json.loads(line[len('LOADED '):])
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10, help='runs per command (default: %(default)s)')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_startup')
+    try:
+        msg_path = msggen.generate_corpus(directory, count=1)[0]
+        report = {'python': sys.version.split()[0], 'repeat': args.repeat, 'commands': {}}
+        for name, command in commands(msg_path, directory):
+            times = []
+            for i in range(args.repeat):
+                if os.path.isdir(os.path.join(directory, 'extract')):
+                    shutil.rmtree(os.path.join(directory, 'extract'))
+                times.append(run(command, directory))
+            report['commands'][name] = {'median_ms': statistics.median(times) * 1000,
+                                        'min_ms': min(times) * 1000, 'loaded': loaded(command, directory)}
+    finally:
+        shutil.rmtree(directory)
+
+    baseline = report['commands']['python']['median_ms']
+    print('%-24s %10s %10s %10s  %s' % ('command', 'median ms', 'min ms', '+python', 'loaded'))
+    for name, result in report['commands'].items():
+        print('%-24s %10.1f %10.1f %10.1f  %s' % (name, result['median_ms'], result['min_ms'],
+                                                  result['median_ms'] - baseline,
+                                                  ', '.join(result['loaded'] or []) or '-'))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
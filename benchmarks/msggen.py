@@ -0,0 +1,421 @@
+"""
+Synthetic Outlook .msg corpus generator.
+
+Writes OLE2 compound files (MS-CFB version 3, 512 byte sectors) laid out
+like the messages Outlook saves: __substg1.0_* property streams in ASCII
+(001E) or Unicode (001F), a __properties_version1.0 stream with the fixed
+length properties, __attach_version1.0_#* storages and nested messages in
+__substg1.0_3701000D storages.
+
+    python benchmarks/msggen.py OUTPUT_DIR [--count N] [--body-size B] ...
+"""
+
+import argparse
+import datetime
+import os
+import random
+import struct
+
+SECTOR_SIZE = 512
+MINI_SECTOR_SIZE = 64
+MINI_STREAM_CUTOFF = 4096
+
+FREESECT = 0xFFFFFFFF
+ENDOFCHAIN = 0xFFFFFFFE
+FATSECT = 0xFFFFFFFD
+DIFSECT = 0xFFFFFFFC
+NOSTREAM = 0xFFFFFFFF
+
+STGTY_EMPTY = 0
+STGTY_STORAGE = 1
+STGTY_STREAM = 2
+STGTY_ROOT = 5
+
+# MAPI property types
+PT_LONG = 0x0003
+PT_BOOLEAN = 0x000B
+PT_OBJECT = 0x000D
+PT_I8 = 0x0014
+PT_STRING8 = 0x001E
+PT_UNICODE = 0x001F
+PT_SYSTIME = 0x0040
+PT_BINARY = 0x0102
+
+FILETIME_EPOCH = datetime.datetime(1601, 1, 1)
+
+
+# --- Compound file writer -----------------------------------------------------
+
+class _Entry(object):
+    def __init__(self, name, entry_type, data=None):
+        self.name = name
+        self.entry_type = entry_type
+        self.data = data
+        self.kids = []
+        self.sid = None
+        self.left = NOSTREAM
+        self.right = NOSTREAM
+        self.child = NOSTREAM
+        self.start = ENDOFCHAIN
+        self.size = 0 if data is None else len(data)
+
+
+def _build_tree(name, tree, entry_type):
+    entry = _Entry(name, entry_type)
+    for kid_name, value in tree.items():
+        if isinstance(value, dict):
+            entry.kids.append(_build_tree(kid_name, value, STGTY_STORAGE))
+        else:
+            entry.kids.append(_Entry(kid_name, STGTY_STREAM, bytes(value)))
+    # CFB orders siblings by name length first, then by upper-cased name
+    entry.kids.sort(key=lambda e: (len(e.name), e.name.upper()))
+    return entry
+
+
+def _link_siblings(entry):
+    # Balanced binary tree over the sorted children
+    def link(kids):
+        if not kids:
+            return NOSTREAM
+        middle = len(kids) // 2
+        node = kids[middle]
+        node.left = link(kids[:middle])
+        node.right = link(kids[middle + 1:])
+        return node.sid
+    entry.child = link(entry.kids)
+    for kid in entry.kids:
+        _link_siblings(kid)
+
+
+def _pack_entry(entry):
+    if entry is None:
+        return (b'\x00' * 64 + struct.pack('<HBB3I', 0, STGTY_EMPTY, 0, NOSTREAM, NOSTREAM, NOSTREAM) +
+                b'\x00' * 36 + struct.pack('<IQ', 0, 0))
+    name = entry.name.encode('utf_16_le')
+    if len(name) > 62:
+        raise ValueError("entry name too long: %r" % entry.name)
+    return (name.ljust(64, b'\x00') +
+            struct.pack('<HBB3I', len(name) + 2, entry.entry_type, 1, entry.left, entry.right, entry.child) +
+            b'\x00' * 36 +
+            struct.pack('<IQ', entry.start, entry.size))
+
+
+def _chain(fat, first, count):
+    for i in range(count - 1):
+        fat[first + i] = first + i + 1
+    fat[first + count - 1] = ENDOFCHAIN
+
+
+def write_compound_file(f, tree):
+    """Writes tree (nested dicts of storage name -> dict or stream bytes) as an OLE2 compound file to
+    the binary file object f.
+    """
+    root = _build_tree('Root Entry', tree, STGTY_ROOT)
+    entries = []
+    stack = [root]
+    while stack:
+        entry = stack.pop()
+        entry.sid = len(entries)
+        entries.append(entry)
+        stack.extend(reversed(entry.kids))
+    _link_siblings(root)
+
+    # Small streams go to the ministream, large ones to regular sectors
+    ministream = bytearray()
+    minifat = []
+    big_streams = []
+    for entry in entries:
+        if entry.entry_type != STGTY_STREAM or entry.size == 0:
+            continue
+        if entry.size < MINI_STREAM_CUTOFF:
+            count = (entry.size + MINI_SECTOR_SIZE - 1) // MINI_SECTOR_SIZE
+            entry.start = len(minifat)
+            minifat.extend(range(entry.start + 1, entry.start + count))
+            minifat.append(ENDOFCHAIN)
+            ministream += entry.data.ljust(count * MINI_SECTOR_SIZE, b'\x00')
+        else:
+            big_streams.append(entry)
+
+    per_sector = SECTOR_SIZE // 4
+    n_dir = (len(entries) + 3) // 4
+    n_minifat = (len(minifat) + per_sector - 1) // per_sector
+    n_ministream = (len(ministream) + SECTOR_SIZE - 1) // SECTOR_SIZE
+    n_data = sum((e.size + SECTOR_SIZE - 1) // SECTOR_SIZE for e in big_streams)
+    payload = n_dir + n_minifat + n_ministream + n_data
+
+    # FAT and DIFAT sectors must also be described by the FAT
+    n_fat = 1
+    while True:
+        n_difat = max(0, (n_fat - 109 + 126) // 127)
+        needed = (payload + n_fat + n_difat + per_sector - 1) // per_sector
+        if needed <= n_fat:
+            break
+        n_fat = needed
+
+    fat = [FREESECT] * (n_fat * per_sector)
+    sect = 0
+    fat_sects = list(range(sect, sect + n_fat))
+    for s in fat_sects:
+        fat[s] = FATSECT
+    sect += n_fat
+    difat_sects = list(range(sect, sect + n_difat))
+    for s in difat_sects:
+        fat[s] = DIFSECT
+    sect += n_difat
+    first_dir = sect
+    _chain(fat, sect, n_dir)
+    sect += n_dir
+    first_minifat = ENDOFCHAIN
+    if n_minifat:
+        first_minifat = sect
+        _chain(fat, sect, n_minifat)
+        sect += n_minifat
+    if n_ministream:
+        root.start = sect
+        root.size = len(ministream)
+        _chain(fat, sect, n_ministream)
+        sect += n_ministream
+    for entry in big_streams:
+        count = (entry.size + SECTOR_SIZE - 1) // SECTOR_SIZE
+        entry.start = sect
+        _chain(fat, sect, count)
+        sect += count
+
+    header = struct.pack(
+        '<8s16sHHHHH6sIIIIIIIII',
+        b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', b'\x00' * 16,
+        0x003E, 0x0003, 0xFFFE, 9, 6, b'\x00' * 6,
+        0, n_fat, first_dir, 0, MINI_STREAM_CUTOFF,
+        first_minifat, n_minifat,
+        difat_sects[0] if difat_sects else ENDOFCHAIN, n_difat)
+    header += struct.pack('<109I', *(fat_sects[:109] + [FREESECT] * (109 - min(109, n_fat))))
+
+    f.write(header)
+    f.write(struct.pack('<%dI' % len(fat), *fat))
+    rest = fat_sects[109:]
+    for i in range(n_difat):
+        chunk = rest[i * 127:(i + 1) * 127]
+        chunk += [FREESECT] * (127 - len(chunk))
+        next_sect = difat_sects[i + 1] if i + 1 < n_difat else ENDOFCHAIN
+        f.write(struct.pack('<128I', *(chunk + [next_sect])))
+    f.write(b''.join(_pack_entry(e) for e in entries))
+    f.write(_pack_entry(None) * (n_dir * 4 - len(entries)))
+    if n_minifat:
+        padded = minifat + [FREESECT] * (n_minifat * per_sector - len(minifat))
+        f.write(struct.pack('<%dI' % len(padded), *padded))
+    if n_ministream:
+        f.write(bytes(ministream.ljust(n_ministream * SECTOR_SIZE, b'\x00')))
+    for entry in big_streams:
+        count = (entry.size + SECTOR_SIZE - 1) // SECTOR_SIZE
+        f.write(entry.data.ljust(count * SECTOR_SIZE, b'\x00'))
+
+
+# --- .msg layout --------------------------------------------------------------
+
+def filetime(date):
+    delta = date - FILETIME_EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10000000 + delta.microseconds * 10
+
+
+def _property_entries(streams, fixed):
+    """16 byte entries of __properties_version1.0: the fixed length properties
+    (tag, value) and the size of every variable length property stream
+    """
+    entries = []
+    for tag, value in fixed:
+        prop_type = tag & 0xFFFF
+        if prop_type == PT_SYSTIME or prop_type == PT_I8:
+            raw = struct.pack('<Q', value)
+        else:
+            raw = struct.pack('<I', value) + b'\x00' * 4
+        entries.append(struct.pack('<II', tag, 0x06) + raw)
+    for name, data in sorted(streams.items()):
+        if name.startswith('__substg1.0_') and not isinstance(data, dict):
+            tag = int(name[12:16], 16) << 16 | int(name[16:20], 16)
+            entries.append(struct.pack('<IIII', tag, 0x06, len(data), 0))
+    return b''.join(entries)
+
+
+def string_property(streams, prop_id, value, unicode=True):
+    if unicode:
+        streams['__substg1.0_%s001F' % prop_id] = value.encode('utf_16_le')
+    else:
+        streams['__substg1.0_%s001E' % prop_id] = value.encode('cp1252', 'replace')
+
+
+def build_attachment(name, data, unicode=True):
+    streams = {}
+    string_property(streams, '3707', name, unicode)
+    string_property(streams, '3704', name[:8], False)
+    streams['__substg1.0_37010102'] = data
+    fixed = [(0x0E200003, len(data)), (0x37050003, 1)]  # PR_ATTACH_SIZE, PR_ATTACH_METHOD by value
+    streams['__properties_version1.0'] = b'\x00' * 8 + _property_entries(streams, fixed)
+    return streams
+
+
+def build_message(subject, body, header, sender_name, sender_email, to, date,
+                  attachments=(), nested=None, unicode=True, embedded=False):
+    """Returns the tree of a message for write_compound_file.
+    attachments are (name, data) pairs, nested the tree of an embedded message (see embedded=True).
+    """
+    streams = {}
+    string_property(streams, '0037', subject, unicode)
+    string_property(streams, '1000', body, unicode)
+    string_property(streams, '007D', header, unicode)
+    string_property(streams, '0C1A', sender_name, unicode)
+    string_property(streams, '0C1F', sender_email, unicode)
+    string_property(streams, '0E04', to, unicode)
+    string_property(streams, '001A', 'IPM.Note', unicode)
+    index = 0
+    for name, data in attachments:
+        streams['__attach_version1.0_#%08X' % index] = build_attachment(name, data, unicode)
+        index += 1
+    if nested is not None:
+        storage = {'__substg1.0_3701000D': nested}
+        string_property(storage, '3707', 'forwarded.msg', unicode)
+        storage['__properties_version1.0'] = b'\x00' * 8 + _property_entries(
+            storage, [(0x0E200003, 0), (0x37050003, 5)])  # embedded message
+        streams['__attach_version1.0_#%08X' % index] = storage
+        index += 1
+    fixed = [
+        (0x0E070003, 0x01),  # PR_MESSAGE_FLAGS: read
+        (0x00390040, filetime(date)),  # PR_CLIENT_SUBMIT_TIME
+        (0x0E060040, filetime(date + datetime.timedelta(seconds=3))),  # PR_MESSAGE_DELIVERY_TIME
+        (0x0E080003, len(body) + sum(len(data) for name, data in attachments)),  # PR_MESSAGE_SIZE
+    ]
+    # Next recipient id, next attachment id, recipient count, attachment count
+    prefix = struct.pack('<8sIIII', b'', 0, index, 0, index)
+    if not embedded:
+        prefix += b'\x00' * 8
+    streams['__properties_version1.0'] = prefix + _property_entries(streams, fixed)
+    return streams
+
+
+# --- Corpus -------------------------------------------------------------------
+
+WORDS = ("invoice payment account password verify urgent please click review document attached "
+         "bank transfer confirm security update delivery order reference customer service "
+         "meeting report quarterly budget approval signature contract").split()
+NON_ASCII_WORDS = u"façture réglement sécurité échéance Grüße €".split()
+RISKY_NAMES = ("invoice.exe", "scan.zip", "document.docm", "report.pdf", "update.js", "notes.txt", "photo.jpg")
+
+
+def make_header(rng, received, sender_email, spf_domain='MYDOMAIN.fr', date=None):
+    lines = []
+    for i in range(received):
+        lines.append("Received: from relay%d.example.net (relay%d.example.net [192.0.2.%d])\r\n"
+                     "\tby relay%d.example.org with ESMTPS id %08X\r\n"
+                     "\tfor <victim@%s>; %s" % (i, i, rng.randrange(1, 255), i + 1,
+                                               rng.getrandbits(32), spf_domain,
+                                               date.strftime('%a, %d %b %Y %H:%M:%S +0000')))
+    envelope = sender_email if rng.random() < 0.7 else "bounce%d@mailer.example.com" % rng.randrange(1000)
+    lines.append("Received-SPF: %s (mx1.%s: domain of %s designates 192.0.2.1 as\r\n"
+                 " permitted sender) identity=mailfrom; client-ip=192.0.2.1;\r\n"
+                 " receiver=mx1.%s; envelope-from=\"%s\"; x-sender=\"%s\"" % (
+                     rng.choice(("Pass", "Pass", "None", "Fail")), spf_domain, envelope, spf_domain, envelope, envelope))
+    lines.append("From: %s" % sender_email)
+    lines.append("To: victim@%s" % spf_domain)
+    lines.append("Subject: test")
+    lines.append("Date: %s" % date.strftime('%a, %d %b %Y %H:%M:%S +0000'))
+    return "\r\n".join(lines) + "\r\n\r\n"
+
+
+def make_body(rng, size, non_ascii):
+    words = []
+    length = 0
+    vocabulary = WORDS + NON_ASCII_WORDS if non_ascii else WORDS
+    while length < size:
+        if rng.random() < 0.02:
+            word = "http://%s.example.com/%s?id=%d" % (rng.choice(WORDS), rng.choice(WORDS), rng.randrange(10 ** 6))
+        else:
+            word = rng.choice(vocabulary)
+        words.append(word)
+        length += len(word) + 1
+        if rng.random() < 0.08:
+            words.append("\r\n")
+    return " ".join(words)[:size]
+
+
+def make_payload(rng, size, pool):
+    if pool and rng.random() < 0.5:
+        return rng.choice(pool)
+    block = bytes(bytearray(rng.getrandbits(8) for _ in range(min(size, 4096))))
+    data = (block * (size // max(len(block), 1) + 1))[:size]
+    # Unique content even when the random block repeats
+    data = struct.pack('<Q', rng.getrandbits(64)) + data[8:] if size >= 8 else data
+    if len(pool) < 32:
+        pool.append(data)
+    return data
+
+
+def generate_message(rng, body_size=4096, received=10, attachments=2, attachment_size=32 * 1024,
+                     unicode=True, nested_depth=0, pool=None, embedded=False):
+    pool = [] if pool is None else pool
+    date = datetime.datetime(2018, 1, 1) + datetime.timedelta(seconds=rng.randrange(365 * 86400))
+    sender = "%s.%s@%s.com" % (rng.choice(WORDS), rng.choice(WORDS), rng.choice(WORDS))
+    nested = None
+    if nested_depth > 0:
+        nested = generate_message(rng, body_size, received, attachments, attachment_size, unicode,
+                                  nested_depth - 1, pool, embedded=True)
+    return build_message(
+        subject="%s %s %d" % (rng.choice(WORDS).capitalize(), rng.choice(WORDS), rng.randrange(10 ** 6)),
+        body=make_body(rng, body_size, unicode),
+        header=make_header(rng, received, sender, date=date),
+        sender_name=sender.split('@')[0],
+        sender_email=sender,
+        to="victim",
+        date=date,
+        attachments=[(rng.choice(RISKY_NAMES), make_payload(rng, attachment_size, pool))
+                     for _ in range(attachments)],
+        nested=nested,
+        unicode=unicode,
+        embedded=embedded)
+
+
+def generate_corpus(directory, count=100, seed=0, body_size=4096, received=10, attachments=2,
+                    attachment_size=32 * 1024, unicode_ratio=1.0, nested_depth=0):
+    """Writes count synthetic messages to directory, returns their paths"""
+    rng = random.Random(seed)
+    pool = []
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    for i in range(count):
+        tree = generate_message(rng, body_size, received, attachments, attachment_size,
+                                rng.random() < unicode_ratio, nested_depth, pool)
+        path = os.path.join(directory, "synthetic-%06d.msg" % i)
+        with open(path, 'wb') as f:
+            write_compound_file(f, tree)
+        paths.append(path)
+    return paths
+
+
+def add_corpus_arguments(parser):
+    parser.add_argument("--count", type=int, default=100, help="number of messages")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--body-size", type=int, default=4096, help="body length in characters")
+    parser.add_argument("--received", type=int, default=10, help="Received fields per header")
+    parser.add_argument("--attachments", type=int, default=2, help="attachments per message")
+    parser.add_argument("--attachment-size", type=int, default=32 * 1024, help="attachment size in bytes")
+    parser.add_argument("--unicode-ratio", type=float, default=1.0,
+                        help="share of messages with Unicode (001F) rather than ASCII (001E) strings")
+    parser.add_argument("--nested-depth", type=int, default=0, help="levels of attached .msg in every message")
+
+
+def corpus_options(args):
+    return dict(count=args.count, seed=args.seed, body_size=args.body_size, received=args.received,
+                attachments=args.attachments, attachment_size=args.attachment_size,
+                unicode_ratio=args.unicode_ratio, nested_depth=args.nested_depth)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic .msg corpus")
+    parser.add_argument("directory")
+    add_corpus_arguments(parser)
+    args = parser.parse_args()
+    paths = generate_corpus(args.directory, **corpus_options(args))
+    print("%d messages written to %s" % (len(paths), args.directory))
+
+
+if __name__ == "__main__":
+    main()